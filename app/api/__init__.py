@@ -1,9 +1,11 @@
 from fastapi import APIRouter
 
+from .jwks_api import jwks_router
 from .metrics_api import metrics_router
 from .user_api import user_router
 
 router = APIRouter()
 
 router.include_router(metrics_router)
-router.include_router(user_router)
\ No newline at end of file
+router.include_router(user_router)
+router.include_router(jwks_router)
\ No newline at end of file
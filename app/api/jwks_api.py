@@ -0,0 +1,27 @@
+# @Time: 2/17/26 20:50
+# @Author: jie
+# @File: jwks_api.py
+# @Description: Public signing keys for services that verify our access tokens
+from fastapi import APIRouter, Request, Response
+
+from app.core.jwt_keys import JWKS_MAX_AGE_SECONDS, get_key_ring
+
+jwks_router = APIRouter()
+
+_EMPTY_JWKS = b'{"keys":[]}'
+
+
+@jwks_router.get("/.well-known/jwks.json")
+def jwks(request: Request):
+    """
+    JWKS of every key in JWT_KEYS_DIR (empty in HS256 mode).
+
+    Served from bytes built once per process, with Cache-Control and an ETag
+    so consumers revalidate with a 304 instead of re-downloading.
+    """
+    ring = get_key_ring()
+    body, etag = (ring.jwks_body, ring.jwks_etag) if ring is not None else (_EMPTY_JWKS, '"empty"')
+    headers = {"Cache-Control": f"public, max-age={JWKS_MAX_AGE_SECONDS}", "ETag": etag}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/jwk-set+json", headers=headers)
@@ -1,12 +1,34 @@
+import hmac
+import os
 import time
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 
 from app.core.deps import get_current_user
+from app.core.http_metrics import request_metrics
+from app.core.jwt_cache import verified_token_cache
+from app.core.profiler import request_profiler
+from app.core.rate_limit import login_limiter, register_limiter
+from app.core.redis_client import redis_breaker
+from app.core.security import PasswordService
+from app.core.token_denylist import token_denylist
+from app.db import pool_metrics
+from app.db.replicas import get_replica_set
+from app.service.group_commit import session_batcher
+from app.service.health_monitor import health_monitor
+from app.service.refresh_singleflight import refresh_flights
+from app.service.session_flusher import session_flusher
+from app.service.session_store import session_store
+from app.service.session_sweeper import session_sweeper
 
 metrics_router = APIRouter()
 
 START_TIME = time.time()
-REQUEST_COUNT = 0
+
+# Bearer token Prometheus must send to /metrics/prometheus. Empty: scraping
+# is refused (behind nginx every client looks local, so there is no safe
+# unauthenticated default)
+METRICS_SCRAPE_TOKEN = os.getenv("METRICS_SCRAPE_TOKEN", "")
 
 @metrics_router.get("/")
 def read_root():
@@ -21,37 +43,53 @@ def hello(name: str = "world"):
     return {"message": f"hello {name}"}
 
 @metrics_router.get("/metrics")
-def metrics(current_user: dict = Depends(get_current_user)):
-    global REQUEST_COUNT
-    REQUEST_COUNT += 1
+async def metrics(current_user: dict = Depends(get_current_user)):
     return {
         "uptime_seconds": int(time.time() - START_TIME),
-        "request_count": REQUEST_COUNT,
+        "request_count": request_metrics.total_requests(),
+        "password_engine": PasswordService.stats(),
+        "db_pool": pool_metrics(),
+        "db_replicas": get_replica_set().stats(),
+        "jwt_cache": verified_token_cache.stats(),
+        "redis_breaker": redis_breaker.stats(),
+        "token_denylist": token_denylist.stats(),
+        "profiler": request_profiler.stats(),
+        "rate_limit": {"login": login_limiter.stats(), "register": register_limiter.stats()},
+        "sessions": {
+            **session_store.stats(),
+            "write_behind": session_flusher.stats(),
+            "group_commit": session_batcher.stats(),
+            "sweeper": session_sweeper.stats(),
+            "refresh_singleflight": refresh_flights.stats(),
+        },
     }
 
 
+@metrics_router.get("/metrics/prometheus", response_class=PlainTextResponse)
+async def prometheus_metrics(request: Request):
+    """Request latency histograms in Prometheus text format, summed over all workers."""
+    if not METRICS_SCRAPE_TOKEN:
+        raise HTTPException(status_code=403, detail="Prometheus scraping is disabled")
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_SCRAPE_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid scrape token")
+    return PlainTextResponse(request_metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @metrics_router.get("/ready")
 async def ready():
     """
-    Check all external dependencies for readiness.
-    
-    Returns 200 if all configured dependencies are healthy.
-    Returns 503 if any configured dependency is unhealthy.
+    Readiness from the background health monitor's last result (no I/O here).
+
+    Returns 200 if all configured dependencies were healthy at the last check.
+    Returns 503 if any was unhealthy, or the last check is too old.
     """
-    from app.db import check_database_ready
-    from app.core.redis_client import check_redis_ready
-    
-    db_status = check_database_ready()
-    redis_status = await check_redis_ready()
-    
-    status = {**db_status, **redis_status}
-    
-    # Consider "not_configured" as acceptable (dependency is optional)
-    all_ok = all(v == "ok" or v == "not_configured" for v in status.values())
-    
-    if not all_ok:
-        from fastapi import HTTPException
-        raise HTTPException(status_code=503, detail=status)
-    
-    return {"status": "ready", "dependencies": status}
+    if health_monitor.checked_at is None:
+        # Monitor not running (no lifespan) or first check still in flight
+        await health_monitor.refresh()
+
+    snapshot = health_monitor.snapshot()
+    if not health_monitor.is_ready():
+        raise HTTPException(status_code=503, detail=snapshot)
 
+    return {"status": "ready", **snapshot}
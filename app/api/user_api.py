@@ -2,22 +2,28 @@
 # @Author: jie
 # @File: user_api.py
 # @Description:
-import hashlib
-import secrets
 import os
 
 from datetime import datetime, timedelta, timezone
 
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from typing import Optional
 
-from app.core.redis_client import get_redis_client
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from sqlalchemy import select
+
+from app.core.deps import get_current_user, revoke_bearer_token
+from app.core.rate_limit import login_limiter, register_limiter
 from app.core.security import PasswordService
-from app.db.database import get_db
+from app.db.database import DbSession, get_db_session
+from app.db.replicas import pin_primary_reads, scalar_or_primary
 from app.core.jwt import create_access_token
 from app.model import User
 from app.model.LoginRequest import LoginRequest
-from app.model.RefreshSession import RefreshSession
 from app.model.RegisterRequest import RegisterRequest
+from app.service.session_store import session_store
+from app.service.refresh_singleflight import RefreshResult, refresh_flights
+from app.service.user_service import insert_user, rehash_password_in_background, username_taken
+from app.utils.hash import generate_refresh_token, hash_refresh_token
 
 user_router = APIRouter()
 
@@ -43,7 +49,9 @@ def _set_refresh_cookie(response: Response, token: str) -> None:
 
 
 @user_router.post("/register")
-def register(data: RegisterRequest, db=Depends(get_db)):
+async def register(
+    data: RegisterRequest, request: Request, response: Response, db: DbSession = Depends(get_db_session)
+):
     """Register a new user."""
     username = data.username.strip()
     password = data.password
@@ -54,53 +62,46 @@ def register(data: RegisterRequest, db=Depends(get_db)):
     if len(password) < 6:
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
 
-    exists = db.query(User).filter(User.username == username).first()
-    if exists:
+    # 429 before any DB query or bcrypt work
+    await register_limiter.check(request)
+    # Known duplicates are rejected before paying for a bcrypt hash
+    if await username_taken(db, username):
         raise HTTPException(status_code=409, detail="Username already exists")
-    u = User(
-        username=username,
-        password_hash=PasswordService.hash_password(password),
-        is_active=True
-    )
-    db.add(u)
-    db.commit()
-    db.refresh(u)
+    password_hash = await PasswordService.hash_password_async(password)
+    # One round trip; a concurrent registration of the same name gets 409, not a 500
+    if await insert_user(db, username, password_hash) is None:
+        raise HTTPException(status_code=409, detail="Username already exists")
+    # The login that usually follows must find the user even if replicas lag
+    pin_primary_reads(response)
     return {"message": "registered", "username": username}
 
 
 @user_router.post("/login")
-async def login(data: LoginRequest, response: Response, db=Depends(get_db)):
+async def login(data: LoginRequest, request: Request, response: Response, db: DbSession = Depends(get_db_session)):
     """Login: return a short-lived access token; refresh the token stored in HttpOnly cookie."""
-    user = db.query(User).filter(User.username == data.username.strip()).first()
-    if not user or not PasswordService.verify_password(data.password, user.password_hash):
+    # 429 before any DB query or bcrypt work
+    await login_limiter.check(request, data.username)
+    # Replica read; not found there is re-checked on the primary
+    user = await scalar_or_primary(db, select(User).where(User.username == data.username.strip()))
+    # End the read transaction: don't hold a pooled connection across bcrypt
+    # (or while waiting on the group-commit writer, which needs one itself)
+    await db.commit()
+    if not user or not await PasswordService.verify_password_async(data.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     if not user.is_active:
         raise HTTPException(status_code=403, detail="User is inactive")
+    # Cost changed (BCRYPT_ROUNDS / calibration): upgrade the stored hash, off the request path
+    if PasswordService.needs_rehash(user.password_hash):
+        rehash_password_in_background(user.id, user.password_hash, data.password)
 
     access_token = create_access_token(user.username)
-    plain = secrets.token_urlsafe(32)
-    token_hash = hashlib.sha256(plain.encode()).hexdigest()
+    plain = generate_refresh_token()
+    token_hash = hash_refresh_token(plain)
 
     expires_at = datetime.now(timezone.utc) + timedelta(seconds=REFRESH_TTL_SECONDS)
 
-    session = RefreshSession(
-        user_id=user.id,
-        token_hash=token_hash,
-        expires_at=expires_at,
-        revoked_at=None,
-    )
-    db.add(session)
-    db.commit()
-    db.refresh(session)
-
-    # Async Redis call
-    rds = get_redis_client()
-    if rds:
-        await rds.setex(
-            f"rt:{token_hash}",
-            REFRESH_TTL_SECONDS,
-            str(session.id)
-        )
+    # Per SESSION_STORE (database: row inline or written behind + Redis record)
+    await session_store.create(db, user, token_hash, expires_at, REFRESH_TTL_SECONDS)
 
     _set_refresh_cookie(response, plain)
     return {
@@ -110,121 +111,93 @@ async def login(data: LoginRequest, response: Response, db=Depends(get_db)):
 
 
 @user_router.post("/refresh")
-async def refresh(request: Request, response: Response, db=Depends(get_db)):
+async def refresh(request: Request, response: Response, db: DbSession = Depends(get_db_session)):
     """Refresh rotation using HttpOnly cookie.
 
     Reads refresh token from cookie, rotates it, returns new access token.
+    A duplicate of a rotation in flight, or done within REFRESH_GRACE_SECONDS,
+    gets that rotation's result instead of "Refresh token revoked".
     """
     old_plain = request.cookies.get(REFRESH_COOKIE_NAME)
     if not old_plain:
         raise HTTPException(status_code=401, detail="Missing refresh token cookie")
 
-    now = datetime.now(timezone.utc)
-    old_hash = hashlib.sha256(old_plain.encode()).hexdigest()
-    old_key = f"rt:{old_hash}"
-
-    session = None
-
-    # 1) Try Redis lookup first
-    rds = get_redis_client()
-    if rds:
-        sid = await rds.get(old_key)
-        if sid is not None:
-            session = db.query(RefreshSession).filter(RefreshSession.id == int(sid)).first()
-
-    # 2) Fallback: DB lookup by token_hash (handles Redis restart / TTL loss)
-    if session is None:
-        session = db.query(RefreshSession).filter(RefreshSession.token_hash == old_hash).first()
-
-        if session is None:
-            raise HTTPException(status_code=401, detail="Invalid refresh token")
-
-        if session.revoked_at is not None:
-            raise HTTPException(status_code=401, detail="Refresh token revoked")
-
-        if session.expires_at <= now:
-            raise HTTPException(status_code=401, detail="Refresh token expired")
-
-        # Re-hydrate Redis with remaining TTL
-        rds_client = get_redis_client()
-        if rds_client:
-            remaining = int((session.expires_at - now).total_seconds())
-            if remaining > 0:
-                await rds_client.setex(old_key, remaining, str(session.id))
-
-    # 3) Validate session state (for redis-hit case)
-    if session.revoked_at is not None:
-        raise HTTPException(status_code=401, detail="Refresh token revoked")
-
-    if session.expires_at <= now:
-        # best-effort cleanup
-        rds_cleanup = get_redis_client()
-        if rds_cleanup:
-            await rds_cleanup.delete(old_key)
-        raise HTTPException(status_code=401, detail="Refresh token expired")
-
-    # 4) Rotation: revoke old session + delete old redis key
-    session.revoked_at = now
-    db.commit()
-    if rds:
-        await rds.delete(old_key)
-
-    # 5) Issue new refresh token (plain in cookie; hash in DB/Redis)
-    new_plain = secrets.token_urlsafe(32)
-    new_hash = hashlib.sha256(new_plain.encode()).hexdigest()
-
-    new_expires_at = now + timedelta(seconds=REFRESH_TTL_SECONDS)
-    new_session = RefreshSession(
-        user_id=session.user_id,
-        token_hash=new_hash,
-        expires_at=new_expires_at,
-        revoked_at=None,
-    )
-    db.add(new_session)
-    db.commit()
-    db.refresh(new_session)
+    old_hash = hash_refresh_token(old_plain)
 
-    if rds:
-        await rds.setex(f"rt:{new_hash}", REFRESH_TTL_SECONDS, str(new_session.id))
+    async def _rotate() -> RefreshResult:
+        now = datetime.now(timezone.utc)
 
-    _set_refresh_cookie(response, new_plain)
+        # 1) Issue new refresh token (plain in cookie; hash in DB/Redis)
+        new_plain = generate_refresh_token()
+        new_hash = hash_refresh_token(new_plain)
+        new_expires_at = now + timedelta(seconds=REFRESH_TTL_SECONDS)
 
-    # 6) Return new access token
-    user = db.query(User).filter(User.id == session.user_id).first()
-    if not user or not user.is_active:
-        raise HTTPException(status_code=401, detail="User not available")
+        # 2) Rotation: revoke old + create new, atomically in the session store
+        rotated = await session_store.rotate(db, old_hash, new_hash, now, new_expires_at, REFRESH_TTL_SECONDS)
 
-    access_token = create_access_token(user.username)
+        # 3) New access token
+        return RefreshResult(
+            access_token=create_access_token(rotated.username), refresh_token=new_plain, user_id=rotated.user_id
+        )
+
+    # Concurrent tabs presenting the same cookie share one rotation
+    result = await refresh_flights.run(old_plain, old_hash, _rotate)
+
+    _set_refresh_cookie(response, result.refresh_token)
+    pin_primary_reads(response)
 
     return {
-        "access_token": access_token,
+        "access_token": result.access_token,
         "token_type": "bearer",
     }
 
 
 @user_router.post("/logout")
-async def logout(request: Request, response: Response, db=Depends(get_db)):
+async def logout(
+    request: Request,
+    response: Response,
+    authorization: Optional[str] = Header(default=None),
+    db: DbSession = Depends(get_db_session),
+):
     """Logout by revoking refresh token.
 
-    - Server: revoke session in DB and delete Redis cache
+    - Server: revoke the session in the session store;
+      the access token sent as Bearer (if any) is denylisted until it expires
     - Client: cookie is cleared; access token (JWT) should also be deleted client-side
     """
     token_plain = request.cookies.get(REFRESH_COOKIE_NAME)
 
     if token_plain:
-        token_hash = hashlib.sha256(token_plain.encode()).hexdigest()
-        redis_key = f"rt:{token_hash}"
+        token_hash = hash_refresh_token(token_plain)
+        record = await session_store.lookup(db, token_hash)
+        await session_store.revoke(db, token_hash, datetime.now(timezone.utc))
+        if record is not None:
+            # A tab still holding the pre-rotation cookie must not get the new tokens
+            await refresh_flights.forget_user(record.user_id)
+    await revoke_bearer_token(authorization)
+
+    response.delete_cookie(key=REFRESH_COOKIE_NAME, path="/")
+    return {"message": "logged out"}
+
 
-        # Revoke session in DB
-        session = db.query(RefreshSession).filter(RefreshSession.token_hash == token_hash).first()
-        if session and session.revoked_at is None:
-            session.revoked_at = datetime.now(timezone.utc)
-            db.commit()
+@user_router.post("/logout/all")
+async def logout_all(
+    response: Response,
+    authorization: Optional[str] = Header(default=None),
+    current_user: dict = Depends(get_current_user),
+    db: DbSession = Depends(get_db_session),
+):
+    """Revoke every refresh session of the current user (all devices), and the calling access token.
 
-        # Delete from Redis
-        rds = get_redis_client()
-        if rds:
-            await rds.delete(redis_key)
+    Other devices' access tokens are not tracked server-side; they stop
+    working when they expire and can no longer be refreshed.
+    """
+    user_id = await scalar_or_primary(db, select(User.id).where(User.username == current_user["sub"]))
+    if user_id is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    revoked = await session_store.revoke_all(db, user_id, datetime.now(timezone.utc))
+    await refresh_flights.forget_user(user_id)
+    await revoke_bearer_token(authorization)
 
     response.delete_cookie(key=REFRESH_COOKIE_NAME, path="/")
-    return {"message": "logged out"}
+    return {"message": "logged out everywhere", "sessions_revoked": revoked}
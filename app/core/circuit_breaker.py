@@ -0,0 +1,101 @@
+# @Time: 2/20/26 20:20
+# @Author: jie
+# @File: circuit_breaker.py
+# @Description: Consecutive-failure circuit breaker with a single half-open probe
+import time
+from typing import Callable, List, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures; every call
+    is then refused without touching the dependency. After `reset_seconds`
+    the next call is let through as the probe (half-open): success closes
+    the breaker, failure re-opens it for another `reset_seconds`.
+
+    Only used from the event loop, so no lock.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._on_close: List[Callable[[], None]] = []
+
+        self.state_changed_at = time.time()
+        self.failures = 0
+        self.opens = 0
+        self.rejected = 0
+        self.probes = 0
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        self.state_changed_at = time.time()
+
+    def is_closed(self) -> bool:
+        return self.state == CLOSED
+
+    def allow(self) -> bool:
+        """May a call go through now? In half-open, only the one probe may."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.reset_seconds:
+                self.rejected += 1
+                return False
+            self._set_state(HALF_OPEN)
+        if self._probe_in_flight:
+            self.rejected += 1
+            return False
+        self._probe_in_flight = True
+        self.probes += 1
+        return True
+
+    def record_success(self) -> None:
+        self._consecutive_failures = 0
+        if self.state != CLOSED:
+            self._probe_in_flight = False
+            self._set_state(CLOSED)
+            for callback in self._on_close:
+                callback()
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self._consecutive_failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self.opens += 1
+            self._set_state(OPEN)
+
+    def record_abandoned(self) -> None:
+        """The call ended without an outcome (cancelled): free the probe slot."""
+        self._probe_in_flight = False
+
+    def on_close(self, callback: Callable[[], None]) -> None:
+        """Run `callback` (synchronously, on the event loop) whenever the breaker recovers."""
+        self._on_close.append(callback)
+
+    def stats(self) -> dict:
+        retry_in: Optional[float] = None
+        if self.state == OPEN:
+            retry_in = round(max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at)), 3)
+        return {
+            "state": self.state,
+            "state_age_seconds": round(time.time() - self.state_changed_at, 3),
+            "probe_in_seconds": retry_in,
+            "failure_threshold": self.failure_threshold,
+            "reset_seconds": self.reset_seconds,
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "probes": self.probes,
+        }
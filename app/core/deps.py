@@ -11,6 +11,8 @@ import jwt
 from fastapi import Header, HTTPException, status
 
 from .jwt import decode_and_verify
+from .jwt_cache import verified_token_cache
+from .token_denylist import token_denylist
 
 
 def get_bearer_token(authorization: Optional[str]) -> Optional[str]:
@@ -42,9 +44,15 @@ def decode_and_verify_jwt(token: str) -> Dict[str, Any]:
     """Verify JWT and return payload.
 
     This function translates JWT library errors into FastAPI-friendly HTTP 401.
+    Verified payloads are cached (see jwt_cache), so repeat requests with the
+    same token skip base64/JSON decoding and the signature check.
     """
+    cached = verified_token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         payload = decode_and_verify(token)
+        verified_token_cache.put(token, payload)
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(
@@ -60,13 +68,15 @@ def decode_and_verify_jwt(token: str) -> Dict[str, Any]:
         )
 
 
-def get_current_user(authorization: Optional[str] = Header(default=None)) -> Dict[str, Any]:
+async def get_current_user(authorization: Optional[str] = Header(default=None)) -> Dict[str, Any]:
     """FastAPI dependency: get current user from Bearer token.
 
     Usage in routes:
       current_user = Depends(get_current_user)
 
     For demo purposes, it returns the JWT payload directly.
+    Revoked tokens (see token_denylist) are rejected; for a token that was
+    never revoked that costs one in-memory bloom lookup.
     """
     token = get_bearer_token(authorization)
     if not token:
@@ -86,4 +96,28 @@ def get_current_user(authorization: Optional[str] = Header(default=None)) -> Dic
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    return payload
\ No newline at end of file
+    # Tokens issued before jti existed can't be revoked; they age out with exp
+    jti = payload.get("jti")
+    if jti is not None and await token_denylist.is_revoked(jti):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    return payload
+
+
+async def revoke_bearer_token(authorization: Optional[str]) -> bool:
+    """Deny the presented access token until it expires. Invalid / missing tokens are ignored."""
+    token = get_bearer_token(authorization)
+    if not token:
+        return False
+    try:
+        payload = decode_and_verify_jwt(token)
+    except HTTPException:
+        return False
+    if "jti" not in payload:
+        return False
+    await token_denylist.revoke(payload["jti"], payload["exp"])
+    return True
@@ -0,0 +1,58 @@
+# @Time: 2/10/26 20:45
+# @Author: jie
+# @File: fork_safety.py
+# @Description: Per-process lazy singletons that refuse to cross a fork
+import os
+from functools import lru_cache, wraps
+from typing import Callable, List, TypeVar
+
+T = TypeVar("T")
+
+_SINGLETONS: List[Callable] = []
+
+
+class ForkSafetyError(RuntimeError):
+    """A connection-owning singleton was created in a parent process and used in a fork."""
+
+
+def process_singleton(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    lru_cache(maxsize=1) that remembers which process created the value.
+
+    Engines, pools and Redis clients hold sockets; a forked worker that
+    reuses its parent's copy shares those sockets with every sibling and
+    corrupts the protocol stream. Calling the singleton from a different
+    pid than the one that built it raises ForkSafetyError instead.
+    A None result (dependency not configured) owns nothing and is exempt.
+
+    cache_info() / cache_clear() are kept from lru_cache.
+    """
+    owner = {}
+
+    @lru_cache(maxsize=1)
+    def cached() -> T:
+        owner["pid"] = os.getpid()
+        return factory()
+
+    @wraps(factory)
+    def wrapper() -> T:
+        value = cached()
+        if value is not None and owner["pid"] != os.getpid():
+            raise ForkSafetyError(
+                f"{factory.__module__}.{factory.__qualname__}() was created in pid {owner['pid']} "
+                f"and used in pid {os.getpid()}. Create it after the fork (lazily or in lifespan), "
+                "not at import time in the parent; don't preload the app in a forking server."
+            )
+        return value
+
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    _SINGLETONS.append(wrapper)
+    return wrapper
+
+
+def check_fork_safety() -> None:
+    """Fail at worker startup if any process singleton was inherited from a parent."""
+    for singleton in _SINGLETONS:
+        if singleton.cache_info().currsize:
+            singleton()  # raises ForkSafetyError if it belongs to another pid
@@ -0,0 +1,317 @@
+# @Time: 2/09/26 21:00
+# @Author: jie
+# @File: http_metrics.py
+# @Description: Per-route request latency histograms with Prometheus text exposition
+import glob
+import json
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.core.stats import DEFAULT_LATENCY_BUCKETS
+
+# Directory shared by all uvicorn workers of one instance. Empty: metrics are
+# per process (fine for a single worker). It must be emptied when the instance
+# starts, like prometheus_client's PROMETHEUS_MULTIPROC_DIR.
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+
+UNMATCHED_ROUTE = "<unmatched>"
+# The request line's verb is client-chosen: anything else shares one label
+KNOWN_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+OTHER_METHOD = "other"
+# Set in the ASGI scope of synthetic requests (app.service.warmup): not counted.
+# A scope key, unlike a header, can't be sent by a client.
+WARM_UP_SCOPE_KEY = "app.warm_up"
+
+_INITIAL_FILE_SIZE = 64 * 1024
+_HEADER = struct.Struct("<I4x")  # bytes used, padding to 8
+_KEY_LEN = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+
+
+class MmapValues:
+    """
+    Append-only key -> float64 store in a per-process mmap'ed file.
+
+    Layout: header (used bytes), then entries of
+    [u32 key length][utf-8 key][padding to 8][f64 value].
+    Writers only ever touch their own file, from the event loop thread, so
+    updates are a plain pack_into with no lock. Readers in other workers
+    parse every file in the directory and sum the values.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._positions: Dict[str, int] = {}
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, _INITIAL_FILE_SIZE)
+            self._capacity = os.fstat(fd).st_size
+            self._mm = mmap.mmap(fd, self._capacity)
+        finally:
+            os.close(fd)
+        self._used = _HEADER.unpack_from(self._mm, 0)[0] or _HEADER.size
+        for key, _, pos in _iter_entries(self._mm, self._used):
+            self._positions[key] = pos
+
+    def _grow(self, needed: int) -> None:
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        self._mm.close()
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.ftruncate(fd, capacity)
+            self._mm = mmap.mmap(fd, capacity)
+        finally:
+            os.close(fd)
+        self._capacity = capacity
+
+    def _position(self, key: str) -> int:
+        pos = self._positions.get(key)
+        if pos is not None:
+            return pos
+        encoded = key.encode()
+        padded = _KEY_LEN.size + len(encoded)
+        padded += -padded % 8
+        entry_size = padded + _VALUE.size
+        if self._used + entry_size > self._capacity:
+            self._grow(self._used + entry_size)
+        start = self._used
+        _KEY_LEN.pack_into(self._mm, start, len(encoded))
+        self._mm[start + _KEY_LEN.size : start + _KEY_LEN.size + len(encoded)] = encoded
+        pos = start + padded
+        _VALUE.pack_into(self._mm, pos, 0.0)
+        # Publish the entry only once it is complete
+        self._used += entry_size
+        _HEADER.pack_into(self._mm, 0, self._used)
+        self._positions[key] = pos
+        return pos
+
+    def inc(self, key: str, amount: float = 1.0) -> None:
+        pos = self._position(key)
+        _VALUE.pack_into(self._mm, pos, _VALUE.unpack_from(self._mm, pos)[0] + amount)
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+def _iter_entries(buf, used: int) -> Iterator[Tuple[str, float, int]]:
+    pos = _HEADER.size
+    while pos < used:
+        (length,) = _KEY_LEN.unpack_from(buf, pos)
+        key_start = pos + _KEY_LEN.size
+        key = bytes(buf[key_start : key_start + length]).decode()
+        value_pos = key_start + length + (-(_KEY_LEN.size + length) % 8)
+        yield key, _VALUE.unpack_from(buf, value_pos)[0], value_pos
+        pos = value_pos + _VALUE.size
+
+
+def _read_file(path: str) -> List[Tuple[str, float]]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        return []
+    used = _HEADER.unpack_from(data, 0)[0]
+    return [(key, value) for key, value, _ in _iter_entries(data, min(used, len(data)))]
+
+
+class DictValues:
+    """In-process fallback with the same interface as MmapValues."""
+
+    def __init__(self):
+        self.values: Dict[str, float] = defaultdict(float)
+
+    def inc(self, key: str, amount: float = 1.0) -> None:
+        self.values[key] += amount
+
+    def close(self) -> None:
+        pass
+
+
+@lru_cache(maxsize=4096)
+def _key(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+    return json.dumps([name, labels], separators=(",", ":"))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class RequestMetrics:
+    """
+    http_request_duration_seconds{method, route, status} histogram and an
+    http_requests_in_flight gauge.
+
+    Bucket counts are stored non-cumulatively and summed into Prometheus'
+    cumulative `le` buckets at scrape time. With METRICS_MULTIPROC_DIR set,
+    counters live in counters_<pid>.db and the gauge in gauge_<pid>.db; a
+    scrape on any worker sums all files. The gauge file is removed when its
+    worker stops, so dead workers stop contributing in-flight requests.
+    """
+
+    DURATION = "http_request_duration_seconds"
+    IN_FLIGHT = "http_requests_in_flight"
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS, multiproc_dir: str = METRICS_MULTIPROC_DIR):
+        self.buckets = tuple(sorted(buckets))
+        self.multiproc_dir = multiproc_dir
+        self._pid: Optional[int] = None
+        self._counters = None
+        self._gauges = None
+
+    def _stores(self):
+        # Opened lazily and per pid, so a store created before a fork is never shared
+        pid = os.getpid()
+        if self._pid != pid:
+            if self.multiproc_dir:
+                os.makedirs(self.multiproc_dir, exist_ok=True)
+                self._counters = MmapValues(os.path.join(self.multiproc_dir, f"counters_{pid}.db"))
+                self._gauges = MmapValues(os.path.join(self.multiproc_dir, f"gauge_{pid}.db"))
+            else:
+                self._counters, self._gauges = DictValues(), DictValues()
+            self._pid = pid
+        return self._counters, self._gauges
+
+    def observe(self, method: str, route: str, status: int, seconds: float) -> None:
+        counters, _ = self._stores()
+        labels = (("method", method), ("route", route), ("status", str(status)))
+        idx = bisect_left(self.buckets, seconds)
+        le = str(self.buckets[idx]) if idx < len(self.buckets) else "+Inf"
+        counters.inc(_key(self.DURATION + "_bucket", labels + (("le", le),)))
+        counters.inc(_key(self.DURATION + "_sum", labels), seconds)
+        counters.inc(_key(self.DURATION + "_count", labels))
+
+    def track_in_flight(self, method: str, delta: int) -> None:
+        _, gauges = self._stores()
+        gauges.inc(_key(self.IN_FLIGHT, (("method", method),)), delta)
+
+    def mark_process_dead(self) -> None:
+        """Drop this worker's gauge file (its counters are kept)."""
+        if self._pid != os.getpid():
+            return
+        self._counters.close()
+        self._gauges.close()
+        if self.multiproc_dir:
+            path = os.path.join(self.multiproc_dir, f"gauge_{self._pid}.db")
+            if os.path.exists(path):
+                os.remove(path)
+        self._pid = None
+
+    def _collect(self) -> Tuple[Dict[str, float], Dict[str, float]]:
+        counters, gauges = self._stores()
+        if not self.multiproc_dir:
+            return dict(counters.values), dict(gauges.values)
+        merged = []
+        for pattern in ("counters_*.db", "gauge_*.db"):
+            totals: Dict[str, float] = defaultdict(float)
+            for path in glob.glob(os.path.join(self.multiproc_dir, pattern)):
+                try:
+                    entries = _read_file(path)
+                except FileNotFoundError:  # worker exited mid-scrape
+                    continue
+                for key, value in entries:
+                    totals[key] += value
+            merged.append(totals)
+        return merged[0], merged[1]
+
+    def _series(self, counters: Dict[str, float]) -> Dict[str, dict]:
+        series: Dict[str, dict] = defaultdict(dict)
+        for key, value in counters.items():
+            name, labels = json.loads(key)
+            series[name][tuple(tuple(pair) for pair in labels)] = value
+        return series
+
+    def total_requests(self) -> int:
+        counters, _ = self._collect()
+        return int(sum(self._series(counters)[self.DURATION + "_count"].values()))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        counters, gauges = self._collect()
+        series = self._series(counters)
+        buckets: Dict[tuple, Dict[str, float]] = defaultdict(dict)
+        for labels, value in series[self.DURATION + "_bucket"].items():
+            buckets[labels[:-1]][labels[-1][1]] = value
+
+        lines = [
+            f"# HELP {self.DURATION} HTTP request latency by route and status.",
+            f"# TYPE {self.DURATION} histogram",
+        ]
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        for labels in sorted(series[self.DURATION + "_count"]):
+            running = 0.0
+            for le in bounds:
+                running += buckets[labels].get(le, 0.0)
+                lines.append(f"{self.DURATION}_bucket{_format_labels(labels + (('le', le),))} {_format_value(running)}")
+            total = series[self.DURATION + "_sum"].get(labels, 0.0)
+            count = series[self.DURATION + "_count"][labels]
+            lines.append(f"{self.DURATION}_sum{_format_labels(labels)} {total!r}")
+            lines.append(f"{self.DURATION}_count{_format_labels(labels)} {_format_value(count)}")
+
+        lines += [
+            f"# HELP {self.IN_FLIGHT} Requests currently being served.",
+            f"# TYPE {self.IN_FLIGHT} gauge",
+        ]
+        for key, value in sorted(gauges.items()):
+            name, labels = json.loads(key)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware task/queue overhead).
+
+    The route label is the matched route template (/users/{id}, not the raw
+    path) so cardinality stays bounded; unmatched paths share one label, as
+    do methods outside KNOWN_METHODS.
+    """
+
+    def __init__(self, app, metrics: RequestMetrics = request_metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get(WARM_UP_SCOPE_KEY):
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"] if scope["method"] in KNOWN_METHODS else OTHER_METHOD
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.metrics.track_in_flight(method, 1)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.track_in_flight(method, -1)
+            route = scope.get("route")
+            self.metrics.observe(
+                method, getattr(route, "path", UNMATCHED_ROUTE), status, time.perf_counter() - start
+            )
@@ -8,11 +8,17 @@ from __future__ import annotations
 from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, Optional
 import os
+import secrets
 import jwt
 
+from .jwt_keys import get_key_ring
+from .request_timing import timed
+
 # ===== Config (for demo) =====
 # In a real project, read these from env / settings.
 JWT_SECRET = os.getenv("JWT_SECRET")
+# Used when JWT_KEYS_DIR is unset. With a key ring, HS256 tokens (no kid) are
+# still accepted while JWT_SECRET is set, so a switch doesn't log everyone out.
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 *24
 
@@ -35,6 +41,8 @@ def create_access_token(
         "sub": subject,
         "iat": int(now.timestamp()),
         "exp": int(expire.timestamp()),
+        # Unique id, so a single token can be revoked (see token_denylist)
+        "jti": secrets.token_urlsafe(16),
     }
     if claims:
         # Avoid overwriting standard claims accidentally
@@ -43,7 +51,12 @@ def create_access_token(
                 continue
             payload[k] = v
 
-    token = jwt.encode(payload, JWT_SECRET, algorithm=ALGORITHM)
+    ring = get_key_ring()
+    with timed("jwt"):
+        if ring is None:
+            token = jwt.encode(payload, JWT_SECRET, algorithm=ALGORITHM)
+        else:
+            token = jwt.encode(payload, ring.signing_key, algorithm=ring.algorithm, headers={"kid": ring.signing_kid})
     # PyJWT may return str in modern versions; keep it as str
     return token
 
@@ -55,6 +68,14 @@ def decode_and_verify(token: str) -> Dict[str, Any]:
       - jwt.ExpiredSignatureError
       - jwt.InvalidTokenError
     """
-    payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+    ring = get_key_ring()
+    with timed("jwt"):
+        kid = jwt.get_unverified_header(token).get("kid") if ring is not None else None
+        if kid is None and (ring is None or JWT_SECRET):
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+        else:
+            # Public key looked up by kid (parsed once in the key ring); alg pinned per key
+            key = ring.verification_key(kid)
+            payload = jwt.decode(token, key.key, algorithms=[key.algorithm])
     # Ensure it is a dict
     return dict(payload)
@@ -0,0 +1,117 @@
+# @Time: 2/06/26 20:10
+# @Author: jie
+# @File: jwt_cache.py
+# @Description: Bounded in-process LRU of verified JWT payloads
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# ===== Config =====
+# Entries never outlive the token's own exp; this caps how long a payload is
+# trusted without re-verification even for long-lived tokens.
+JWT_CACHE_TTL_SECONDS = int(os.getenv("JWT_CACHE_TTL_SECONDS", "300"))
+# Approximate memory budget; 0 disables the cache
+JWT_CACHE_MAX_BYTES = int(os.getenv("JWT_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Rough per-entry overhead of the OrderedDict node, tuple, key bytes and float
+_ENTRY_OVERHEAD_BYTES = 256
+
+
+class VerifiedTokenCache:
+    """
+    LRU of verified JWT payloads keyed by a digest of the raw token.
+
+    - Key: 16-byte BLAKE2b of the token, so the token itself is never stored
+    - Expiry: min(token exp, now + ttl)
+    - Size: approximate bytes (payload JSON + overhead); LRU entries are
+      evicted once max_bytes is exceeded
+    - Thread-safe: get_current_user may run in the threadpool
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: int):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[bytes, Tuple[Dict[str, Any], float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        if self.max_bytes <= 0:
+            return None
+        key = self._key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at, size = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return dict(payload)
+
+    def put(self, token: str, payload: Dict[str, Any]) -> None:
+        if self.max_bytes <= 0:
+            return
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, float(exp))
+        if expires_at <= now:
+            return
+
+        size = len(json.dumps(payload, separators=(",", ":"), default=str)) + _ENTRY_OVERHEAD_BYTES
+        key = self._key(token)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (dict(payload), expires_at, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, used = len(self._entries), self._bytes
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+verified_token_cache = VerifiedTokenCache(JWT_CACHE_MAX_BYTES, JWT_CACHE_TTL_SECONDS)
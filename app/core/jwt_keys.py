@@ -0,0 +1,112 @@
+# @Time: 2/17/26 20:20
+# @Author: jie
+# @File: jwt_keys.py
+# @Description: Asymmetric JWT key ring (EdDSA / ES256, kid-indexed) and its JWKS
+import functools
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+# ===== Config =====
+# Directory of PEM keys named <kid>.pem: Ed25519 (EdDSA) or P-256 (ES256).
+# Private keys can sign; public-only files are accepted for verification
+# (e.g. a retired key whose tokens have not expired yet). Empty: HS256 with
+# JWT_SECRET, as before.
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "")
+# kid of the private key that signs new tokens (default: the last one by name)
+JWT_SIGNING_KID = os.getenv("JWT_SIGNING_KID", "")
+# Cache-Control max-age on /.well-known/jwks.json; consumers re-fetch at most this often
+JWKS_MAX_AGE_SECONDS = int(os.getenv("JWKS_MAX_AGE_SECONDS", "300"))
+
+
+@dataclass(frozen=True)
+class VerificationKey:
+    kid: str
+    algorithm: str
+    key: Any  # cryptography public key, parsed once at load
+
+
+class KeyRing:
+    """
+    Parsed signing key + kid-indexed public keys.
+
+    Built once per process from JWT_KEYS_DIR, so a request never parses PEM.
+    Each key's algorithm is fixed by its type, and verification only accepts
+    that algorithm for that kid (no alg confusion via the token header).
+
+    Rotation: add the new <kid>.pem (published in the JWKS and accepted for
+    verification on the next deploy), then point JWT_SIGNING_KID at it;
+    remove the old file once its last tokens have expired.
+    """
+
+    def __init__(self, signing_kid: str, signing_key: Any, keys: Dict[str, VerificationKey]):
+        self.signing_kid = signing_kid
+        self.signing_key = signing_key
+        self.keys = keys
+        self.algorithm = keys[signing_kid].algorithm
+
+    @staticmethod
+    def _algorithm(public_key: Any) -> str:
+        if isinstance(public_key, ed25519.Ed25519PublicKey):
+            return "EdDSA"
+        if isinstance(public_key, ec.EllipticCurvePublicKey) and isinstance(public_key.curve, ec.SECP256R1):
+            return "ES256"
+        raise ValueError(f"Unsupported JWT key type {type(public_key).__name__} (use Ed25519 or P-256)")
+
+    @classmethod
+    def from_dir(cls, path: str, signing_kid: str = "") -> "KeyRing":
+        private_keys: Dict[str, Any] = {}
+        keys: Dict[str, VerificationKey] = {}
+        for pem_path in sorted(Path(path).glob("*.pem")):
+            kid, pem = pem_path.stem, pem_path.read_bytes()
+            if b"PRIVATE KEY" in pem:
+                private_keys[kid] = serialization.load_pem_private_key(pem, password=None)
+                public_key = private_keys[kid].public_key()
+            else:
+                public_key = serialization.load_pem_public_key(pem)
+            keys[kid] = VerificationKey(kid, cls._algorithm(public_key), public_key)
+
+        if not private_keys:
+            raise RuntimeError(f"JWT_KEYS_DIR={path} holds no private key to sign with")
+        signing_kid = signing_kid or max(private_keys)
+        if signing_kid not in private_keys:
+            raise RuntimeError(f"JWT_SIGNING_KID={signing_kid} has no private key in {path}")
+        return cls(signing_kid, private_keys[signing_kid], keys)
+
+    def verification_key(self, kid: Optional[str]) -> VerificationKey:
+        key = self.keys.get(kid) if kid else None
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown key id {kid!r}")
+        return key
+
+    def jwks(self) -> Dict[str, Any]:
+        entries = []
+        for vk in self.keys.values():
+            jwk = json.loads(jwt.get_algorithm_by_name(vk.algorithm).to_jwk(vk.key))
+            jwk.update(kid=vk.kid, alg=vk.algorithm, use="sig")
+            entries.append(jwk)
+        return {"keys": entries}
+
+    @functools.cached_property
+    def jwks_body(self) -> bytes:
+        """Serialized once: the key set only changes with a restart."""
+        return json.dumps(self.jwks(), separators=(",", ":")).encode()
+
+    @functools.cached_property
+    def jwks_etag(self) -> str:
+        return '"' + hashlib.blake2b(self.jwks_body, digest_size=12).hexdigest() + '"'
+
+
+@functools.lru_cache(maxsize=None)
+def get_key_ring() -> Optional[KeyRing]:
+    """The process's key ring, or None in HS256 mode (JWT_KEYS_DIR unset)."""
+    if not JWT_KEYS_DIR:
+        return None
+    return KeyRing.from_dir(JWT_KEYS_DIR, JWT_SIGNING_KID)
@@ -0,0 +1,157 @@
+# @Time: 2/19/26 21:00
+# @Author: jie
+# @File: profiler.py
+# @Description: Opt-in sampling profiler dumping folded stacks of chosen requests
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# ===== Config =====
+# Profile every Nth request (0: off)
+PROFILE_EVERY_N_REQUESTS = int(os.getenv("PROFILE_EVERY_N_REQUESTS", "0"))
+# Profile every request, keep those slower than this (0: off)
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/auth-profiles")
+
+_MAX_DEPTH = 128
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _fold(frame) -> str:
+    """Root-first `module.qualname;...` (the input format of flamegraph.pl and speedscope)."""
+    names: List[str] = []
+    while frame is not None and len(names) < _MAX_DEPTH:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append(f"{module}.{code.co_qualname}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the event-loop thread's stack every PROFILE_INTERVAL_MS from a
+    background thread, while at least one profiled request is in flight.
+
+    A sample is credited to the request whose task the loop is running at
+    that moment, so each dump is the on-CPU time of one request (time spent
+    awaiting Postgres/Redis/bcrypt is what Server-Timing shows). Dumps are
+    one `<stack> <count>` line per distinct stack:
+
+        flamegraph.pl $PROFILE_DIR/<file>.folded > flame.svg
+    """
+
+    def __init__(self, every_n: int, slow_ms: float, interval_ms: float, out_dir: str):
+        self.every_n = every_n
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000
+        self.out_dir = out_dir
+        self.enabled = every_n > 0 or slow_ms > 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._active: Dict[asyncio.Task, Counter] = {}
+        self._to_write: List[Tuple[str, Counter]] = []
+
+        self.requests = 0
+        self.profiled = 0
+        self.dumped = 0
+        self.samples = 0
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def begin(self) -> Optional[Tuple[asyncio.Task, bool]]:
+        """Called at request start; returns a handle if this request is profiled."""
+        if not self.enabled:
+            return None
+        self.requests += 1
+        forced = bool(self.every_n) and self.requests % self.every_n == 0
+        if not forced and not self.slow_ms:
+            return None
+        self._ensure_thread()
+        task = asyncio.current_task()
+        with self._lock:
+            self._active[task] = Counter()
+        self.profiled += 1
+        return task, forced
+
+    def end(self, handle: Tuple[asyncio.Task, bool], label: str, seconds: float) -> None:
+        task, forced = handle
+        with self._lock:
+            stacks = self._active.pop(task, None)
+            keep = forced or (self.slow_ms and seconds * 1000 >= self.slow_ms)
+            if stacks and keep:
+                name = f"{int(time.time() * 1000)}-{os.getpid()}-{_UNSAFE_CHARS.sub('_', label)}-{seconds * 1000:.0f}ms"
+                # Written by the sampler thread, not on the event loop
+                self._to_write.append((name, stacks))
+
+    def _flush(self) -> None:
+        with self._lock:
+            pending, self._to_write = self._to_write, []
+        if not pending:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        for name, stacks in pending:
+            with open(os.path.join(self.out_dir, f"{name}.folded"), "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+            self.dumped += 1
+
+    def _sample(self) -> None:
+        if not self._active:
+            return
+        frame = sys._current_frames().get(self._loop_thread_id)
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            return
+        if frame is None or task not in self._active:
+            return
+        stack = _fold(frame)
+        with self._lock:
+            stacks = self._active.get(task)
+            if stacks is not None:
+                stacks[stack] += 1
+                self.samples += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+            self._flush()
+        self._flush()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "every_n_requests": self.every_n,
+            "slow_ms": self.slow_ms,
+            "dir": self.out_dir if self.enabled else None,
+            "profiled": self.profiled,
+            "samples": self.samples,
+            "dumped": self.dumped,
+        }
+
+
+request_profiler = StackSampler(PROFILE_EVERY_N_REQUESTS, PROFILE_SLOW_MS, PROFILE_INTERVAL_MS, PROFILE_DIR)
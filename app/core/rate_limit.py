@@ -0,0 +1,202 @@
+# @Time: 2/12/26 20:20
+# @Author: jie
+# @File: rate_limit.py
+# @Description: Per-IP / per-username admission control for the bcrypt routes
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from ipaddress import ip_address, ip_network
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+from redis.exceptions import RedisError
+
+from app.core.redis_client import available_redis_client
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_WINDOW_SECONDS = int(os.getenv("RATE_LIMIT_WINDOW_SECONDS", "60"))
+RATE_LIMIT_LOGIN_PER_IP = int(os.getenv("RATE_LIMIT_LOGIN_PER_IP", "30"))
+RATE_LIMIT_LOGIN_PER_USERNAME = int(os.getenv("RATE_LIMIT_LOGIN_PER_USERNAME", "10"))
+RATE_LIMIT_REGISTER_PER_IP = int(os.getenv("RATE_LIMIT_REGISTER_PER_IP", "10"))
+# Proxies whose X-Forwarded-For hops are believed: nginx in the container by
+# default; production adds the ALB's subnets (terraform/ecs.tf)
+RATE_LIMIT_TRUSTED_PROXIES = [
+    ip_network(cidr.strip())
+    for cidr in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "127.0.0.0/8,::1/128").split(",")
+    if cidr.strip()
+]
+# Keys tracked by the in-process fallback before the least recently used are dropped
+RATE_LIMIT_FALLBACK_MAX_KEYS = int(os.getenv("RATE_LIMIT_FALLBACK_MAX_KEYS", "100000"))
+
+# Sliding-window log: one sorted set per key, scored by request time (ms).
+# All keys are checked before any is charged, so a rejected request costs nothing.
+# KEYS: limiter keys; ARGV: now ms, window ms, unique member, limit per key...
+# Returns {0, 0} when admitted, else {index of the key that is full, retry-after ms}.
+_SLIDING_WINDOW_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+  redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+  if redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+    local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    return {i, tonumber(oldest[2]) + window - now}
+  end
+end
+for _, key in ipairs(KEYS) do
+  redis.call('ZADD', key, now, ARGV[3])
+  redis.call('PEXPIRE', key, window)
+end
+return {0, 0}
+"""
+
+
+def _trusted_proxy(address: str) -> bool:
+    try:
+        ip = ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in RATE_LIMIT_TRUSTED_PROXIES)
+
+
+def client_ip(request: Request) -> str:
+    """
+    The right-most address in X-Forwarded-For + the peer that is not a
+    trusted proxy. Hops left of it were written by the client, so they can't
+    move the key; a proxy's own address (nginx, an ALB node) never is the key.
+    """
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    hops.append(request.client.host if request.client else "unknown")
+    for hop in reversed(hops):
+        if not _trusted_proxy(hop):
+            return hop
+    return hops[0]
+
+
+class TokenBuckets:
+    """
+    In-process fallback used while Redis is unreachable (per worker, so the
+    effective limit is multiplied by the worker count). Capacity = limit,
+    refilled at limit / window per second. Bounded LRU of keys.
+    """
+
+    def __init__(self, window_seconds: int, max_keys: int):
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _level(self, key: str, limit: int, now: float) -> float:
+        tokens, last = self._buckets.get(key, (float(limit), now))
+        return min(float(limit), tokens + (now - last) * limit / self.window_seconds)
+
+    def acquire(self, keys: List[str], limits: List[int]) -> Tuple[int, float]:
+        """Same contract as the Lua script: (0, 0) or (1-based index of full key, retry-after s)."""
+        now = time.monotonic()
+        with self._lock:
+            levels = [self._level(key, limit, now) for key, limit in zip(keys, limits)]
+            for i, (level, limit) in enumerate(zip(levels, limits)):
+                if level < 1:
+                    return i + 1, (1 - level) * self.window_seconds / limit
+            for key, level in zip(keys, levels):
+                self._buckets[key] = (level - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0, 0.0
+
+
+class RateLimiter:
+    """
+    Admission control for routes that pay for a bcrypt hash.
+
+    Checked before any DB query or hashing: one atomic EVALSHA per request
+    against a Redis sliding-window log (per client IP and, optionally, per
+    username). Over the limit -> 429 + Retry-After. If Redis is not
+    configured or errors, the in-process token buckets decide instead.
+    """
+
+    def __init__(self, scope: str, window_seconds: int, per_ip: int, per_username: Optional[int] = None):
+        self.scope = scope
+        self.window_seconds = window_seconds
+        self.per_ip = per_ip
+        self.per_username = per_username
+        self._fallback = TokenBuckets(window_seconds, RATE_LIMIT_FALLBACK_MAX_KEYS)
+
+        self.allowed = 0
+        self.rejected_ip = 0
+        self.rejected_username = 0
+        self.fallback_decisions = 0
+        self.redis_errors = 0
+
+    def _keys(self, ip: str, username: Optional[str]) -> Tuple[List[str], List[str], List[int]]:
+        names, keys, limits = ["ip"], [f"rl:{self.scope}:ip:{ip}"], [self.per_ip]
+        if self.per_username and username:
+            # Hashed: usernames are attacker-controlled and unbounded in length
+            digest = hashlib.blake2b(username.strip().lower().encode(), digest_size=12).hexdigest()
+            names.append("username")
+            keys.append(f"rl:{self.scope}:user:{digest}")
+            limits.append(self.per_username)
+        return names, keys, limits
+
+    async def _acquire_redis(self, rds, keys: List[str], limits: List[int]) -> Tuple[int, float]:
+        script = rds.register_script(_SLIDING_WINDOW_LUA)
+        now_ms = int(time.time() * 1000)
+        member = f"{now_ms}-{secrets.token_hex(4)}"
+        full, retry_ms = await script(keys=keys, args=[now_ms, self.window_seconds * 1000, member, *limits])
+        return int(full), int(retry_ms) / 1000
+
+    async def check(self, request: Request, username: Optional[str] = None) -> None:
+        if not RATE_LIMIT_ENABLED:
+            return
+        names, keys, limits = self._keys(client_ip(request), username)
+
+        rds = available_redis_client()
+        decision = None
+        if rds is not None:
+            try:
+                decision = await self._acquire_redis(rds, keys, limits)
+            except RedisError:
+                self.redis_errors += 1
+                logger.warning("Rate limiter: Redis unavailable, using in-process buckets", exc_info=True)
+        if decision is None:
+            self.fallback_decisions += 1
+            decision = self._fallback.acquire(keys, limits)
+
+        full, retry_after = decision
+        if not full:
+            self.allowed += 1
+            return
+        if names[full - 1] == "ip":
+            self.rejected_ip += 1
+        else:
+            self.rejected_username += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many attempts, please retry later",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+
+    def stats(self) -> dict:
+        return {
+            "enabled": RATE_LIMIT_ENABLED,
+            "window_seconds": self.window_seconds,
+            "per_ip": self.per_ip,
+            "per_username": self.per_username,
+            "allowed": self.allowed,
+            "rejected_ip": self.rejected_ip,
+            "rejected_username": self.rejected_username,
+            "fallback_decisions": self.fallback_decisions,
+            "redis_errors": self.redis_errors,
+        }
+
+
+login_limiter = RateLimiter("login", RATE_LIMIT_WINDOW_SECONDS, RATE_LIMIT_LOGIN_PER_IP, RATE_LIMIT_LOGIN_PER_USERNAME)
+# Register already rejects a taken username before hashing; the IP limit is what matters there
+register_limiter = RateLimiter("register", RATE_LIMIT_WINDOW_SECONDS, RATE_LIMIT_REGISTER_PER_IP)
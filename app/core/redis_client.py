@@ -1,22 +1,100 @@
 import os
-from functools import lru_cache
 from typing import Optional
 
 import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import MaxConnectionsError, RedisError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from app.core.circuit_breaker import CircuitBreaker
+from app.core.fork_safety import process_singleton
+from app.core.request_timing import instrument_redis
 
 """
 Redis client utilities with lazy initialization.
 
 Design goals:
 - Lazy loading: client created on first use, not at import time
-- One shared Redis client per process (singleton via lru_cache)
+- One shared Redis client per process (process_singleton: never inherited across fork)
 - Async-compatible with FastAPI lifespan
 - Safe in CI / local environments without Redis
 - Health check support via check_redis_ready()
+- Fails fast: bounded timeouts, one quick retry, and a circuit breaker that
+  refuses calls outright while Redis is down (request paths go DB-only)
 """
 
+# ===== Config =====
+REDIS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("REDIS_CONNECT_TIMEOUT_SECONDS", "0.5"))
+REDIS_SOCKET_TIMEOUT_SECONDS = float(os.getenv("REDIS_SOCKET_TIMEOUT_SECONDS", "0.5"))
+# Per worker. Beyond it calls fail at once (MaxConnectionsError) instead of queueing
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+# PING idle connections older than this before reuse (0 disables)
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+# Retries on connection errors/timeouts, a few ms apart (redis-py's default
+# backs off for seconds, which is what made an outage cost seconds per request)
+REDIS_RETRIES = int(os.getenv("REDIS_RETRIES", "1"))
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "5"))
+REDIS_BREAKER_RESET_SECONDS = float(os.getenv("REDIS_BREAKER_RESET_SECONDS", "5"))
+
+redis_breaker = CircuitBreaker("redis", REDIS_BREAKER_FAILURES, REDIS_BREAKER_RESET_SECONDS)
+
+
+class CircuitOpenError(RedisConnectionError):
+    """Raised instead of calling Redis while the breaker is open."""
+
+
+def guard_redis(client, breaker: CircuitBreaker = redis_breaker):
+    """
+    Put every command and pipeline round trip behind `breaker`.
 
-@lru_cache(maxsize=1)
+    Connection errors and timeouts count as failures. Any reply, errors
+    included, counts as success (Redis is up). A full pool is not Redis's
+    fault, so it counts as neither.
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    async def call(fn, *args, **kwargs):
+        if not breaker.allow():
+            raise CircuitOpenError(f"Redis circuit open ({breaker.state})")
+        try:
+            result = await fn(*args, **kwargs)
+        except MaxConnectionsError:
+            breaker.record_abandoned()
+            raise
+        except (RedisConnectionError, RedisTimeoutError):
+            breaker.record_failure()
+            raise
+        except RedisError:
+            breaker.record_success()
+            raise
+        except BaseException:
+            breaker.record_abandoned()
+            raise
+        breaker.record_success()
+        return result
+
+    async def guarded_execute_command(*args, **options):
+        return await call(execute_command, *args, **options)
+
+    def guarded_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def guarded_execute(*a, **kw):
+            return await call(execute, *a, **kw)
+
+        pipe.execute = guarded_execute
+        return pipe
+
+    client.execute_command = guarded_execute_command
+    client.pipeline = guarded_pipeline
+    return client
+
+
+@process_singleton
 def get_redis_client() -> Optional[redis.Redis]:
     """
     Lazily create and return the Redis client singleton.
@@ -27,7 +105,29 @@ def get_redis_client() -> Optional[redis.Redis]:
     url = os.getenv("REDIS_URL", "")
     if not url:
         return None
-    return redis.from_url(url, decode_responses=True)
+    client = redis.from_url(
+        url,
+        decode_responses=True,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS,
+        socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        retry=Retry(ExponentialBackoff(cap=0.05, base=0.005), REDIS_RETRIES),
+    )
+    # Commands count towards the request's Server-Timing `redis` entry
+    return instrument_redis(guard_redis(client))
+
+
+def available_redis_client() -> Optional[redis.Redis]:
+    """
+    The client for request paths: None when Redis is not configured *or*
+    the breaker is not closed, so callers take their no-Redis (DB-only)
+    path without waiting on a timeout. While half-open, only background
+    callers (the health monitor's PING) get to probe.
+    """
+    if not redis_breaker.is_closed():
+        return None
+    return get_redis_client()
 
 
 # Alias for backward compatibility and convenience
@@ -0,0 +1,137 @@
+# @Time: 2/19/26 20:30
+# @Author: jie
+# @File: request_timing.py
+# @Description: Per-request time spent in Postgres / Redis / bcrypt / JWT, sent as Server-Timing
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+from app.core.profiler import request_profiler
+
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+
+# Credential endpoints only ever get `total`: a `bcrypt` entry on a failed
+# login would tell an unknown username from a wrong password.
+TOTAL_ONLY_PATHS = frozenset({"/login", "/register"})
+
+# name -> [seconds, calls] for the current request; None outside a request
+# (background tasks), where record() is a no-op. Threadpool work runs in a
+# copy of the request's context, so it shares the same dict.
+_timings: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("request_timings", default=None)
+
+
+def record(name: str, seconds: float) -> None:
+    timings = _timings.get()
+    if timings is None:
+        return
+    entry = timings.get(name)
+    if entry is None:
+        timings[name] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Add the block's wall time to `name` (works around awaits too)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def server_timing_header(timings: Dict[str, List[float]], total_seconds: float) -> str:
+    """`db;dur=1.92;desc="3x", ..., total;dur=4.10` (durations in ms)."""
+    parts = [f'{name};dur={seconds * 1000:.2f};desc="{int(calls)}x"' for name, (seconds, calls) in timings.items()]
+    parts.append(f"total;dur={total_seconds * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Time every statement as `db` (async engines: pass engine.sync_engine)."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._timing_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record("db", time.perf_counter() - context._timing_start)
+
+
+def instrument_redis(client):
+    """
+    Time every command and pipeline round trip as `redis`.
+
+    Wraps the instance's execute_command / pipeline rather than subclassing,
+    so it works for whatever from_url returns (including test stand-ins).
+    Scripts and command helpers all go through execute_command.
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    async def timed_execute_command(*args, **options):
+        with timed("redis"):
+            return await execute_command(*args, **options)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def timed_execute(*a, **kw):
+            with timed("redis"):
+                return await execute(*a, **kw)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    return client
+
+
+class ServerTimingMiddleware:
+    """
+    Pure ASGI middleware: collects the request's timings and adds a
+    Server-Timing header (browser devtools and curl -v show it).
+
+    Also the hook for the opt-in sampling profiler (app.core.profiler).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (SERVER_TIMING_ENABLED or request_profiler.enabled):
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, List[float]] = {}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        profile = request_profiler.begin()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and SERVER_TIMING_ENABLED:
+                entries = {} if scope["path"] in TOTAL_ONLY_PATHS else timings
+                MutableHeaders(scope=message).append(
+                    "Server-Timing", server_timing_header(entries, time.perf_counter() - start)
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timings.reset(token)
+            if profile is not None:
+                route = scope.get("route")
+                label = f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+                request_profiler.end(profile, label, time.perf_counter() - start)
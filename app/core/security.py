@@ -2,13 +2,263 @@
 # @Author: jie
 # @File: security.py
 # @Description:
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional, Tuple
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from app.core.fork_safety import ForkSafetyError
+from app.core.request_timing import timed
+
+# uvicorn configures this logger; app.* loggers are not configured at INFO
+logger = logging.getLogger("uvicorn.error")
+
+# ===== bcrypt cost config =====
+# Fixed cost; 0 = passlib's default (12) unless calibrated
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "0"))
+# > 0 (and no BCRYPT_ROUNDS): benchmark this host at startup and use the
+# highest rounds whose verify fits in this many ms
+BCRYPT_TARGET_MS = float(os.getenv("BCRYPT_TARGET_MS", "0"))
+BCRYPT_MIN_ROUNDS = int(os.getenv("BCRYPT_MIN_ROUNDS", "10"))
+BCRYPT_MAX_ROUNDS = int(os.getenv("BCRYPT_MAX_ROUNDS", "14"))
+
+_CALIBRATION_PASSWORD = "bcrypt-calibration"
+
+
+@functools.lru_cache(maxsize=None)
+def crypt_context(rounds: int = 0) -> CryptContext:
+    """
+    bcrypt context hashing at `rounds` (0: passlib's default).
+
+    Hashes outside [rounds, rounds + 1] need an update. The one round of
+    slack keeps hosts that calibrate one apart from rehashing each other's
+    hashes on every login.
+    """
+    if not rounds:
+        return CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds + 1,
+    )
+
+
+pwd_context = crypt_context(BCRYPT_ROUNDS)
+
+# ===== Password engine config =====
+# Workers default to the cores available to this uvicorn worker (cores split
+# across WEB_CONCURRENCY workers); the queue limit bounds how many
+# hash/verify jobs may wait behind them before we start shedding load.
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+PASSWORD_POOL_MAX_QUEUE = int(os.getenv("PASSWORD_POOL_MAX_QUEUE", str(PASSWORD_POOL_WORKERS * 4)))
+PASSWORD_POOL_RETRY_AFTER = int(os.getenv("PASSWORD_POOL_RETRY_AFTER", "1"))
+
+
+def _hash_in_worker(password: str, rounds: int = 0) -> str:
+    return crypt_context(rounds).hash(password)
+
+
+def _verify_in_worker(password: str, password_hash: str) -> bool:
+    return pwd_context.verify(password, password_hash)
+
+
+def calibrate_bcrypt_rounds(target_ms: float, min_rounds: int, max_rounds: int, samples: int = 3) -> Tuple[int, float]:
+    """
+    Highest rounds in [min_rounds, max_rounds] whose verify fits in target_ms
+    on this host, and the predicted verify ms at that cost.
+
+    Times the best of `samples` verifies at min_rounds and extrapolates:
+    each extra round doubles bcrypt's work. Runs in a pool worker, so it
+    measures the process that will do the hashing.
+    """
+    context = crypt_context(min_rounds)
+    password_hash = context.hash(_CALIBRATION_PASSWORD)
+    best = float("inf")
+    for _ in range(samples):
+        start = time.perf_counter()
+        context.verify(_CALIBRATION_PASSWORD, password_hash)
+        best = min(best, time.perf_counter() - start)
+    base_ms = best * 1000
+    rounds = min_rounds
+    while rounds < max_rounds and base_ms * 2 ** (rounds + 1 - min_rounds) <= target_ms:
+        rounds += 1
+    return rounds, round(base_ms * 2 ** (rounds - min_rounds), 1)
+
+
+class PasswordEngine:
+    """
+    Runs bcrypt on a bounded process pool so it never blocks the event loop.
+
+    - The pool is created lazily on first use (one per process)
+    - At most `workers + max_queue` jobs are accepted at once; beyond that
+      callers get 503 + Retry-After instead of queueing unboundedly
+    - `pending` is only touched from the event loop, so no lock is needed
+    """
+
+    def __init__(self, workers: int, max_queue: int, retry_after: int, rounds: int = 0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.rounds = rounds
+        self.calibrated_verify_ms: Optional[float] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.verify_count = 0
+        self.verify_seconds_total = 0.0
+        self.verify_seconds_max = 0.0
+        self.rehashes = 0
+        self.rehash_skipped = 0
+        self.rehash_failures = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is not None and self._executor_pid != os.getpid():
+            raise ForkSafetyError(
+                f"Password pool was started in pid {self._executor_pid} and used in pid {os.getpid()}"
+            )
+        if self._executor is None:
+            # spawn: workers must not inherit the parent's event loop, sockets or pools
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _busy(self) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Password service busy, please retry",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise self._busy()
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with timed("bcrypt"):
+                result = await loop.run_in_executor(self._get_executor(), fn, *args)
+            self.completed += 1
+            return result
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM killed); start a fresh pool on next call
+            self._executor = None
+            raise self._busy()
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self.run(_hash_in_worker, password, self.rounds)
+
+    def needs_update(self, password_hash: str) -> bool:
+        """Parses the hash string only (no bcrypt work): cheap on the event loop."""
+        return crypt_context(self.rounds).needs_update(password_hash)
+
+    def has_spare_capacity(self) -> bool:
+        """Background work (rehashing) only runs when no request would wait behind it."""
+        return self.pending < self.workers
+
+    async def calibrate(self, target_ms: float, min_rounds: int, max_rounds: int) -> int:
+        """Benchmark a pool worker and hash with the resulting rounds from now on."""
+        self.rounds, self.calibrated_verify_ms = await self.run(
+            calibrate_bcrypt_rounds, target_ms, min_rounds, max_rounds
+        )
+        return self.rounds
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        start = time.perf_counter()
+        try:
+            return await self.run(_verify_in_worker, password, password_hash)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.verify_count += 1
+            self.verify_seconds_total += elapsed
+            self.verify_seconds_max = max(self.verify_seconds_max, elapsed)
+
+    def stats(self) -> dict:
+        in_flight = min(self.pending, self.workers)
+        avg = self.verify_seconds_total / self.verify_count if self.verify_count else 0.0
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self.pending - in_flight,
+            "in_flight": in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "verify_count": self.verify_count,
+            "verify_avg_ms": round(avg * 1000, 2),
+            "verify_max_ms": round(self.verify_seconds_max * 1000, 2),
+            "bcrypt_rounds": self.rounds or None,
+            "calibrated_verify_ms": self.calibrated_verify_ms,
+            "rehashes": self.rehashes,
+            "rehash_skipped": self.rehash_skipped,
+            "rehash_failures": self.rehash_failures,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_engine = PasswordEngine(
+    PASSWORD_POOL_WORKERS, PASSWORD_POOL_MAX_QUEUE, PASSWORD_POOL_RETRY_AFTER, BCRYPT_ROUNDS
+)
+
+
+async def calibrate_from_config() -> None:
+    """Startup hook: calibrate when BCRYPT_TARGET_MS is set and BCRYPT_ROUNDS is not."""
+    if BCRYPT_TARGET_MS <= 0 or BCRYPT_ROUNDS:
+        return
+    rounds = await password_engine.calibrate(BCRYPT_TARGET_MS, BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS)
+    logger.info(
+        "bcrypt calibrated: %d rounds (~%.0f ms per verify, target %.0f ms)",
+        rounds, password_engine.calibrated_verify_ms, BCRYPT_TARGET_MS,
+    )
+
+
 class PasswordService:
     @staticmethod
     def hash_password(password: str) -> str:
-        return pwd_context.hash(password)
+        return crypt_context(password_engine.rounds).hash(password)
+
     @staticmethod
     def verify_password(password: str, password_hash: str) -> bool:
-        return pwd_context.verify(password, password_hash)
\ No newline at end of file
+        return pwd_context.verify(password, password_hash)
+
+    @staticmethod
+    async def hash_password_async(password: str) -> str:
+        """Hash on the process pool. Raises HTTP 503 when the pool is saturated."""
+        return await password_engine.hash(password)
+
+    @staticmethod
+    async def verify_password_async(password: str, password_hash: str) -> bool:
+        """Verify on the process pool. Raises HTTP 503 when the pool is saturated."""
+        return await password_engine.verify(password, password_hash)
+
+    @staticmethod
+    def needs_rehash(password_hash: str) -> bool:
+        """True if the hash's cost no longer matches the configured / calibrated rounds."""
+        return password_engine.needs_update(password_hash)
+
+    @staticmethod
+    def stats() -> dict:
+        return password_engine.stats()
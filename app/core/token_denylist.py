@@ -0,0 +1,289 @@
+# @Time: 2/16/26 20:30
+# @Author: jie
+# @File: token_denylist.py
+# @Description: Access-token revocation: Redis denylist + per-worker bloom filter
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import HTTPException, status
+from redis.exceptions import RedisError
+
+from app.core.redis_client import get_redis_client, redis_breaker
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+# Revocations the filter is sized for (roughly: logouts per access-token lifetime)
+JWT_DENYLIST_BLOOM_CAPACITY = int(os.getenv("JWT_DENYLIST_BLOOM_CAPACITY", "100000"))
+# Target false-positive rate at capacity; a false positive costs one ZSCORE
+JWT_DENYLIST_BLOOM_FP_RATE = float(os.getenv("JWT_DENYLIST_BLOOM_FP_RATE", "0.001"))
+# Bloom filters can't forget: rebuilt from Redis this often to drop expired jtis
+# (and to pick up anything missed while the subscriber was disconnected)
+JWT_DENYLIST_REBUILD_SECONDS = float(os.getenv("JWT_DENYLIST_REBUILD_SECONDS", "300"))
+
+# Sorted set of revoked jtis, scored by the token's exp (epoch seconds)
+DENYLIST_KEY = "jwt:denylist"
+# Every worker's filter subscribes here; the message is the revoked jti
+DENYLIST_CHANNEL = "jwt:denylist:events"
+
+_RESUBSCRIBE_DELAY_SECONDS = 1.0
+
+
+class BloomFilter:
+    """
+    Fixed-size bloom filter over strings.
+
+    m = -n ln p / (ln 2)^2 bits and k = m/n ln 2 hashes for n items at
+    false-positive rate p. The k bit positions come from one 16-byte BLAKE2b
+    digest by double hashing (h1 + i*h2), so a lookup is one hash call.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = max(1, capacity)
+        self.fp_rate = fp_rate
+        self.num_bits = max(8, int(math.ceil(-self.capacity * math.log(fp_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / self.capacity * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item: str) -> None:
+        """Set the item's bits. count only grows if one was unset (re-adds are free)."""
+        new = False
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not self._bits[pos >> 3] & mask:
+                self._bits[pos >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def estimated_fp_rate(self) -> float:
+        """(1 - e^(-kn/m))^k for the items added so far."""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class TokenDenylist:
+    """
+    Revoked access-token jtis.
+
+    - Source of truth: Redis sorted set DENYLIST_KEY (jti -> exp). Without
+      Redis, an in-process dict (single-worker dev setups)
+    - Every worker keeps a bloom filter of that set, fed by pub/sub on
+      DENYLIST_CHANNEL and rebuilt every JWT_DENYLIST_REBUILD_SECONDS
+
+    is_revoked() is a memory-only bloom lookup for almost every token; only
+    a bloom positive (revoked, or a false positive) costs a ZSCORE.
+
+    Redis down: a logout is still denied on the worker that handled it
+    (_local), and published to the others once the breaker closes.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float, rebuild_seconds: float):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.rebuild_seconds = rebuild_seconds
+        self._bloom = BloomFilter(capacity, fp_rate)
+        self._local: Dict[str, float] = {}
+        # Revoked while Redis was down: in _local, not yet in Redis
+        self._unpublished: Dict[str, float] = {}
+        self._publish_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.checks = 0
+        self.bloom_positives = 0
+        self.revoked_hits = 0
+        self.false_positives = 0
+        self.revocations = 0
+        self.pubsub_messages = 0
+        self.rebuilds = 0
+        self.redis_errors = 0
+
+    def start(self) -> None:
+        if self._task is None and get_redis_client() is not None:
+            self._task = asyncio.create_task(self._run(), name="token-denylist")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _schedule_publish(self) -> None:
+        if self._unpublished and (self._publish_task is None or self._publish_task.done()):
+            self._publish_task = asyncio.create_task(self.publish_pending(), name="token-denylist-publish")
+
+    async def revoke(self, jti: str, exp: float) -> None:
+        """Deny `jti` until `exp`; every worker's filter learns it via pub/sub."""
+        if exp <= time.time():
+            return
+        self.revocations += 1
+        self._bloom.add(jti)
+        rds = get_redis_client()
+        if rds is not None:
+            try:
+                await self._publish({jti: exp})
+                return
+            except RedisError:
+                # Denied by this worker right away; the others learn it on recovery
+                self.redis_errors += 1
+                logger.warning("Token denylist: Redis unavailable, revocation kept locally", exc_info=True)
+                self._unpublished[jti] = exp
+        self._local[jti] = exp
+        if len(self._local) > self.capacity:
+            self._prune_local()
+
+    async def _publish(self, entries: Dict[str, float]) -> None:
+        rds = get_redis_client()
+        async with rds.pipeline(transaction=True) as pipe:
+            pipe.zadd(DENYLIST_KEY, entries)
+            for jti in entries:
+                pipe.publish(DENYLIST_CHANNEL, jti)
+            await pipe.execute()
+
+    async def publish_pending(self) -> None:
+        """Push revocations made while Redis was down (runs when the breaker closes)."""
+        if not self._unpublished:
+            return
+        now = time.time()
+        pending = {jti: exp for jti, exp in self._unpublished.items() if exp > now}
+        self._unpublished = {}
+        if not pending:
+            return
+        try:
+            await self._publish(pending)
+        except RedisError:
+            self.redis_errors += 1
+            logger.warning("Token denylist: publishing pending revocations failed; will retry", exc_info=True)
+            self._unpublished.update(pending)
+
+    async def is_revoked(self, jti: str) -> bool:
+        self.checks += 1
+        if jti not in self._bloom:
+            return False
+        self.bloom_positives += 1
+
+        rds = get_redis_client()
+        exp = self._local.get(jti)
+        if exp is None and rds is not None:
+            try:
+                exp = await rds.zscore(DENYLIST_KEY, jti)
+            except RedisError:
+                self.redis_errors += 1
+                logger.warning("Token denylist: Redis unavailable on a bloom positive", exc_info=True)
+                # Can't tell a revoked token from a false positive: fail closed, but retryable
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Token revocation status unavailable",
+                )
+        revoked = exp is not None and exp > time.time()
+        if revoked:
+            self.revoked_hits += 1
+        else:
+            self.false_positives += 1
+        return revoked
+
+    def _replace_bloom(self, jtis: List[str]) -> None:
+        bloom = BloomFilter(self.capacity, self.fp_rate)
+        for jti in jtis:
+            bloom.add(jti)
+        self._bloom = bloom
+        self.rebuilds += 1
+
+    def _prune_local(self) -> None:
+        now = time.time()
+        self._local = {jti: exp for jti, exp in self._local.items() if exp > now}
+        if get_redis_client() is None:
+            self._replace_bloom(list(self._local))
+
+    async def rebuild(self) -> None:
+        """Drop expired entries and rebuild the filter from what is still denied."""
+        rds = get_redis_client()
+        if rds is None:
+            self._prune_local()
+            return
+        now = time.time()
+        async with rds.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(DENYLIST_KEY, "-inf", now)
+            pipe.zrange(DENYLIST_KEY, 0, -1)
+            _, jtis = await pipe.execute()
+        self._local = {jti: exp for jti, exp in self._local.items() if exp > now}
+        self._replace_bloom([*jtis, *self._local])
+
+    async def _listen(self, rds) -> None:
+        async with rds.pubsub() as pubsub:
+            await pubsub.subscribe(DENYLIST_CHANNEL)
+            # Rebuilt after subscribing, so no revocation falls in between.
+            # Messages queued during a rebuild are applied to the new filter.
+            await self.rebuild()
+            next_rebuild = time.monotonic() + self.rebuild_seconds
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None and message["type"] == "message":
+                    self.pubsub_messages += 1
+                    self._bloom.add(message["data"])
+                if self.rebuild_seconds > 0 and time.monotonic() >= next_rebuild:
+                    await self.rebuild()
+                    next_rebuild = time.monotonic() + self.rebuild_seconds
+
+    async def _run(self) -> None:
+        while True:
+            if not redis_breaker.is_closed():
+                # Redis is down; the health monitor's PING probes it
+                await asyncio.sleep(_RESUBSCRIBE_DELAY_SECONDS)
+                continue
+            rds = get_redis_client()
+            try:
+                await self._listen(rds)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.redis_errors += 1
+                logger.exception("Token denylist subscriber failed, resubscribing")
+            await asyncio.sleep(_RESUBSCRIBE_DELAY_SECONDS)
+
+    def stats(self) -> dict:
+        bloom = self._bloom
+        negatives = self.checks - self.revoked_hits
+        return {
+            "bloom_capacity": bloom.capacity,
+            "bloom_target_fp_rate": bloom.fp_rate,
+            "bloom_bits": bloom.num_bits,
+            "bloom_hashes": bloom.num_hashes,
+            "bloom_items": bloom.count,
+            "bloom_estimated_fp_rate": round(bloom.estimated_fp_rate(), 6),
+            "checks": self.checks,
+            "bloom_positives": self.bloom_positives,
+            "revoked_hits": self.revoked_hits,
+            "false_positives": self.false_positives,
+            # Share of non-revoked tokens that still paid for a Redis lookup
+            "observed_fp_rate": round(self.false_positives / negatives, 6) if negatives else 0.0,
+            "revocations": self.revocations,
+            "pubsub_messages": self.pubsub_messages,
+            "rebuilds": self.rebuilds,
+            "redis_errors": self.redis_errors,
+            "unpublished": len(self._unpublished),
+            "subscribed": self._task is not None,
+        }
+
+
+token_denylist = TokenDenylist(JWT_DENYLIST_BLOOM_CAPACITY, JWT_DENYLIST_BLOOM_FP_RATE, JWT_DENYLIST_REBUILD_SECONDS)
+redis_breaker.on_close(token_denylist._schedule_publish)
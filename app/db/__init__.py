@@ -2,6 +2,38 @@
 # @Author: jie
 # @File: __init__.py
 # @Description:
-from .database import Base, get_engine, get_session_local, get_db, check_database_ready
+from .database import (
+    Base,
+    DbSession,
+    check_database_ready,
+    check_database_ready_async,
+    db_session_scope,
+    dispose_engines,
+    get_async_db,
+    get_async_engine,
+    get_async_session_local,
+    get_db,
+    get_db_session,
+    get_engine,
+    get_session_local,
+    insert_ignore,
+    pool_metrics,
+)
 
-__all__ = ["Base", "get_engine", "get_session_local", "get_db", "check_database_ready"]
\ No newline at end of file
+__all__ = [
+    "Base",
+    "DbSession",
+    "get_engine",
+    "get_session_local",
+    "get_db",
+    "get_async_engine",
+    "get_async_session_local",
+    "get_async_db",
+    "get_db_session",
+    "db_session_scope",
+    "insert_ignore",
+    "check_database_ready",
+    "check_database_ready_async",
+    "pool_metrics",
+    "dispose_engines",
+]
\ No newline at end of file
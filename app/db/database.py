@@ -3,12 +3,35 @@
 # @File: database.py
 # @Description: Database utilities with lazy initialization
 import os
-from functools import lru_cache
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Any, List, Optional, Union
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from sqlalchemy.engine import Engine
+from sqlalchemy import Insert, Table, create_engine, insert, text
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from app.core.fork_safety import process_singleton
+from app.core.request_timing import instrument_engine
+
+from .pool import pool_kwargs, pool_status
+from .replicas import PRIMARY_PIN_COOKIE, AsyncRoutingSession, RoutingSession, get_replica_set, pin_primary
+
+# "true": auth routes use the native async engine (AsyncSession)
+# "false": auth routes use the sync engine, with each call pushed to the threadpool
+# Both paths expose the same awaitable API so throughput can be compared per deployment.
+DB_ASYNC_MODE = os.getenv("DB_ASYNC_MODE", "true").lower() == "true"
+
+# Sync driver -> async driver for create_async_engine
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+psycopg",
+    "postgresql+psycopg": "postgresql+psycopg",
+    "postgresql+psycopg2": "postgresql+psycopg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
 
 
 class Base(DeclarativeBase):
@@ -16,7 +39,7 @@ class Base(DeclarativeBase):
     pass
 
 
-@lru_cache(maxsize=1)
+@process_singleton
 def get_engine() -> Optional[Engine]:
     """
     Lazily create and return the SQLAlchemy engine singleton.
@@ -27,20 +50,23 @@ def get_engine() -> Optional[Engine]:
     url = os.getenv("DATABASE_URL", "")
     if not url:
         return None
-    return create_engine(url)
+    engine = create_engine(url, **pool_kwargs(url, is_async=False))
+    instrument_engine(engine)
+    return engine
 
 
-@lru_cache(maxsize=1)
+@process_singleton
 def get_session_local() -> Optional[sessionmaker]:
     """
     Lazily create and return the session factory singleton.
 
+    Sessions route plain SELECTs to DATABASE_REPLICA_URLS (app.db.replicas).
     Returns None if DATABASE_URL is not configured.
     """
     engine = get_engine()
     if engine is None:
         return None
-    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    return sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine)
 
 
 def get_db():
@@ -59,6 +85,151 @@ def get_db():
         db.close()
 
 
+def _to_async_url(url: str) -> str:
+    parsed = make_url(url)
+    driver = _ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+@process_singleton
+def get_async_engine() -> Optional[AsyncEngine]:
+    """
+    Lazily create and return the async SQLAlchemy engine singleton.
+
+    Uses the same DATABASE_URL as get_engine(); psycopg 3 serves both the
+    sync and the async dialect, so no second driver is needed for Postgres.
+    Returns None if DATABASE_URL is not configured.
+    """
+    url = os.getenv("DATABASE_URL", "")
+    if not url:
+        return None
+    async_url = _to_async_url(url)
+    engine = create_async_engine(async_url, **pool_kwargs(async_url, is_async=True))
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+@process_singleton
+def get_async_session_local() -> Optional[async_sessionmaker]:
+    """
+    Lazily create and return the async session factory singleton.
+
+    expire_on_commit=False: attributes stay readable after commit without
+    an implicit (and, in async, illegal) lazy reload.
+    """
+    engine = get_async_engine()
+    if engine is None:
+        return None
+    return async_sessionmaker(
+        bind=engine, sync_session_class=AsyncRoutingSession, autoflush=False, expire_on_commit=False
+    )
+
+
+async def get_async_db():
+    """
+    FastAPI dependency: yield an AsyncSession.
+
+    Raises RuntimeError if DATABASE_URL is not configured.
+    """
+    session_local = get_async_session_local()
+    if session_local is None:
+        raise RuntimeError("Database not configured: DATABASE_URL is empty")
+    async with session_local() as db:
+        yield db
+
+
+class ThreadedSession:
+    """
+    Awaitable facade over a sync Session.
+
+    Every blocking call runs in the threadpool, so the event loop is never
+    blocked. Only the subset of the AsyncSession API used by the routes is
+    mirrored here.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    @property
+    def info(self) -> dict:
+        return self.sync_session.info
+
+    def add(self, instance: Any) -> None:
+        self.sync_session.add(instance)
+
+    def get_bind(self) -> Any:
+        return self.sync_session.get_bind()
+
+    async def execute(self, statement: Any, params: Any = None) -> Any:
+        return await run_in_threadpool(self.sync_session.execute, statement, params)
+
+    async def scalar(self, statement: Any, params: Any = None) -> Any:
+        return await run_in_threadpool(self.sync_session.scalar, statement, params)
+
+    async def flush(self) -> None:
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self) -> None:
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self) -> None:
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, instance: Any) -> None:
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def close(self) -> None:
+        await run_in_threadpool(self.sync_session.close)
+
+
+DbSession = Union[AsyncSession, ThreadedSession]
+
+
+async def _open_db_session(primary_only: bool):
+    if DB_ASYNC_MODE:
+        session_local = get_async_session_local()
+        if session_local is None:
+            raise RuntimeError("Database not configured: DATABASE_URL is empty")
+        async with session_local() as db:
+            if primary_only:
+                pin_primary(db)
+            yield db
+        return
+
+    session_local = get_session_local()
+    if session_local is None:
+        raise RuntimeError("Database not configured: DATABASE_URL is empty")
+    db = ThreadedSession(session_local(expire_on_commit=False))
+    if primary_only:
+        pin_primary(db)
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_db_session(request: Request):
+    """
+    FastAPI dependency used by the auth routes.
+
+    Yields an AsyncSession when DB_ASYNC_MODE is on, otherwise a
+    ThreadedSession wrapping the sync engine. Reads may go to a replica,
+    unless the client wrote a moment ago (PRIMARY_PIN_COOKIE).
+    """
+    primary_only = PRIMARY_PIN_COOKIE in request.cookies
+    if primary_only:
+        get_replica_set().pinned_sessions += 1
+    async for db in _open_db_session(primary_only):
+        yield db
+
+
+@asynccontextmanager
+async def db_session_scope():
+    """Same session selection as get_db_session, for background tasks: primary only."""
+    async for db in _open_db_session(primary_only=True):
+        yield db
+
+
 def check_database_ready() -> dict:
     """
     Check database connectivity for /ready endpoint.
@@ -79,6 +250,70 @@ def check_database_ready() -> dict:
         return {"database": f"error: {str(e)}"}
 
 
+def insert_ignore(table: Table, dialect_name: str, conflict_columns: List[str]) -> Insert:
+    """
+    INSERT ... ON CONFLICT (conflict_columns) DO NOTHING on PostgreSQL/SQLite.
+
+    Other dialects get a plain INSERT; callers must treat IntegrityError as
+    the conflict there.
+    """
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+        return pg_insert(table).on_conflict_do_nothing(index_elements=conflict_columns)
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+        return sqlite_insert(table).on_conflict_do_nothing(index_elements=conflict_columns)
+    return insert(table)
+
+
+async def check_database_ready_async() -> dict:
+    """
+    Same contract as check_database_ready, without blocking the event loop.
+
+    Probes the engine the routes actually use (per DB_ASYNC_MODE); exceptions
+    propagate so the caller can time and classify them.
+    """
+    if not DB_ASYNC_MODE:
+        return await run_in_threadpool(check_database_ready)
+    engine = get_async_engine()
+    if engine is None:
+        return {"database": "not_configured"}
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    return {"database": "ok"}
+
+
+def pool_metrics() -> dict:
+    """
+    Live connection-pool stats for /metrics.
+
+    Only engines that were already created are reported; this never
+    instantiates an engine just to look at it.
+    """
+    result = {}
+    if get_engine.cache_info().currsize and get_engine() is not None:
+        result["sync"] = pool_status(get_engine().pool, "sync")
+    if get_async_engine.cache_info().currsize and get_async_engine() is not None:
+        result["async"] = pool_status(get_async_engine().sync_engine.pool, "async")
+    return result
+
+
+async def dispose_engines() -> None:
+    """
+    Close all pooled connections at application shutdown.
+
+    Safe to call even if no engine was ever created.
+    """
+    if get_async_engine.cache_info().currsize and get_async_engine() is not None:
+        await get_async_engine().dispose()
+    if get_engine.cache_info().currsize and get_engine() is not None:
+        get_engine().dispose()
+    if get_replica_set.cache_info().currsize:
+        await get_replica_set().dispose()
+
+
 # Backward compatibility aliases
 engine = None  # Deprecated: use get_engine()
 SessionLocal = None  # Deprecated: use get_session_local()
\ No newline at end of file
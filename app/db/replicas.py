@@ -0,0 +1,259 @@
+# @Time: 2/22/26 20:30
+# @Author: jie
+# @File: replicas.py
+# @Description: Optional read replicas: health/lag-aware round-robin and a routing Session
+import asyncio
+import functools
+import itertools
+import os
+from typing import Any, List, Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select, visitors
+from sqlalchemy.sql.dml import UpdateBase
+from starlette.concurrency import run_in_threadpool
+
+from app.core.fork_safety import process_singleton
+from app.core.request_timing import instrument_engine
+
+from .pool import pool_kwargs
+
+# ===== Config =====
+# Comma-separated read replicas of DATABASE_URL (empty: everything goes to the primary)
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+# A replica further behind than this, or failing its probe, gets no reads until the next good probe
+DATABASE_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DATABASE_REPLICA_MAX_LAG_SECONDS", "2"))
+# After register / refresh the client reads from the primary for this long (cookie)
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv("DATABASE_REPLICA_PIN_SECONDS", "5"))
+
+PRIMARY_PIN_COOKIE = "db_primary"
+
+# Session.info keys
+_PINNED = "primary_pinned"
+_READ_REPLICA = "read_replica"
+
+# 0 when caught up (an idle primary sends no transactions, so the replay
+# timestamp alone would look like growing lag)
+_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class Replica:
+    """One replica URL, its lazily built engines and its last probe result."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True  # until the first probe says otherwise
+        self.lag_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.reads = 0
+        self.disconnects = 0
+
+    def _watch(self, engine: Engine) -> None:
+        instrument_engine(engine)
+
+        @event.listens_for(engine, "handle_error")
+        def _on_error(context):
+            # Out of rotation at once; the next probe decides when it is back
+            if context.is_disconnect:
+                self.disconnects += 1
+                self.healthy = False
+
+    @functools.cached_property
+    def sync_engine(self) -> Engine:
+        engine = create_engine(self.url, **pool_kwargs(self.url, is_async=False))
+        self._watch(engine)
+        return engine
+
+    @functools.cached_property
+    def async_engine(self) -> AsyncEngine:
+        from app.db.database import _to_async_url
+
+        async_url = _to_async_url(self.url)
+        engine = create_async_engine(async_url, **pool_kwargs(async_url, is_async=True))
+        self._watch(engine.sync_engine)
+        return engine
+
+    def _lag_statement(self, dialect_name: str):
+        return _LAG_SQL if dialect_name == "postgresql" else text("SELECT 0")
+
+    async def probe(self, is_async: bool) -> None:
+        try:
+            if is_async:
+                async with self.async_engine.connect() as conn:
+                    lag = await conn.scalar(self._lag_statement(conn.dialect.name))
+            else:
+
+                def _probe():
+                    with self.sync_engine.connect() as conn:
+                        return conn.scalar(self._lag_statement(conn.dialect.name))
+
+                lag = await run_in_threadpool(_probe)
+        except Exception as e:
+            self.healthy, self.lag_seconds, self.last_error = False, None, str(e)
+            return
+        self.lag_seconds = round(float(lag), 3)
+        self.healthy = self.lag_seconds <= DATABASE_REPLICA_MAX_LAG_SECONDS
+        self.last_error = None if self.healthy else f"lag {self.lag_seconds}s"
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "lag_seconds": self.lag_seconds,
+            "last_error": self.last_error,
+            "reads": self.reads,
+            "disconnects": self.disconnects,
+        }
+
+    async def dispose(self) -> None:
+        if "async_engine" in self.__dict__:
+            await self.async_engine.dispose()
+        if "sync_engine" in self.__dict__:
+            self.sync_engine.dispose()
+
+
+class ReplicaSet:
+    """
+    Round-robin over the replicas whose last probe was healthy. With none
+    healthy (or none configured), reads go to the primary.
+
+    Probed by the health monitor (check_replicas_ready), so a lagging or
+    dead replica leaves the rotation within HEALTH_CHECK_INTERVAL_SECONDS;
+    a dropped connection takes it out immediately.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.replicas = [Replica(url) for url in urls]
+        self._counter = itertools.count()
+
+        self.primary_reads = 0  # reads that were eligible but found no healthy replica
+        self.primary_rereads = 0  # replica misses re-read on the primary
+        self.pinned_sessions = 0
+
+    def pick(self) -> Optional[Replica]:
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            self.primary_reads += 1
+            return None
+        replica = healthy[next(self._counter) % len(healthy)]
+        replica.reads += 1
+        return replica
+
+    async def probe(self, is_async: bool) -> None:
+        await asyncio.gather(*(r.probe(is_async) for r in self.replicas))
+
+    def stats(self) -> dict:
+        return {
+            "replicas": {f"replica{i}": r.stats() for i, r in enumerate(self.replicas)},
+            "max_lag_seconds": DATABASE_REPLICA_MAX_LAG_SECONDS,
+            "primary_reads": self.primary_reads,
+            "primary_rereads": self.primary_rereads,
+            "pinned_sessions": self.pinned_sessions,
+        }
+
+    async def dispose(self) -> None:
+        for replica in self.replicas:
+            await replica.dispose()
+
+
+@process_singleton
+def get_replica_set() -> ReplicaSet:
+    return ReplicaSet(DATABASE_REPLICA_URLS)
+
+
+def _read_only(clause: Any) -> bool:
+    """A plain SELECT: no FOR UPDATE, no INSERT/UPDATE/DELETE (e.g. in a CTE)."""
+    if not isinstance(clause, Select) or clause._for_update_arg is not None:
+        return False
+    return not any(isinstance(element, UpdateBase) for element in visitors.iterate(clause))
+
+
+class RoutingSession(Session):
+    """
+    Session that sends read-only statements to a replica.
+
+    Primary: flushes, DML (also inside CTEs), SELECT ... FOR UPDATE, text(),
+    and every statement after the session's first write or pin_primary(),
+    so a request always reads its own writes. Each session talks to at most
+    one replica at a time, so its reads are one consistent snapshot.
+    """
+
+    is_async = False
+
+    def get_bind(self, mapper=None, *, clause=None, **kw):
+        primary = super().get_bind(mapper, clause=clause, **kw)
+        if clause is None or self._flushing or self.info.get(_PINNED) or not DATABASE_REPLICA_URLS:
+            return primary
+        if not _read_only(clause):
+            self.info[_PINNED] = True
+            return primary
+        replica = self.info.get(_READ_REPLICA) or get_replica_set().pick()
+        if replica is None:
+            return primary
+        self.info[_READ_REPLICA] = replica
+        return replica.async_engine.sync_engine if self.is_async else replica.sync_engine
+
+
+class AsyncRoutingSession(RoutingSession):
+    """sync_session_class of the AsyncSession: routes to the replicas' async engines."""
+
+    is_async = True
+
+
+def pin_primary(db: Any) -> bool:
+    """
+    Send the rest of this session's statements to the primary.
+
+    Returns True if the session had read from a replica, i.e. a re-read on
+    the primary could return something newer.
+    """
+    db.info[_PINNED] = True
+    return db.info.pop(_READ_REPLICA, None) is not None
+
+
+async def scalar_or_primary(db: Any, statement: Any) -> Any:
+    """
+    scalar_one_or_none() of a read; a miss served by a replica is re-read on
+    the primary, which may just be ahead (a user registered a moment ago).
+    """
+    value = (await db.execute(statement)).scalar_one_or_none()
+    if value is None and pin_primary(db):
+        get_replica_set().primary_rereads += 1
+        # The replica's read transaction is done with; the re-read starts on the primary
+        await db.commit()
+        value = (await db.execute(statement)).scalar_one_or_none()
+    return value
+
+
+def pin_primary_reads(response: Any) -> None:
+    """After a write: this client reads from the primary until replicas have surely caught up."""
+    if not DATABASE_REPLICA_URLS:
+        return
+    response.set_cookie(
+        PRIMARY_PIN_COOKIE,
+        "1",
+        max_age=DATABASE_REPLICA_PIN_SECONDS,
+        httponly=True,
+        samesite="lax",
+        path="/",
+    )
+
+
+async def check_replicas_ready() -> dict:
+    """
+    Probe every replica's health and lag (health monitor). Replicas are
+    never required: without a healthy one, reads use the primary.
+    """
+    if not DATABASE_REPLICA_URLS:
+        return {"replicas": "not_configured"}
+    from app.db.database import DB_ASYNC_MODE
+
+    replica_set = get_replica_set()
+    await replica_set.probe(DB_ASYNC_MODE)
+    down = [f"replica{i}: {r.last_error}" for i, r in enumerate(replica_set.replicas) if not r.healthy]
+    return {"replicas": "ok" if not down else "error: " + "; ".join(down)}
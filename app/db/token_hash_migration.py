@@ -0,0 +1,172 @@
+# @Time: 2/21/26 20:30
+# @Author: jie
+# @File: token_hash_migration.py
+# @Description: Online migration of sessions.token_hash (hex text) to token_digest (BYTEA)
+"""
+Online migration of refresh-token hashes from 64-char hex (sessions.token_hash)
+to the raw 32-byte digest (sessions.token_digest). PostgreSQL only; no step
+holds more than a brief lock, and each is safe to re-run.
+
+    python -m app.db.token_hash_migration prepare    # add column + unique index (CONCURRENTLY)
+    # deploy TOKEN_HASH_STORAGE=hex+binary           (new rows get both columns)
+    python -m app.db.token_hash_migration backfill   # fill token_digest for older rows, in batches
+    python -m app.db.token_hash_migration verify     # 0 rows missing / mismatched
+    # deploy TOKEN_HASH_STORAGE=binary+hex           (lookups and Redis keys go binary)
+    # deploy TOKEN_HASH_STORAGE=binary               (token_hash no longer written)
+    python -m app.db.token_hash_migration finalize   # token_digest NOT NULL, drop token_hash, reindex
+    python -m app.db.token_hash_migration report     # sizes of the table and its indexes
+
+Run backfill only once every worker is on hex+binary, or rows inserted by a
+hex-only worker afterwards are missed (verify catches that; run it again).
+"""
+import argparse
+import sys
+import time
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from app.db.database import get_engine
+
+DIGEST_INDEX = "sessions_token_digest_key"
+NOT_NULL_CHECK = "sessions_token_digest_not_null"
+# Schema changes give up instead of queueing behind a long transaction
+# (which would block every session query queued behind them)
+LOCK_TIMEOUT = "2s"
+
+
+def _connect() -> Connection:
+    engine = get_engine()
+    if engine is None:
+        raise SystemExit("DATABASE_URL is not configured")
+    if engine.dialect.name != "postgresql":
+        raise SystemExit(f"Online migration needs PostgreSQL, not {engine.dialect.name}")
+    # CREATE INDEX CONCURRENTLY can't run in a transaction block
+    conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    conn.execute(text(f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+    return conn
+
+
+def _index_valid(conn: Connection, name: str):
+    """True / False (a failed CONCURRENTLY build leaves an INVALID index) / None if absent."""
+    return conn.scalar(
+        text("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"),
+        {"name": name},
+    )
+
+
+def _has_token_hash(conn: Connection) -> bool:
+    return bool(
+        conn.scalar(
+            text(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'sessions' AND column_name = 'token_hash'"
+            )
+        )
+    )
+
+
+def prepare(conn: Connection) -> None:
+    if not _has_token_hash(conn):
+        print("Already finalized")
+        return
+    conn.execute(text("ALTER TABLE sessions ADD COLUMN IF NOT EXISTS token_digest bytea"))
+    # binary-phase workers stop writing token_hash
+    conn.execute(text("ALTER TABLE sessions ALTER COLUMN token_hash DROP NOT NULL"))
+    if _index_valid(conn, DIGEST_INDEX) is False:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {DIGEST_INDEX}"))
+    conn.execute(text(f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {DIGEST_INDEX} ON sessions (token_digest)"))
+    print(f"token_digest column and {DIGEST_INDEX} ready; deploy TOKEN_HASH_STORAGE=hex+binary, then backfill")
+
+
+def backfill(conn: Connection, batch: int, pause_ms: float) -> None:
+    """Keyset over id ranges: each batch is one short transaction on at most `batch` rows."""
+    max_id = conn.scalar(text("SELECT max(id) FROM sessions")) or 0
+    last_id, updated, start = 0, 0, time.perf_counter()
+    while last_id < max_id:
+        result = conn.execute(
+            text(
+                "UPDATE sessions SET token_digest = decode(token_hash, 'hex') "
+                "WHERE id > :lo AND id <= :hi AND token_digest IS NULL AND token_hash IS NOT NULL"
+            ),
+            {"lo": last_id, "hi": last_id + batch},
+        )
+        updated += result.rowcount
+        last_id += batch
+        if pause_ms:
+            time.sleep(pause_ms / 1000)
+    print(f"backfilled {updated} rows up to id {max_id} in {time.perf_counter() - start:.1f}s")
+
+
+def verify(conn: Connection) -> bool:
+    missing = conn.scalar(text("SELECT count(*) FROM sessions WHERE token_digest IS NULL"))
+    mismatched = 0
+    if _has_token_hash(conn):
+        mismatched = conn.scalar(
+            text(
+                "SELECT count(*) FROM sessions "
+                "WHERE token_hash IS NOT NULL AND token_digest IS DISTINCT FROM decode(token_hash, 'hex')"
+            )
+        )
+    valid = _index_valid(conn, DIGEST_INDEX)
+    print(f"rows without token_digest: {missing}, mismatched: {mismatched}, {DIGEST_INDEX} valid: {valid}")
+    return missing == 0 and mismatched == 0 and bool(valid)
+
+
+def finalize(conn: Connection) -> None:
+    if not _has_token_hash(conn):
+        print("Already finalized")
+        return
+    if not verify(conn):
+        raise SystemExit("Not finalizing: run backfill (with every worker on hex+binary or later) first")
+    # SET NOT NULL skips its full-table scan (under an exclusive lock) when a
+    # validated CHECK already proves it; VALIDATE only takes a weak lock
+    conn.execute(text(f"ALTER TABLE sessions DROP CONSTRAINT IF EXISTS {NOT_NULL_CHECK}"))
+    conn.execute(
+        text(f"ALTER TABLE sessions ADD CONSTRAINT {NOT_NULL_CHECK} CHECK (token_digest IS NOT NULL) NOT VALID")
+    )
+    conn.execute(text(f"ALTER TABLE sessions VALIDATE CONSTRAINT {NOT_NULL_CHECK}"))
+    conn.execute(text("ALTER TABLE sessions ALTER COLUMN token_digest SET NOT NULL"))
+    conn.execute(text(f"ALTER TABLE sessions DROP CONSTRAINT {NOT_NULL_CHECK}"))
+    # Drops the hex unique index with it; the heap space is reclaimed as rows are rewritten
+    conn.execute(text("ALTER TABLE sessions DROP COLUMN token_hash"))
+    # The backfill filled the digest index one row at a time (half-empty
+    # pages) and left dead tuples in the others; rebuild without blocking writes
+    conn.execute(text("REINDEX TABLE CONCURRENTLY sessions"))
+    print("token_hash dropped; sessions are keyed by token_digest only")
+
+
+def report(conn: Connection) -> None:
+    rows = conn.scalar(text("SELECT count(*) FROM sessions"))
+    print(f"sessions: {rows} rows, table {_size(conn, 'sessions')}")
+    for (name,) in conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'sessions' ORDER BY 1")):
+        print(f"  {name}: {_size(conn, name)}")
+
+
+def _size(conn: Connection, relation: str) -> str:
+    return conn.scalar(text("SELECT pg_size_pretty(pg_relation_size(CAST(:r AS regclass)))"), {"r": relation})
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", choices=["prepare", "backfill", "verify", "finalize", "report"])
+    parser.add_argument("--batch", type=int, default=5000, help="backfill: ids per transaction")
+    parser.add_argument("--pause-ms", type=float, default=20, help="backfill: pause between batches")
+    args = parser.parse_args(argv)
+
+    with _connect() as conn:
+        if args.step == "prepare":
+            prepare(conn)
+        elif args.step == "backfill":
+            backfill(conn, args.batch, args.pause_ms)
+        elif args.step == "verify":
+            return 0 if verify(conn) else 1
+        elif args.step == "finalize":
+            finalize(conn)
+        else:
+            report(conn)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
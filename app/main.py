@@ -1,24 +1,78 @@
 from contextlib import asynccontextmanager
 
+from anyio import to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import router
 from app.core import redis_client
-from app.db import Base, get_engine
+from app.core.fork_safety import check_fork_safety
+from app.core.jwt_keys import get_key_ring
+from app.core.http_metrics import RequestMetricsMiddleware, request_metrics
+from app.core.profiler import request_profiler
+from app.core.request_timing import ServerTimingMiddleware
+from app.core.security import calibrate_from_config, password_engine
+from app.core.token_denylist import token_denylist
+from app.db import Base, dispose_engines, get_engine
+from app.db.pool import THREADPOOL_SIZE
+from app.service.group_commit import session_batcher
+from app.service.health_monitor import health_monitor
+from app.service.session_flusher import session_flusher
+from app.service.session_sweeper import session_sweeper
+from app.service.user_service import seed_taken_usernames_in_background
+from app.service.warmup import WARMUP_ENABLED, warm_up
 import os
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Engines / Redis client must be built in this worker, not inherited from a parent
+    check_fork_safety()
+    # Parse JWT_KEYS_DIR now: a bad key fails startup, not the first login
+    get_key_ring()
+
+    # Size AnyIO's worker threads to the DB pool so threads don't pile up on checkout
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
     # Optional: create tables on startup (for dev/test environments)
     if os.getenv("CREATE_TABLES_ON_STARTUP", "false").lower() == "true":
         engine = get_engine()
         if engine:
             Base.metadata.create_all(bind=engine)
+
+    # Opt-in: pick the bcrypt cost that fits BCRYPT_TARGET_MS on this host
+    await calibrate_from_config()
+
+    # Write-behind persistence for SESSION_DURABILITY=async (no-op otherwise)
+    session_flusher.start()
+    # Deletes expired / long-revoked sessions (SESSION_SWEEP_INTERVAL_SECONDS=0 disables)
+    session_sweeper.start()
+    # Keeps this worker's revoked-token bloom filter in sync (needs Redis)
+    token_denylist.start()
+    # Probes DB + Redis in the background; /ready serves the cached result
+    health_monitor.start()
+    # Users created before the taken-username filter existed (once per Redis dataset)
+    seed_taken_usernames_in_background()
+
+    # Opt-in: pay pool/bcrypt/route cold-start costs here, not on the first requests
+    if WARMUP_ENABLED:
+        health_monitor.warming_up = True
+        try:
+            health_monitor.warmup_ms = await warm_up(app)
+        finally:
+            health_monitor.warming_up = False
     yield
     
     # Cleanup on shutdown
+    await health_monitor.stop()
+    await token_denylist.stop()
+    await session_sweeper.stop()
+    await session_flusher.stop()
+    await session_batcher.stop()
     await redis_client.close_redis()
+    password_engine.shutdown()
+    await dispose_engines()
+    request_profiler.stop()
+    request_metrics.mark_process_dead()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -42,3 +96,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+# Server-Timing breakdown (+ opt-in sampling profiler)
+app.add_middleware(ServerTimingMiddleware)
+
+# Outermost, so latency covers every other middleware
+app.add_middleware(RequestMetricsMiddleware)
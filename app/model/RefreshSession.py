@@ -4,19 +4,46 @@
 # @Description:
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import Integer, String, DateTime, ForeignKey, func
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import Integer, LargeBinary, String, DateTime, ForeignKey, Index, func, text
+from sqlalchemy.orm import InstrumentedAttribute, Mapped, mapped_column, relationship
 from app.db import Base
+from app.utils.hash import TOKEN_HASH_STORAGE, TOKEN_LOOKUP_BINARY, WRITES_TOKEN_DIGEST, WRITES_TOKEN_HASH
 
 
 class RefreshSession(Base):
     """Represents a user session with refresh token information."""
     __tablename__ = "sessions"
+    __table_args__ = (
+        # Used by app.service.session_sweeper; the revoked_at index is partial
+        # so the (mostly NULL) active rows don't bloat it
+        Index("ix_sessions_expires_at", "expires_at"),
+        Index(
+            "ix_sessions_revoked_at",
+            "revoked_at",
+            postgresql_where=text("revoked_at IS NOT NULL"),
+            sqlite_where=text("revoked_at IS NOT NULL"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False, index=True)
-    token_hash: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
+    # SHA-256 of the refresh token, per TOKEN_HASH_STORAGE (app.utils.hash):
+    # hex text, raw bytes (half the index size), or both while migrating.
+    # Only the columns of the current phase are mapped.
+    if WRITES_TOKEN_HASH:
+        token_hash: Mapped[Optional[str]] = mapped_column(
+            String(255), nullable=TOKEN_HASH_STORAGE != "hex", unique=True
+        )
+    if WRITES_TOKEN_DIGEST:
+        token_digest: Mapped[Optional[bytes]] = mapped_column(
+            LargeBinary(32), nullable=TOKEN_HASH_STORAGE != "binary", unique=True
+        )
     expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
     revoked_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
-    user = relationship("User", back_populates="sessions")
\ No newline at end of file
+    user = relationship("User", back_populates="sessions")
+
+
+def token_lookup_column() -> InstrumentedAttribute:
+    """The column sessions are found by (token_digest from binary+hex on)."""
+    return RefreshSession.token_digest if TOKEN_LOOKUP_BINARY else RefreshSession.token_hash
@@ -0,0 +1,142 @@
+# @Time: 2/07/26 21:05
+# @Author: jie
+# @File: group_commit.py
+# @Description: Group-commit batching of RefreshSession inserts at login
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from app.core.stats import Histogram
+from app.db.database import db_session_scope
+from app.model.RefreshSession import RefreshSession, token_lookup_column
+from app.utils.hash import token_columns
+
+logger = logging.getLogger(__name__)
+
+# ===== Config (opt-in) =====
+SESSION_GROUP_COMMIT = os.getenv("SESSION_GROUP_COMMIT", "false").lower() == "true"
+SESSION_GROUP_COMMIT_MAX_BATCH = int(os.getenv("SESSION_GROUP_COMMIT_MAX_BATCH", "64"))
+SESSION_GROUP_COMMIT_LINGER_MS = float(os.getenv("SESSION_GROUP_COMMIT_LINGER_MS", "5"))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class SessionInsertBatcher:
+    """
+    Coalesces concurrent session inserts into one multi-row INSERT + COMMIT.
+
+    Each login enqueues its row and awaits a future. A single writer task
+    waits up to `linger_ms` after the first row (or until `max_batch` rows
+    are queued), then writes the whole batch with
+    INSERT ... VALUES (...), (...) RETURNING id, <token hash>
+    and hands every waiter its id. One fsync-bound commit is shared by the
+    whole batch instead of one per login.
+    """
+
+    def __init__(self, max_batch: int, linger_ms: float):
+        self.max_batch = max_batch
+        self.linger = linger_ms / 1000
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._has_rows: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.commit_latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._has_rows = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="session-group-commit")
+
+    async def insert(self, user_id: int, token_hash: bytes, expires_at: datetime) -> int:
+        """Queue one session row and wait for the batch it lands in to commit."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({"user_id": user_id, **token_columns(token_hash), "expires_at": expires_at}, future))
+        self._has_rows.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_rows.wait()
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.linger)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+
+    async def _flush(self) -> None:
+        batch = self._pending[: self.max_batch]
+        del self._pending[: self.max_batch]
+        if len(self._pending) < self.max_batch:
+            self._full.clear()
+        if not self._pending:
+            self._has_rows.clear()
+        if not batch:
+            return
+
+        rows = [row for row, _ in batch]
+        sessions = RefreshSession.__table__
+        token_key = token_lookup_column().key
+        start = time.perf_counter()
+        try:
+            async with db_session_scope() as db:
+                result = await db.execute(
+                    insert(sessions).returning(sessions.c.id, sessions.c[token_key]), rows
+                )
+                ids = {token: session_id for session_id, token in result.all()}
+                await db.commit()
+        except Exception as e:
+            self.errors += 1
+            logger.exception("Group-commit session insert failed (%d rows)", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.commit_latency.observe(time.perf_counter() - start)
+            self.batch_size.observe(len(batch))
+
+        self.rows += len(batch)
+        for row, future in batch:
+            if not future.done():  # the waiting request may have been cancelled
+                future.set_result(ids[row[token_key]])
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while self._pending:
+            await self._flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": SESSION_GROUP_COMMIT,
+            "max_batch": self.max_batch,
+            "linger_ms": self.linger * 1000,
+            "queued": len(self._pending),
+            "rows": self.rows,
+            "errors": self.errors,
+            "batch_size": self.batch_size.snapshot(),
+            "commit_latency_seconds": self.commit_latency.snapshot(),
+        }
+
+
+session_batcher = SessionInsertBatcher(SESSION_GROUP_COMMIT_MAX_BATCH, SESSION_GROUP_COMMIT_LINGER_MS)
@@ -0,0 +1,133 @@
+# @Time: 2/13/26 20:30
+# @Author: jie
+# @File: health_monitor.py
+# @Description: Background dependency checks so /ready serves a cached answer
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.core.redis_client import check_redis_ready
+from app.db.database import check_database_ready_async
+from app.db.replicas import check_replicas_ready
+from app.service.session_store import session_store
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_INTERVAL_SECONDS = float(os.getenv("HEALTH_CHECK_INTERVAL_SECONDS", "5"))
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("HEALTH_CHECK_TIMEOUT_SECONDS", "2"))
+# A result older than this means the monitor itself is stuck: report not ready
+HEALTH_MAX_AGE_SECONDS = float(
+    os.getenv("HEALTH_MAX_AGE_SECONDS", str(3 * HEALTH_CHECK_INTERVAL_SECONDS + HEALTH_CHECK_TIMEOUT_SECONDS))
+)
+
+CHECKS: Dict[str, Callable[[], Awaitable[dict]]] = {
+    "database": check_database_ready_async,
+    "redis": check_redis_ready,
+    # Also what takes lagging/dead replicas out of the read rotation
+    "replicas": check_replicas_ready,
+}
+
+
+class HealthMonitor:
+    """
+    Probes Postgres and Redis concurrently every HEALTH_CHECK_INTERVAL_SECONDS,
+    each bounded by HEALTH_CHECK_TIMEOUT_SECONDS, and keeps the last result.
+
+    /ready only reads that result, so a probe costs no DB connection, no
+    Redis round trip and no event-loop blocking, however often the load
+    balancers ask.
+
+    Redis is only required when it holds the sessions (SESSION_STORE=redis,
+    or SESSION_DURABILITY=async); otherwise the auth paths run DB-only while
+    it is down and /ready reports it as degraded. The Redis PING here is also what
+    probes an open circuit breaker (app.core.redis_client.redis_breaker).
+    Read replicas are never required either.
+    """
+
+    def __init__(self, interval: float, timeout: float, max_age: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_age = max_age
+        self._task: Optional[asyncio.Task] = None
+
+        self.status: Dict[str, str] = {}
+        self.latency_ms: Dict[str, float] = {}
+        self.checked_at: Optional[float] = None
+        self.checks = 0
+        # Set by lifespan around the opt-in warm-up (app.service.warmup)
+        self.warming_up = False
+        self.warmup_ms: Optional[dict] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="health-monitor")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Health check failed")
+            await asyncio.sleep(self.interval)
+
+    async def _probe(self, name: str, check: Callable[[], Awaitable[dict]]):
+        start = time.perf_counter()
+        try:
+            result = (await asyncio.wait_for(check(), self.timeout))[name]
+        except asyncio.TimeoutError:
+            result = f"error: timed out after {self.timeout}s"
+        except Exception as e:
+            result = f"error: {e}"
+        return name, result, round((time.perf_counter() - start) * 1000, 3)
+
+    async def refresh(self) -> None:
+        """Run every check concurrently and replace the cached result."""
+        results = await asyncio.gather(*(self._probe(name, check) for name, check in CHECKS.items()))
+        self.status = {name: result for name, result, _ in results}
+        self.latency_ms = {name: latency for name, _, latency in results}
+        self.checked_at = time.time()
+        self.checks += 1
+
+    def age(self) -> Optional[float]:
+        return None if self.checked_at is None else time.time() - self.checked_at
+
+    def degraded(self) -> list:
+        """Failing dependencies the service can run without (replicas always: reads fall back to the primary)."""
+        optional = ("replicas",) if session_store.requires_redis() else ("redis", "replicas")
+        return [name for name in optional if self.status.get(name, "ok") not in ("ok", "not_configured")]
+
+    def is_ready(self) -> bool:
+        age = self.age()
+        if self.warming_up or age is None or age > self.max_age:
+            return False
+        degraded = self.degraded()
+        # "not_configured" is acceptable (dependency is optional)
+        return all(v == "ok" or v == "not_configured" or k in degraded for k, v in self.status.items())
+
+    def snapshot(self) -> dict:
+        age = self.age()
+        return {
+            "dependencies": dict(self.status),
+            "latency_ms": dict(self.latency_ms),
+            "degraded": self.degraded(),
+            "last_check_age_seconds": None if age is None else round(age, 3),
+            "warming_up": self.warming_up,
+            "warmup_ms": self.warmup_ms,
+        }
+
+
+health_monitor = HealthMonitor(HEALTH_CHECK_INTERVAL_SECONDS, HEALTH_CHECK_TIMEOUT_SECONDS, HEALTH_MAX_AGE_SECONDS)
@@ -0,0 +1,161 @@
+# @Time: 2/24/26 21:00
+# @Author: jie
+# @File: memory_session_store.py
+# @Description: In-process SessionStore: slotted records, a hash index and an expiry heap
+import heapq
+from typing import Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+
+from app.service.session_service import SESSION_TOMBSTONE_TTL, RotatedSession, SessionRecord
+from app.service.session_store import SessionStore
+from app.utils.hash import now_ts
+
+# Rebuild the heap once stale entries (superseded deadlines) outnumber live ones this much
+_HEAP_SLACK = 2
+
+
+class _Session:
+    __slots__ = ("user_id", "username", "expires_at", "revoked", "active", "deadline")
+
+    def __init__(self, user_id: int, username: str, expires_at: int, active: bool = True):
+        self.user_id = user_id
+        self.username = username  # shared with the user's other sessions
+        self.expires_at = expires_at
+        self.revoked = False
+        self.active = active
+        self.deadline = expires_at  # when the entry is dropped (a tombstone's is sooner)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions in this process's memory, for a single worker (tests,
+    benchmarks, single-node deployments that accept losing sessions on
+    restart).
+
+    - index: token digest -> _Session (one dict lookup per operation)
+    - per-user sets of live digests for revoke_all
+    - a min-heap of (deadline, digest): expired sessions and tombstones
+      (revoked ones, kept SESSION_TOMBSTONE_TTL so reuse reads "revoked")
+      are dropped as their deadline passes, amortized over the writes.
+      A revocation pushes a new deadline and leaves the old heap entry
+      behind; those are skipped when popped, and the heap is rebuilt when
+      they pile up.
+
+    Every method runs without awaiting, so each is atomic on the event loop.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._sessions: Dict[bytes, _Session] = {}
+        self._by_user: Dict[int, Set[bytes]] = {}
+        self._heap: List[Tuple[int, bytes]] = []
+
+        self.creates = 0
+        self.rotations = 0
+        self.rejections = 0
+        self.revocations = 0
+        self.evictions = 0
+        self.heap_rebuilds = 0
+
+    # ===== index maintenance =====
+
+    def _add(self, token_hash: bytes, session: _Session) -> None:
+        self._sessions[token_hash] = session
+        self._by_user.setdefault(session.user_id, set()).add(token_hash)
+        heapq.heappush(self._heap, (session.deadline, token_hash))
+
+    def _unindex(self, token_hash: bytes, session: _Session) -> None:
+        hashes = self._by_user.get(session.user_id)
+        if hashes is not None:
+            hashes.discard(token_hash)
+            if not hashes:
+                del self._by_user[session.user_id]
+
+    def _tombstone(self, token_hash: bytes, session: _Session, now: int) -> None:
+        session.revoked = True
+        session.deadline = min(session.expires_at, now + SESSION_TOMBSTONE_TTL)
+        self._unindex(token_hash, session)
+        heapq.heappush(self._heap, (session.deadline, token_hash))
+        self.revocations += 1
+
+    def _evict(self, now: int) -> None:
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, token_hash = heapq.heappop(heap)
+            session = self._sessions.get(token_hash)
+            if session is not None and session.deadline == deadline:
+                del self._sessions[token_hash]
+                self._unindex(token_hash, session)
+                self.evictions += 1
+        if len(heap) > _HEAP_SLACK * len(self._sessions) + 1024:
+            self._heap = [(s.deadline, h) for h, s in self._sessions.items()]
+            heapq.heapify(self._heap)
+            self.heap_rebuilds += 1
+
+    # ===== SessionStore =====
+
+    async def create(self, db, user, token_hash, expires_at, ttl_seconds):
+        self._evict(now_ts())
+        self._add(token_hash, _Session(user.id, user.username, int(expires_at.timestamp()), active=user.is_active))
+        self.creates += 1
+
+    async def lookup(self, db, token_hash) -> Optional[SessionRecord]:
+        session = self._sessions.get(token_hash)
+        if session is None:
+            return None
+        return SessionRecord(
+            user_id=session.user_id,
+            username=session.username,
+            expires_at=session.expires_at,
+            revoked=session.revoked,
+            active=session.active,
+        )
+
+    async def rotate(self, db, old_hash, new_hash, now, expires_at, ttl_seconds):
+        now_epoch = int(now.timestamp())
+        self._evict(now_epoch)
+        session = self._sessions.get(old_hash)
+        if session is None:
+            raise HTTPException(status_code=401, detail="Invalid refresh token")
+        detail = None
+        if session.revoked:
+            detail = "Refresh token revoked"
+        elif session.expires_at <= now_epoch:
+            detail = "Refresh token expired"
+        elif not session.active:
+            detail = "User not available"
+        if detail is not None:
+            self.rejections += 1
+            raise HTTPException(status_code=401, detail=detail)
+
+        self._tombstone(old_hash, session, now_epoch)
+        self._add(new_hash, _Session(session.user_id, session.username, int(expires_at.timestamp())))
+        self.rotations += 1
+        return RotatedSession(session_id=None, user_id=session.user_id, username=session.username)
+
+    async def revoke(self, db, token_hash, now):
+        session = self._sessions.get(token_hash)
+        if session is not None and not session.revoked:
+            self._tombstone(token_hash, session, int(now.timestamp()))
+
+    async def revoke_all(self, db, user_id, now):
+        hashes = self._by_user.pop(user_id, set())
+        for token_hash in hashes:
+            self._tombstone(token_hash, self._sessions[token_hash], int(now.timestamp()))
+        return len(hashes)
+
+    def stats(self) -> dict:
+        return {
+            "store": self.name,
+            "sessions": len(self._sessions),  # tombstones included
+            "users": len(self._by_user),
+            "heap_entries": len(self._heap),
+            "creates": self.creates,
+            "rotations": self.rotations,
+            "rejections": self.rejections,
+            "revocations": self.revocations,
+            "evictions": self.evictions,
+            "heap_rebuilds": self.heap_rebuilds,
+        }
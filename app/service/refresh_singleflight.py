@@ -0,0 +1,296 @@
+# @Time: 2/23/26 20:10
+# @Author: jie
+# @File: refresh_singleflight.py
+# @Description: Single-flight + grace window for concurrent refreshes of the same token
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+
+from app.core.redis_client import available_redis_client
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+# A token rotated less than this long ago is answered with the rotation's
+# result instead of 401 (0 disables single-flight and the grace window)
+REFRESH_GRACE_SECONDS = int(os.getenv("REFRESH_GRACE_SECONDS", "10"))
+# How long a duplicate waits for another worker's rotation of the same token
+REFRESH_SINGLEFLIGHT_WAIT_MS = int(os.getenv("REFRESH_SINGLEFLIGHT_WAIT_MS", "2000"))
+
+GRACE_MAX_ENTRIES = 10000
+_POLL_SECONDS = 0.02
+_PENDING = "pending"
+_NONCE_BYTES = 12
+
+
+@dataclass(frozen=True)
+class RefreshResult:
+    access_token: str
+    refresh_token: str  # plain, for the cookie
+    user_id: int
+
+
+def _cipher(old_plain: str) -> AESGCM:
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"refresh-grace").derive(old_plain.encode("utf-8"))
+    return AESGCM(key)
+
+
+def seal(old_plain: str, result: RefreshResult) -> str:
+    """
+    Encrypt a result for Redis (AES-GCM) under a key derived from the old
+    plain token, which Redis never sees (it only holds its SHA-256). A
+    value that was altered fails to open rather than decoding to garbage.
+    """
+    payload = json.dumps(
+        {"a": result.access_token, "r": result.refresh_token, "u": result.user_id}, separators=(",", ":")
+    ).encode()
+    nonce = os.urandom(_NONCE_BYTES)
+    return base64.b64encode(nonce + _cipher(old_plain).encrypt(nonce, payload, None)).decode()
+
+
+def unseal(old_plain: str, value: str) -> Optional[RefreshResult]:
+    try:
+        sealed = base64.b64decode(value, validate=True)
+        data = json.loads(_cipher(old_plain).decrypt(sealed[:_NONCE_BYTES], sealed[_NONCE_BYTES:], None))
+        return RefreshResult(access_token=data["a"], refresh_token=data["r"], user_id=int(data["u"]))
+    except (InvalidTag, ValueError, KeyError, TypeError):
+        return None
+
+
+def flight_key(old_hash: bytes) -> str:
+    """"pending" while a worker rotates the token, then its sealed result for the grace window."""
+    return f"rtflight:{old_hash.hex()}"
+
+
+def user_flights_key(user_id: int) -> str:
+    """SET of the flight keys holding a user's grace results (dropped on logout)."""
+    return f"rtflight:user:{user_id}"
+
+
+class RefreshSingleFlight:
+    """
+    Coalesces refreshes that present the same (old) refresh token.
+
+    Browsers with several tabs fire /refresh together with one cookie; only
+    the first rotation can win, and the others used to get "Refresh token
+    revoked" and fall back to a bcrypt login.
+
+    - Same worker, rotation in flight: wait for it and share its result.
+    - Same worker, rotated within REFRESH_GRACE_SECONDS: return that result
+      again (no DB or Redis work).
+    - Other workers: the leader holds rtflight:{hash} ("pending") while it
+      rotates, then stores the sealed result there for the grace window.
+      A duplicate that finds the key polls it for up to
+      REFRESH_SINGLEFLIGHT_WAIT_MS instead of rotating.
+
+    If the leader fails, waiters on this worker get its error; waiters on
+    other workers rotate themselves (and get the precise 401). Without
+    Redis, only same-worker duplicates are coalesced.
+
+    Logging out drops the user's grace results (forget_user), so the old
+    cookie stops yielding the new tokens. A worker's own copy is only
+    served while the Redis result still exists, which covers logouts
+    handled by other workers.
+    """
+
+    def __init__(self, grace_seconds: int, wait_ms: int):
+        self.grace_seconds = grace_seconds
+        self.wait = wait_ms / 1000
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        self._grace: "OrderedDict[bytes, Tuple[float, RefreshResult]]" = OrderedDict()
+
+        self.leaders = 0
+        self.coalesced_inflight = 0
+        self.coalesced_grace = 0
+        self.coalesced_remote = 0
+        self.remote_wait_timeouts = 0
+        self.forgotten = 0
+
+    async def run(
+        self, old_plain: str, old_hash: bytes, rotate: Callable[[], Awaitable[RefreshResult]]
+    ) -> RefreshResult:
+        if self.grace_seconds <= 0:
+            return await rotate()
+
+        while (future := self._inflight.get(old_hash)) is not None:
+            # wait() rather than await: a cancelled leader must not cancel us
+            await asyncio.wait((future,))
+            if not future.cancelled():
+                self.coalesced_inflight += 1
+                return future.result()
+
+        cached = self._local_grace(old_hash)
+        if cached is not None:
+            if await self._still_granted(old_hash):
+                self.coalesced_grace += 1
+                return cached
+            self._grace.pop(old_hash, None)
+
+        future = asyncio.get_running_loop().create_future()
+        # Mark a failure as retrieved even when nobody was waiting for it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[old_hash] = future
+        try:
+            result = await self._lead(old_plain, old_hash, rotate)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[old_hash]
+
+    async def _lead(
+        self, old_plain: str, old_hash: bytes, rotate: Callable[[], Awaitable[RefreshResult]]
+    ) -> RefreshResult:
+        rds = available_redis_client()
+        key = flight_key(old_hash)
+        if rds is not None:
+            try:
+                if not await rds.set(key, _PENDING, nx=True, px=int(self.wait * 1000)):
+                    remote = await self._await_remote(rds, old_plain, key)
+                    if remote is not None:
+                        self.coalesced_remote += 1
+                        return remote
+            except RedisError:
+                logger.warning("Refresh single-flight: Redis call failed, coalescing in-process only", exc_info=True)
+                rds = None
+
+        self.leaders += 1
+        try:
+            result = await rotate()
+        except HTTPException as e:
+            # Lost a race the lock did not see (it expired, or Redis was skipped)
+            if rds is not None and e.detail == "Refresh token revoked":
+                remote = await self._read_remote(rds, old_plain, key)
+                if remote is not None:
+                    self.coalesced_remote += 1
+                    return remote
+            await self._release(rds, key)
+            raise
+        except BaseException:
+            await self._release(rds, key)
+            raise
+
+        self._remember(old_hash, result)
+        if rds is not None:
+            try:
+                async with rds.pipeline(transaction=True) as pipe:
+                    pipe.set(key, seal(old_plain, result), ex=self.grace_seconds)
+                    pipe.sadd(user_flights_key(result.user_id), key)
+                    pipe.expire(user_flights_key(result.user_id), self.grace_seconds)
+                    await pipe.execute()
+            except RedisError:
+                logger.warning("Refresh single-flight: could not store the grace result", exc_info=True)
+        return result
+
+    async def _await_remote(self, rds, old_plain: str, key: str) -> Optional[RefreshResult]:
+        """Poll another worker's rotation; None if it failed, vanished or took too long."""
+        deadline = time.monotonic() + self.wait
+        while True:
+            value = await rds.get(key)
+            if value is None:
+                return None
+            if value != _PENDING:
+                return unseal(old_plain, value)
+            if time.monotonic() >= deadline:
+                self.remote_wait_timeouts += 1
+                return None
+            await asyncio.sleep(_POLL_SECONDS)
+
+    async def _read_remote(self, rds, old_plain: str, key: str) -> Optional[RefreshResult]:
+        try:
+            value = await rds.get(key)
+        except RedisError:
+            return None
+        if value is None or value == _PENDING:
+            return None
+        return unseal(old_plain, value)
+
+    @staticmethod
+    async def _release(rds, key: str) -> None:
+        if rds is None:
+            return
+        try:
+            await rds.delete(key)
+        except RedisError:
+            pass  # expires after REFRESH_SINGLEFLIGHT_WAIT_MS anyway
+
+    @staticmethod
+    async def _still_granted(old_hash: bytes) -> bool:
+        """False once the Redis result is gone (a logout on any worker, or expiry)."""
+        rds = available_redis_client()
+        if rds is None:
+            return True
+        try:
+            return bool(await rds.exists(flight_key(old_hash)))
+        except RedisError:
+            return True
+
+    async def forget_user(self, user_id: int) -> None:
+        """Drop a user's grace results, here and in Redis, once their sessions are revoked."""
+        stale = [old_hash for old_hash, (_, result) in self._grace.items() if result.user_id == user_id]
+        for old_hash in stale:
+            del self._grace[old_hash]
+        self.forgotten += len(stale)
+        rds = available_redis_client()
+        if rds is None:
+            return
+        try:
+            keys = await rds.smembers(user_flights_key(user_id))
+            async with rds.pipeline(transaction=True) as pipe:
+                if keys:
+                    pipe.delete(*keys)
+                pipe.delete(user_flights_key(user_id))
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Refresh single-flight: could not drop the grace results of user %s", user_id, exc_info=True)
+
+    def _local_grace(self, old_hash: bytes) -> Optional[RefreshResult]:
+        entry = self._grace.get(old_hash)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def _remember(self, old_hash: bytes, result: RefreshResult) -> None:
+        now = time.monotonic()
+        self._grace[old_hash] = (now + self.grace_seconds, result)
+        # Insertion order is expiry order (one fixed grace period)
+        while self._grace:
+            oldest_expiry, _ = next(iter(self._grace.values()))
+            if oldest_expiry > now and len(self._grace) <= GRACE_MAX_ENTRIES:
+                break
+            self._grace.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "grace_seconds": self.grace_seconds,
+            "leaders": self.leaders,
+            "coalesced_inflight": self.coalesced_inflight,
+            "coalesced_grace": self.coalesced_grace,
+            "coalesced_remote": self.coalesced_remote,
+            "remote_wait_timeouts": self.remote_wait_timeouts,
+            "forgotten": self.forgotten,
+            "inflight": len(self._inflight),
+            "grace_entries": len(self._grace),
+        }
+
+
+refresh_flights = RefreshSingleFlight(REFRESH_GRACE_SECONDS, REFRESH_SINGLEFLIGHT_WAIT_MS)
@@ -0,0 +1,326 @@
+# @Time: 2/05/26 22:40
+# @Author: jie
+# @File: session_flusher.py
+# @Description: Write-behind flusher that persists Redis session changes to Postgres
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from redis.client import NEVER_DECODE
+from sqlalchemy import bindparam, select, update
+
+from app.core.redis_client import CircuitOpenError, get_redis_client
+from app.db.database import db_session_scope, insert_ignore
+from app.model.RefreshSession import RefreshSession, token_lookup_column
+from app.model.User import User
+from app.service.session_service import (
+    WRITE_BEHIND_QUEUE,
+    SessionRecord,
+    redis_key,
+    user_sessions_key,
+    write_behind_enabled,
+)
+from app.utils.hash import digest_from_token_id, token_columns, token_id
+
+logger = logging.getLogger(__name__)
+
+SESSION_FLUSH_INTERVAL_MS = int(os.getenv("SESSION_FLUSH_INTERVAL_MS", "200"))
+SESSION_FLUSH_BATCH = int(os.getenv("SESSION_FLUSH_BATCH", "500"))
+SESSION_REHYDRATE_BATCH = int(os.getenv("SESSION_REHYDRATE_BATCH", "1000"))
+
+FLUSH_LOCK_KEY = "session:wb:lock"
+FLUSH_LOCK_TTL_MS = 10_000
+EPOCH_KEY = "session:epoch"
+# Entries that can't be decoded, kept for inspection instead of blocking the queue
+DEAD_LETTER_KEY = "session:wb:dead"
+DEAD_LETTER_MAX = 10_000
+
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+# KEYS: lock, queue, dead-letter list
+# ARGV: lock token, entries read, dead-letter cap, malformed entries...
+# Only the lock holder may trim: if the lock expired during the DB step,
+# another flusher has read (and will trim) the same head of the queue, and a
+# second LTRIM would drop entries nobody flushed. Returns the queue length,
+# or -1 when the lock was lost.
+_TRIM_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return -1 end
+if #ARGV > 3 then
+  for i = 4, #ARGV do redis.call('RPUSH', KEYS[3], ARGV[i]) end
+  redis.call('LTRIM', KEYS[3], -tonumber(ARGV[3]), -1)
+end
+redis.call('LTRIM', KEYS[2], ARGV[2], -1)
+return redis.call('LLEN', KEYS[2])
+"""
+
+
+def _ts(value: int) -> datetime:
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+def _digest(value: str) -> bytes:
+    digest = bytes.fromhex(value)
+    if len(digest) != 32:
+        raise ValueError("not a SHA-256 digest")
+    return digest
+
+
+def _parse_entry(raw: bytes) -> Tuple[Optional[dict], Optional[dict]]:
+    """(insert params, revoke params) of a queue entry; raises on a malformed one."""
+    # Queue entries carry hex hashes (JSON); stored per TOKEN_HASH_STORAGE
+    entry = json.loads(raw)
+    insert = revoke = None
+    if entry.get("new"):
+        insert = {
+            "user_id": int(entry["uid"]),
+            **token_columns(_digest(entry["new"])),
+            "expires_at": _ts(int(entry["exp"])),
+        }
+    if entry.get("old"):
+        revoke = {"h": token_id(_digest(entry["old"])), "at": _ts(int(entry["at"]))}
+    return insert, revoke
+
+
+class SessionFlusher:
+    """
+    Drains the write-behind queue (a Redis list) into Postgres.
+
+    - Entries are read with LRANGE and only trimmed after the DB commit, so a
+      crash replays them; inserts use ON CONFLICT DO NOTHING and revocations
+      only touch rows with revoked_at IS NULL, so replays are idempotent.
+    - A short Redis lock keeps one flusher active across workers. The trim
+      checks it is still held, so a flusher whose lock expired mid-commit
+      leaves the entries to the one that took over.
+    - An entry that can't be decoded goes to a dead-letter list instead of
+      failing every flush behind it.
+    - Reconciliation: an epoch key is written once per Redis dataset. If it
+      disappears, Redis lost data (restart without persistence, failover,
+      FLUSHALL). Unflushed entries are gone at that point; Postgres is the
+      source of truth again and active sessions are re-hydrated into Redis.
+      Tokens rotated inside the lost window fall back to their last flushed
+      DB state, which is the price of SESSION_DURABILITY=async.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._epoch: Optional[str] = None
+        self._lock_token = secrets.token_hex(8)
+
+        self.flushed = 0
+        self.batches = 0
+        self.errors = 0
+        self.queue_length = 0
+        self.dead_lettered = 0
+        self.lock_lost = 0
+        self.data_loss_detected = 0
+        self.rehydrated = 0
+        self.last_flush_at: Optional[float] = None
+
+    def start(self) -> None:
+        if self._task is None and write_behind_enabled():
+            self._task = asyncio.create_task(self._run(), name="session-flusher")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Drain whatever is left so a clean shutdown loses nothing
+        try:
+            while await self.flush_once():
+                pass
+        except Exception:
+            logger.exception("Final session flush failed")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.check_epoch()
+                while await self.flush_once() >= SESSION_FLUSH_BATCH:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except CircuitOpenError:
+                pass  # Redis is down and already reported; the queue waits in Redis
+            except Exception:
+                self.errors += 1
+                logger.exception("Session write-behind flush failed")
+            await asyncio.sleep(SESSION_FLUSH_INTERVAL_MS / 1000)
+
+    async def _acquire(self) -> bool:
+        rds = get_redis_client()
+        return bool(await rds.set(FLUSH_LOCK_KEY, self._lock_token, nx=True, px=FLUSH_LOCK_TTL_MS))
+
+    async def _release(self) -> None:
+        rds = get_redis_client()
+        await rds.eval(_RELEASE_LOCK_LUA, 1, FLUSH_LOCK_KEY, self._lock_token)
+
+    async def flush_once(self) -> int:
+        """Apply one batch from the queue. Returns the number of entries flushed."""
+        rds = get_redis_client()
+        if not await self._acquire():
+            return 0
+        try:
+            # Undecoded, so a corrupt entry fails on its own below rather than here
+            raw_entries = await rds.execute_command(
+                "LRANGE", WRITE_BEHIND_QUEUE, 0, SESSION_FLUSH_BATCH - 1, **{NEVER_DECODE: True}
+            )
+            if not raw_entries:
+                self.queue_length = 0
+                return 0
+
+            inserts, revokes, malformed = [], [], []
+            for raw in raw_entries:
+                try:
+                    insert, revoke = _parse_entry(raw)
+                except (ValueError, KeyError, TypeError, AttributeError, OverflowError, OSError):
+                    malformed.append(raw)
+                    continue
+                if insert:
+                    inserts.append(insert)
+                if revoke:
+                    revokes.append(revoke)
+
+            sessions = RefreshSession.__table__
+            token_column = sessions.c[token_lookup_column().key]
+            async with db_session_scope() as db:
+                # Core (not ORM) statements so executemany stays a plain batch
+                # Inserts first: a token is always created before it can be revoked
+                if inserts:
+                    await db.execute(insert_ignore(sessions, db.get_bind().dialect.name, [token_column.key]), inserts)
+                if revokes:
+                    await db.execute(
+                        update(sessions)
+                        .where(token_column == bindparam("h"), sessions.c.revoked_at.is_(None))
+                        .values(revoked_at=bindparam("at")),
+                        revokes,
+                    )
+                await db.commit()
+
+            remaining = await rds.eval(
+                _TRIM_LUA,
+                3,
+                FLUSH_LOCK_KEY,
+                WRITE_BEHIND_QUEUE,
+                DEAD_LETTER_KEY,
+                self._lock_token,
+                len(raw_entries),
+                DEAD_LETTER_MAX,
+                *malformed,
+            )
+            if remaining < 0:
+                # Committed, but the next lock holder replays these (idempotently) and trims them
+                self.lock_lost += 1
+                logger.warning("Session flush lock expired during the DB write; leaving the trim to its new holder")
+                return 0
+            if malformed:
+                self.dead_lettered += len(malformed)
+                logger.error("Moved %d malformed write-behind entries to %s", len(malformed), DEAD_LETTER_KEY)
+
+            self.queue_length = remaining
+            self.flushed += len(raw_entries) - len(malformed)
+            self.batches += 1
+            self.last_flush_at = time.time()
+            return len(raw_entries)
+        finally:
+            await self._release()
+
+    async def check_epoch(self) -> None:
+        """Detect a Redis data loss and reconcile from Postgres."""
+        rds = get_redis_client()
+        current = await rds.get(EPOCH_KEY)
+        if current is not None and current == self._epoch:
+            return
+
+        candidate = uuid.uuid4().hex
+        created = await rds.set(EPOCH_KEY, candidate, nx=True)
+        first_check = self._epoch is None
+        self._epoch = await rds.get(EPOCH_KEY)
+
+        if created and not first_check:
+            # We saw an epoch before and it vanished: Redis lost its dataset.
+            self.data_loss_detected += 1
+            logger.warning("Redis session data loss detected; re-hydrating sessions from Postgres")
+            await self.rehydrate()
+
+    async def rehydrate(self) -> int:
+        """
+        Copy active sessions from Postgres back into Redis (keyset-paginated).
+
+        SET NX so records written by live traffic since the loss always win.
+        """
+        rds = get_redis_client()
+        now = datetime.now(timezone.utc)
+        last_id, total = 0, 0
+        while True:
+            async with db_session_scope() as db:
+                rows = (
+                    await db.execute(
+                        select(
+                            RefreshSession.id,
+                            token_lookup_column().label("token"),
+                            RefreshSession.expires_at,
+                            User.id.label("user_id"),
+                            User.username,
+                            User.is_active,
+                        )
+                        .join(User, User.id == RefreshSession.user_id)
+                        .where(
+                            RefreshSession.id > last_id,
+                            RefreshSession.revoked_at.is_(None),
+                            RefreshSession.expires_at > now,
+                        )
+                        .order_by(RefreshSession.id)
+                        .limit(SESSION_REHYDRATE_BATCH)
+                    )
+                ).all()
+            if not rows:
+                break
+
+            async with rds.pipeline(transaction=False) as pipe:
+                for row in rows:
+                    expires_at = row.expires_at if row.expires_at.tzinfo else row.expires_at.replace(tzinfo=timezone.utc)
+                    ttl = int((expires_at - now).total_seconds())
+                    if ttl <= 0:
+                        continue
+                    record = SessionRecord(row.user_id, row.username, int(expires_at.timestamp()), active=row.is_active)
+                    pipe.set(redis_key(digest_from_token_id(row.token)), record.dumps(), ex=ttl, nx=True)
+                    pipe.sadd(user_sessions_key(row.user_id), row.token)
+                    pipe.expire(user_sessions_key(row.user_id), ttl, gt=True)
+                await pipe.execute()
+
+            total += len(rows)
+            last_id = rows[-1].id
+
+        self.rehydrated += total
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "errors": self.errors,
+            "queue_length": self.queue_length,
+            "dead_lettered": self.dead_lettered,
+            "lock_lost": self.lock_lost,
+            "data_loss_detected": self.data_loss_detected,
+            "rehydrated": self.rehydrated,
+            "last_flush_age_seconds": round(time.time() - self.last_flush_at, 3) if self.last_flush_at else None,
+        }
+
+
+session_flusher = SessionFlusher()
@@ -0,0 +1,610 @@
+# @Time: 2/04/26 21:30
+# @Author: jie
+# @File: session_service.py
+# @Description: Refresh-session persistence (DB + Redis) used by the auth routes
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set, Union
+
+from fastapi import HTTPException
+from redis.client import NEVER_DECODE
+from redis.exceptions import RedisError
+from sqlalchemy import insert, literal, select, update
+
+from app.core.redis_client import available_redis_client, get_redis_client, redis_breaker
+from app.db.database import DbSession
+from app.model.RefreshSession import RefreshSession, token_lookup_column
+from app.model.User import User
+from app.service.group_commit import SESSION_GROUP_COMMIT, session_batcher
+from app.utils.hash import TOKEN_LOOKUP_BINARY, digest_from_token_id, token_columns, token_id
+
+# Token hashes are passed around as the raw 32-byte SHA-256 digest
+# (app.utils.hash.hash_refresh_token) and encoded per TOKEN_HASH_STORAGE at
+# each store. The write-behind queue is JSON, so it always carries hex.
+
+# Where refresh sessions live (app.service.session_store):
+#   database  Postgres (or any SQLAlchemy database) with Redis as cache / write-behind buffer
+#   redis     Redis only: records expire with their TTL, nothing is written to the database
+#   memory    this process only (single worker): tests, benchmarks, single-node deployments
+SESSION_STORE = os.getenv("SESSION_STORE", "database").lower()
+
+# SESSION_STORE=database only:
+# "sync":  Postgres is written inline on every login/refresh/logout (Redis is a cache)
+# "async": a valid refresh is served from Redis alone; Postgres is written
+#          behind by app.service.session_flusher. A Redis data loss can drop
+#          the last few unflushed rotations (see session_flusher).
+SESSION_DURABILITY = os.getenv("SESSION_DURABILITY", "sync").lower()
+
+# How long a revoked record is kept in Redis so reuse is rejected without the DB
+SESSION_TOMBSTONE_TTL = int(os.getenv("SESSION_TOMBSTONE_TTL", "3600"))
+
+WRITE_BEHIND_QUEUE = "session:wb"
+
+# Revocations that could not reach Redis, per worker, replayed on recovery
+SESSION_DEFERRED_MAX = int(os.getenv("SESSION_DEFERRED_MAX", "100000"))
+
+logger = logging.getLogger(__name__)
+
+SESSION_STATS = {
+    "redis_rotations": 0,
+    "db_rotations": 0,
+    "redis_rejections": 0,
+    "revoke_all": 0,
+    "redis_fallbacks": 0,
+    "deferred_dropped": 0,
+    "deferred_replayed": 0,
+}
+
+
+@dataclass
+class RotatedSession:
+    session_id: Optional[int]  # None when the row is written behind
+    user_id: int
+    username: str
+
+
+@dataclass
+class SessionRecord:
+    """
+    What the rt:{hash} key holds, as compact JSON:
+      {"u": user_id, "n": username, "e": expires_at (epoch s), "r": revoked 0/1, "a": user active 0/1}
+    """
+
+    user_id: int
+    username: str
+    expires_at: int
+    revoked: bool = False
+    active: bool = True
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {"u": self.user_id, "n": self.username, "e": self.expires_at, "r": int(self.revoked), "a": int(self.active)},
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def loads(cls, raw: str) -> "SessionRecord":
+        d = json.loads(raw)
+        return cls(user_id=d["u"], username=d["n"], expires_at=d["e"], revoked=bool(d["r"]), active=bool(d["a"]))
+
+
+def redis_key(token_hash: bytes) -> Union[str, bytes]:
+    """rt:{hash}: 64 hex chars, or the 32 raw bytes once lookups are binary."""
+    if TOKEN_LOOKUP_BINARY:
+        return b"rt:" + token_hash
+    return f"rt:{token_hash.hex()}"
+
+
+def user_sessions_key(user_id: int) -> str:
+    """SET of the token hashes (as in redis_key) of a user's live sessions (for revoke-all)."""
+    return f"user:{user_id}:sessions"
+
+
+async def cached_session_hashes(rds, user_id: int) -> Set[bytes]:
+    """
+    Digests in a user's session set. Read undecoded: binary members are not
+    UTF-8. Members of either format are accepted, so sets written before a
+    TOKEN_HASH_STORAGE switch still work.
+    """
+    members = await rds.execute_command("SMEMBERS", user_sessions_key(user_id), **{NEVER_DECODE: True})
+    return {digest_from_token_id(member) for member in members}
+
+
+def write_behind_enabled() -> bool:
+    """Configuration only; request paths also need available_redis_client() to be up."""
+    return SESSION_STORE == "database" and SESSION_DURABILITY == "async" and get_redis_client() is not None
+
+
+def _redis_failed() -> None:
+    SESSION_STATS["redis_fallbacks"] += 1
+    logger.warning("Session store: Redis call failed, continuing DB-only", exc_info=True)
+
+
+# token hash -> revoked_at, user id -> revoked_at. Only kept in write-behind
+# mode, where Redis records are authoritative: a revocation done DB-only
+# must still reach Redis, or the old record (or a not yet flushed session)
+# would stay valid there once Redis is back.
+_deferred_sessions: Dict[bytes, int] = {}
+_deferred_users: Dict[int, int] = {}
+_replay_tasks: Set[asyncio.Task] = set()
+
+
+def _defer_revocation(at: datetime, token_hash: Optional[bytes] = None, user_id: Optional[int] = None) -> None:
+    if not write_behind_enabled():
+        return
+    if len(_deferred_sessions) + len(_deferred_users) >= SESSION_DEFERRED_MAX:
+        SESSION_STATS["deferred_dropped"] += 1
+        return
+    if token_hash is not None:
+        _deferred_sessions[token_hash] = int(at.timestamp())
+    if user_id is not None:
+        _deferred_users[user_id] = int(at.timestamp())
+
+
+async def replay_deferred_revocations() -> None:
+    """DEL the records and queue the revocations that were done DB-only."""
+    if not (_deferred_sessions or _deferred_users):
+        return
+    sessions, users = dict(_deferred_sessions), dict(_deferred_users)
+    _deferred_sessions.clear()
+    _deferred_users.clear()
+    rds = get_redis_client()
+    try:
+        for user_id, at in users.items():
+            for token_hash in await cached_session_hashes(rds, user_id):
+                sessions.setdefault(token_hash, at)
+        async with rds.pipeline(transaction=True) as pipe:
+            for token_hash, at in sessions.items():
+                pipe.delete(redis_key(token_hash))
+                pipe.rpush(WRITE_BEHIND_QUEUE, _queue_entry("revoke", old=token_hash.hex(), at=at))
+            for user_id in users:
+                pipe.delete(user_sessions_key(user_id))
+            await pipe.execute()
+    except RedisError:
+        logger.warning("Replaying deferred session revocations failed; will retry", exc_info=True)
+        _deferred_sessions.update(sessions)
+        _deferred_users.update(users)
+        return
+    SESSION_STATS["deferred_replayed"] += len(sessions)
+
+
+def _schedule_replay() -> None:
+    task = asyncio.create_task(replay_deferred_revocations(), name="session-revocation-replay")
+    _replay_tasks.add(task)
+    task.add_done_callback(_replay_tasks.discard)
+
+
+redis_breaker.on_close(_schedule_replay)
+
+
+def _queue_entry(op: str, **fields) -> str:
+    return json.dumps({"op": op, **fields}, separators=(",", ":"))
+
+
+# KEYS: old key, new key, write-behind queue
+# ARGV: now, new hash, new expires_at, new ttl, tombstone ttl, old hash
+#       (hashes as set members), new hash hex, old hash hex (for the queue),
+#       "1" to queue the DB write (write-behind) / "0" (Redis-only store)
+# Returns {status, user_id, username}; status 1 = rotated, 0 = no record,
+# 2 = revoked, 3 = expired, 4 = user inactive.
+# The per-user session set key is derived from the record, so this assumes
+# a single Redis/Valkey node (not Cluster).
+_ROTATE_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then return {0} end
+local rec = cjson.decode(raw)
+if rec.r == 1 then return {2} end
+if rec.e <= tonumber(ARGV[1]) then
+  redis.call('DEL', KEYS[1])
+  return {3}
+end
+if rec.a ~= 1 then return {4} end
+rec.r = 1
+redis.call('SET', KEYS[1], cjson.encode(rec), 'EX', ARGV[5])
+local new = {u = rec.u, n = rec.n, e = tonumber(ARGV[3]), r = 0, a = 1}
+redis.call('SET', KEYS[2], cjson.encode(new), 'EX', ARGV[4])
+local uset = 'user:' .. rec.u .. ':sessions'
+redis.call('SREM', uset, ARGV[6])
+redis.call('SADD', uset, ARGV[2])
+redis.call('EXPIRE', uset, ARGV[4])
+if ARGV[9] == '1' then
+  redis.call('RPUSH', KEYS[3], cjson.encode({op = 'rotate', old = ARGV[8], new = ARGV[7], uid = rec.u, exp = tonumber(ARGV[3]), at = tonumber(ARGV[1])}))
+end
+return {1, rec.u, rec.n}
+"""
+
+_REJECTIONS = {
+    2: "Refresh token revoked",
+    3: "Refresh token expired",
+    4: "User not available",
+}
+
+
+async def create_session(
+    db: DbSession, user: User, token_hash: bytes, expires_at: datetime, ttl_seconds: int
+) -> None:
+    """Persist a new refresh session (login) and cache its record in Redis."""
+    record = SessionRecord(user.id, user.username, int(expires_at.timestamp()), active=user.is_active)
+    rds = available_redis_client()
+
+    if rds is not None and write_behind_enabled():
+        try:
+            async with rds.pipeline(transaction=True) as pipe:
+                pipe.set(redis_key(token_hash), record.dumps(), ex=ttl_seconds)
+                index_session(pipe, user.id, token_hash, ttl_seconds)
+                pipe.rpush(
+                    WRITE_BEHIND_QUEUE,
+                    _queue_entry("create", new=token_hash.hex(), uid=user.id, exp=record.expires_at),
+                )
+                await pipe.execute()
+            return
+        except RedisError:
+            # Write the row inline instead (a duplicate from a half-applied pipeline is ignored by the flusher)
+            _redis_failed()
+            rds = None
+
+    if SESSION_GROUP_COMMIT:
+        # Shares one multi-row INSERT + COMMIT with concurrent logins
+        await session_batcher.insert(user.id, token_hash, expires_at)
+    else:
+        db.add(RefreshSession(user_id=user.id, **token_columns(token_hash), expires_at=expires_at, revoked_at=None))
+        await db.commit()
+    if rds:
+        try:
+            async with rds.pipeline(transaction=True) as pipe:
+                pipe.set(redis_key(token_hash), record.dumps(), ex=ttl_seconds)
+                index_session(pipe, user.id, token_hash, ttl_seconds)
+                await pipe.execute()
+        except RedisError:
+            _redis_failed()  # the row is committed; refresh finds it in the DB
+
+
+def index_session(pipe, user_id: int, token_hash: bytes, ttl_seconds: int) -> None:
+    """Add a session to its user's set; the set lives as long as the newest session."""
+    pipe.sadd(user_sessions_key(user_id), token_id(token_hash))
+    pipe.expire(user_sessions_key(user_id), ttl_seconds)
+
+
+def _revoke_statement(old_hash: bytes, now: datetime):
+    """
+    UPDATE sessions SET revoked_at = now
+    WHERE token_hash = :old AND revoked_at IS NULL AND expires_at > now
+      AND user_id IN (SELECT id FROM users WHERE is_active)
+    RETURNING user_id, (SELECT username FROM users WHERE id = sessions.user_id)
+
+    Validity, revocation and the user's active flag are all checked by the
+    UPDATE itself, so there is no read-then-write window.
+    """
+    active_users = select(User.id).where(User.is_active.is_(True))
+    username = (
+        select(User.username)
+        .where(User.id == RefreshSession.user_id)
+        .correlate(RefreshSession)
+        .scalar_subquery()
+    )
+    return (
+        update(RefreshSession)
+        .where(
+            token_lookup_column() == token_id(old_hash),
+            RefreshSession.revoked_at.is_(None),
+            RefreshSession.expires_at > now,
+            RefreshSession.user_id.in_(active_users),
+        )
+        .values(revoked_at=now)
+        .returning(RefreshSession.user_id, username.label("username"))
+        # No ORM "fetch" sync: it adds sessions.id to RETURNING, which can
+        # shift the columns read back as user_id under concurrent first use
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def _rotate_single_statement(
+    db: DbSession, old_hash: bytes, new_hash: bytes, now: datetime, expires_at: datetime
+) -> Optional[RotatedSession]:
+    """PostgreSQL: revoke + insert in one round trip via data-modifying CTEs."""
+    old = _revoke_statement(old_hash, now).cte("old")
+    new_columns = token_columns(new_hash)
+    new = (
+        insert(RefreshSession)
+        .from_select(
+            ["user_id", *new_columns, "expires_at"],
+            select(
+                old.c.user_id,
+                *(literal(value) for value in new_columns.values()),
+                literal(expires_at, RefreshSession.expires_at.type),
+            ),
+        )
+        .returning(RefreshSession.id, RefreshSession.user_id)
+        .cte("new")
+    )
+    stmt = select(new.c.id, new.c.user_id, old.c.username).join_from(new, old, new.c.user_id == old.c.user_id)
+    row = (await db.execute(stmt)).first()
+    if row is None:
+        return None
+    return RotatedSession(session_id=row.id, user_id=row.user_id, username=row.username)
+
+
+async def _rotate_two_statements(
+    db: DbSession, old_hash: bytes, new_hash: bytes, now: datetime, expires_at: datetime
+) -> Optional[RotatedSession]:
+    """Other dialects (SQLite in tests/benchmarks): UPDATE ... RETURNING then INSERT ... RETURNING."""
+    row = (await db.execute(_revoke_statement(old_hash, now))).first()
+    if row is None:
+        return None
+    new_id = (
+        await db.execute(
+            insert(RefreshSession)
+            .values(user_id=row.user_id, **token_columns(new_hash), expires_at=expires_at)
+            .returning(RefreshSession.id)
+        )
+    ).scalar_one()
+    return RotatedSession(session_id=new_id, user_id=row.user_id, username=row.username)
+
+
+async def _rotation_failure(db: DbSession, old_hash: bytes, now: datetime) -> HTTPException:
+    """Cold path: work out why the rotation matched nothing, for a precise 401."""
+    session = await db.scalar(select(RefreshSession).where(token_lookup_column() == token_id(old_hash)))
+    if session is None:
+        return HTTPException(status_code=401, detail="Invalid refresh token")
+    if session.revoked_at is not None:
+        return HTTPException(status_code=401, detail="Refresh token revoked")
+    expires_at = session.expires_at
+    if expires_at.tzinfo is None:  # SQLite drops tzinfo
+        expires_at = expires_at.replace(tzinfo=now.tzinfo)
+    if expires_at <= now:
+        return HTTPException(status_code=401, detail="Refresh token expired")
+    return HTTPException(status_code=401, detail="User not available")
+
+
+async def rotate_in_redis(
+    rds,
+    old_hash: bytes,
+    new_hash: bytes,
+    now: datetime,
+    expires_at: datetime,
+    ttl_seconds: int,
+    queue: bool = True,
+) -> Optional[RotatedSession]:
+    """
+    Zero-DB rotation: one EVAL checks the old record, tombstones it, writes
+    the new record and (queue) queues the DB write. Returns None on a record miss.
+    """
+    script = rds.register_script(_ROTATE_LUA)
+    result = await script(
+        keys=[redis_key(old_hash), redis_key(new_hash), WRITE_BEHIND_QUEUE],
+        args=[
+            int(now.timestamp()),
+            token_id(new_hash),
+            int(expires_at.timestamp()),
+            ttl_seconds,
+            SESSION_TOMBSTONE_TTL,
+            token_id(old_hash),
+            new_hash.hex(),
+            old_hash.hex(),
+            "1" if queue else "0",
+        ],
+    )
+    status = int(result[0])
+    if status == 0:
+        return None
+    if status != 1:
+        SESSION_STATS["redis_rejections"] += 1
+        raise HTTPException(status_code=401, detail=_REJECTIONS[status])
+    SESSION_STATS["redis_rotations"] += 1
+    return RotatedSession(session_id=None, user_id=int(result[1]), username=result[2])
+
+
+async def rotate_refresh_session(
+    db: DbSession, old_hash: bytes, new_hash: bytes, now: datetime, expires_at: datetime, ttl_seconds: int
+) -> RotatedSession:
+    """
+    Revoke the old refresh session and create its replacement.
+
+    async durability with a Redis record: one Lua call, no database.
+    Otherwise (sync durability, or the record is gone): one DB transaction
+    (a single statement on PostgreSQL) + COMMIT, then one Redis pipeline
+    that tombstones the old record and writes the new one.
+
+    Raises HTTPException(401) if the old token is unknown, revoked, expired
+    or belongs to an inactive user; nothing is changed in that case.
+
+    Redis down (breaker open, or a call fails): the DB path alone.
+    """
+    rds = available_redis_client()
+    if rds is not None and write_behind_enabled():
+        try:
+            rotated = await rotate_in_redis(rds, old_hash, new_hash, now, expires_at, ttl_seconds)
+            if rotated is not None:
+                return rotated
+        except RedisError:
+            _redis_failed()
+            rds = None
+
+    if db.get_bind().dialect.name == "postgresql":
+        rotated = await _rotate_single_statement(db, old_hash, new_hash, now, expires_at)
+    else:
+        rotated = await _rotate_two_statements(db, old_hash, new_hash, now, expires_at)
+
+    if rotated is None:
+        error = await _rotation_failure(db, old_hash, now)
+        await db.rollback()
+        if error.detail == "Refresh token expired" and rds:
+            try:
+                await rds.delete(redis_key(old_hash))  # best-effort cleanup
+            except RedisError:
+                _redis_failed()
+        raise error
+
+    await db.commit()
+    SESSION_STATS["db_rotations"] += 1
+
+    if rds:
+        tombstone = SessionRecord(rotated.user_id, rotated.username, int(now.timestamp()), revoked=True)
+        record = SessionRecord(rotated.user_id, rotated.username, int(expires_at.timestamp()))
+        try:
+            async with rds.pipeline(transaction=True) as pipe:
+                pipe.set(redis_key(old_hash), tombstone.dumps(), ex=SESSION_TOMBSTONE_TTL)
+                pipe.set(redis_key(new_hash), record.dumps(), ex=ttl_seconds)
+                pipe.srem(user_sessions_key(rotated.user_id), token_id(old_hash))
+                index_session(pipe, rotated.user_id, new_hash, ttl_seconds)
+                await pipe.execute()
+        except RedisError:
+            _redis_failed()
+            rds = None
+    if rds is None:
+        _defer_revocation(now, token_hash=old_hash)
+
+    return rotated
+
+
+async def lookup_session(db: DbSession, token_hash: bytes) -> Optional[SessionRecord]:
+    """The session's record from Redis, else from the sessions row (None if unknown)."""
+    rds = available_redis_client()
+    if rds is not None:
+        try:
+            raw = await rds.get(redis_key(token_hash))
+            if raw is not None:
+                return SessionRecord.loads(raw)
+        except RedisError:
+            _redis_failed()
+
+    row = (
+        await db.execute(
+            select(RefreshSession.user_id, User.username, RefreshSession.expires_at, RefreshSession.revoked_at, User.is_active)
+            .join(User, User.id == RefreshSession.user_id)
+            .where(token_lookup_column() == token_id(token_hash))
+        )
+    ).first()
+    if row is None:
+        return None
+    expires_at = row.expires_at
+    if expires_at.tzinfo is None:  # SQLite drops tzinfo
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return SessionRecord(
+        user_id=row.user_id,
+        username=row.username,
+        expires_at=int(expires_at.timestamp()),
+        revoked=row.revoked_at is not None,
+        active=row.is_active,
+    )
+
+
+async def revoke_session(db: DbSession, token_hash: bytes, now: datetime) -> None:
+    """Logout: revoke one refresh session and tombstone its Redis record."""
+    rds = available_redis_client()
+    key = redis_key(token_hash)
+
+    if rds is not None and write_behind_enabled():
+        try:
+            raw = await rds.get(key)
+            if raw is not None:
+                record = SessionRecord.loads(raw)
+                record.revoked = True
+                async with rds.pipeline(transaction=True) as pipe:
+                    pipe.set(key, record.dumps(), ex=SESSION_TOMBSTONE_TTL)
+                    pipe.srem(user_sessions_key(record.user_id), token_id(token_hash))
+                    pipe.rpush(WRITE_BEHIND_QUEUE, _queue_entry("revoke", old=token_hash.hex(), at=int(now.timestamp())))
+                    await pipe.execute()
+                return
+        except RedisError:
+            _redis_failed()
+            rds = None
+
+    user_id = (
+        await db.execute(
+            update(RefreshSession)
+            .where(token_lookup_column() == token_id(token_hash), RefreshSession.revoked_at.is_(None))
+            .values(revoked_at=now)
+            .returning(RefreshSession.user_id)
+            .execution_options(synchronize_session=False)
+        )
+    ).scalar_one_or_none()
+    await db.commit()
+    if rds:
+        try:
+            async with rds.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                if user_id is not None:
+                    pipe.srem(user_sessions_key(user_id), token_id(token_hash))
+                await pipe.execute()
+        except RedisError:
+            _redis_failed()
+            rds = None
+    if rds is None:
+        # Possibly a session that only exists in Redis so far
+        _defer_revocation(now, token_hash=token_hash)
+
+
+async def revoke_all_sessions(db: DbSession, user_id: int, now: datetime) -> int:
+    """
+    Log a user out everywhere (password change, account disable).
+
+    One bulk UPDATE ... RETURNING the token hash, then one pipeline that DELs
+    every rt:{hash} key plus the user's session set. Hashes come from both
+    the DB and the Redis set, so sessions not yet written behind are
+    covered too: in write-behind mode their revocations are queued after
+    their creates, and the flusher applies them in that order.
+
+    Returns the number of sessions revoked (DB rows plus cached hashes).
+    """
+    rds = available_redis_client()
+    cached = set()
+    if rds:
+        try:
+            cached = await cached_session_hashes(rds, user_id)
+        except RedisError:
+            _redis_failed()
+            rds = None
+
+    revoked = [
+        digest_from_token_id(value)
+        for value in (
+            await db.execute(
+                update(RefreshSession)
+                .where(RefreshSession.user_id == user_id, RefreshSession.revoked_at.is_(None))
+                .values(revoked_at=now)
+                .returning(token_lookup_column())
+                .execution_options(synchronize_session=False)
+            )
+        ).scalars()
+    ]
+    await db.commit()
+
+    hashes = cached | set(revoked)
+    if rds and hashes:
+        try:
+            async with rds.pipeline(transaction=True) as pipe:
+                for chunk in _chunks(sorted(hashes), 1000):
+                    pipe.delete(*(redis_key(h) for h in chunk))
+                    if write_behind_enabled():
+                        at = int(now.timestamp())
+                        pipe.rpush(WRITE_BEHIND_QUEUE, *(_queue_entry("revoke", old=h.hex(), at=at) for h in chunk))
+                pipe.delete(user_sessions_key(user_id))
+                await pipe.execute()
+        except RedisError:
+            _redis_failed()
+            rds = None
+    if rds is None:
+        _defer_revocation(now, user_id=user_id)
+        for h in revoked:
+            _defer_revocation(now, token_hash=h)
+    SESSION_STATS["revoke_all"] += 1
+    return len(hashes)
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def session_stats() -> dict:
+    return {
+        "store": SESSION_STORE,
+        "durability": SESSION_DURABILITY,
+        **SESSION_STATS,
+        "deferred_revocations": len(_deferred_sessions) + len(_deferred_users),
+    }
@@ -0,0 +1,222 @@
+# @Time: 2/24/26 20:15
+# @Author: jie
+# @File: session_store.py
+# @Description: SessionStore interface and its database / Redis-only backends, picked by SESSION_STORE
+import logging
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+
+from app.core.redis_client import available_redis_client
+from app.db.database import DbSession
+from app.model.User import User
+from app.service import session_service
+from app.service.session_service import (
+    SESSION_STATS,
+    SESSION_STORE,
+    SESSION_TOMBSTONE_TTL,
+    RotatedSession,
+    SessionRecord,
+    cached_session_hashes,
+    index_session,
+    redis_key,
+    rotate_in_redis,
+    session_stats,
+    user_sessions_key,
+)
+from app.utils.hash import token_id
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORES = ("database", "redis", "memory")
+if SESSION_STORE not in SESSION_STORES:
+    raise ValueError(f"SESSION_STORE must be one of {', '.join(SESSION_STORES)}")
+
+
+class SessionStore(ABC):
+    """
+    Refresh-session persistence behind the auth routes.
+
+    Token hashes are raw SHA-256 digests (app.utils.hash.hash_refresh_token).
+    `db` is the request's session; stores that don't use the database
+    ignore it. rotate() raises HTTPException(401) with the same details
+    as the database store ("Invalid refresh token", "Refresh token
+    revoked", ...) and changes nothing in that case.
+    """
+
+    name: str
+
+    @abstractmethod
+    async def create(self, db: DbSession, user: User, token_hash: bytes, expires_at: datetime, ttl_seconds: int) -> None:
+        """New session at login."""
+
+    @abstractmethod
+    async def lookup(self, db: DbSession, token_hash: bytes) -> Optional[SessionRecord]:
+        """The session as stored (revoked and expired ones included while kept), or None."""
+
+    @abstractmethod
+    async def rotate(
+        self, db: DbSession, old_hash: bytes, new_hash: bytes, now: datetime, expires_at: datetime, ttl_seconds: int
+    ) -> RotatedSession:
+        """Revoke the old session and create its replacement, atomically."""
+
+    @abstractmethod
+    async def revoke(self, db: DbSession, token_hash: bytes, now: datetime) -> None:
+        """Logout; unknown or already revoked tokens are ignored."""
+
+    @abstractmethod
+    async def revoke_all(self, db: DbSession, user_id: int, now: datetime) -> int:
+        """Revoke every live session of a user; returns how many."""
+
+    def requires_redis(self) -> bool:
+        """Whether sessions are lost (not just slower) while Redis is down; /ready fails then."""
+        return False
+
+    def stats(self) -> dict:
+        return {"store": self.name}
+
+
+class DatabaseSessionStore(SessionStore):
+    """
+    Sessions table, with Redis as record cache (SESSION_DURABILITY=sync) or
+    as the write-behind buffer (async). See app.service.session_service.
+    """
+
+    name = "database"
+
+    async def create(self, db, user, token_hash, expires_at, ttl_seconds):
+        await session_service.create_session(db, user, token_hash, expires_at, ttl_seconds)
+
+    async def lookup(self, db, token_hash):
+        return await session_service.lookup_session(db, token_hash)
+
+    async def rotate(self, db, old_hash, new_hash, now, expires_at, ttl_seconds):
+        return await session_service.rotate_refresh_session(db, old_hash, new_hash, now, expires_at, ttl_seconds)
+
+    async def revoke(self, db, token_hash, now):
+        await session_service.revoke_session(db, token_hash, now)
+
+    async def revoke_all(self, db, user_id, now):
+        return await session_service.revoke_all_sessions(db, user_id, now)
+
+    def requires_redis(self) -> bool:
+        return session_service.write_behind_enabled()
+
+    def stats(self) -> dict:
+        return session_stats()
+
+
+def _unavailable(error: Optional[Exception] = None) -> HTTPException:
+    if error is not None:
+        logger.warning("Session store: Redis call failed", exc_info=error)
+    return HTTPException(status_code=503, detail="Session store unavailable")
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis records only (the rt:{hash} keys and user session sets the
+    database store caches), never written to the database. Sessions live
+    as long as Redis keeps them: run it with persistence (AOF) if a
+    restart must not log everyone out. While Redis is down, session calls
+    fail with 503.
+    """
+
+    name = "redis"
+
+    @staticmethod
+    def _client():
+        rds = available_redis_client()
+        if rds is None:
+            raise _unavailable()
+        return rds
+
+    async def create(self, db, user, token_hash, expires_at, ttl_seconds):
+        record = SessionRecord(user.id, user.username, int(expires_at.timestamp()), active=user.is_active)
+        rds = self._client()
+        try:
+            async with rds.pipeline(transaction=True) as pipe:
+                pipe.set(redis_key(token_hash), record.dumps(), ex=ttl_seconds)
+                index_session(pipe, user.id, token_hash, ttl_seconds)
+                await pipe.execute()
+        except RedisError as e:
+            raise _unavailable(e) from e
+
+    async def lookup(self, db, token_hash):
+        try:
+            raw = await self._client().get(redis_key(token_hash))
+        except RedisError as e:
+            raise _unavailable(e) from e
+        return None if raw is None else SessionRecord.loads(raw)
+
+    async def rotate(self, db, old_hash, new_hash, now, expires_at, ttl_seconds):
+        try:
+            rotated = await rotate_in_redis(
+                self._client(), old_hash, new_hash, now, expires_at, ttl_seconds, queue=False
+            )
+        except RedisError as e:
+            raise _unavailable(e) from e
+        if rotated is None:
+            raise HTTPException(status_code=401, detail="Invalid refresh token")
+        return rotated
+
+    async def revoke(self, db, token_hash, now):
+        rds = self._client()
+        key = redis_key(token_hash)
+        try:
+            raw = await rds.get(key)
+            if raw is None:
+                return
+            record = SessionRecord.loads(raw)
+            record.revoked = True
+            async with rds.pipeline(transaction=True) as pipe:
+                pipe.set(key, record.dumps(), ex=SESSION_TOMBSTONE_TTL)
+                pipe.srem(user_sessions_key(record.user_id), token_id(token_hash))
+                await pipe.execute()
+        except RedisError as e:
+            raise _unavailable(e) from e
+
+    async def revoke_all(self, db, user_id, now):
+        rds = self._client()
+        try:
+            hashes = await cached_session_hashes(rds, user_id)
+            async with rds.pipeline(transaction=True) as pipe:
+                for token_hash in hashes:
+                    pipe.delete(redis_key(token_hash))
+                pipe.delete(user_sessions_key(user_id))
+                await pipe.execute()
+        except RedisError as e:
+            raise _unavailable(e) from e
+        SESSION_STATS["revoke_all"] += 1
+        return len(hashes)
+
+    def requires_redis(self) -> bool:
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "store": self.name,
+            "redis_rotations": SESSION_STATS["redis_rotations"],
+            "redis_rejections": SESSION_STATS["redis_rejections"],
+            "revoke_all": SESSION_STATS["revoke_all"],
+        }
+
+
+def _build_session_store() -> SessionStore:
+    if SESSION_STORE == "redis":
+        if not os.getenv("REDIS_URL"):
+            raise ValueError("SESSION_STORE=redis needs REDIS_URL")
+        return RedisSessionStore()
+    if SESSION_STORE == "memory":
+        if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            raise ValueError("SESSION_STORE=memory keeps sessions in one process; set WEB_CONCURRENCY=1")
+        from app.service.memory_session_store import MemorySessionStore
+
+        return MemorySessionStore()
+    return DatabaseSessionStore()
+
+
+session_store = _build_session_store()
@@ -0,0 +1,172 @@
+# @Time: 2/08/26 20:30
+# @Author: jie
+# @File: session_sweeper.py
+# @Description: Background deletion of expired / long-revoked refresh sessions
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import delete, func, select, text, tuple_
+
+from app.db.database import DbSession, db_session_scope
+from app.model.RefreshSession import RefreshSession
+
+logger = logging.getLogger(__name__)
+
+# 0 disables the sweeper
+SESSION_SWEEP_INTERVAL_SECONDS = int(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", "300"))
+SESSION_SWEEP_BATCH = int(os.getenv("SESSION_SWEEP_BATCH", "500"))
+# Pause between batches so the sweep never competes with request traffic
+SESSION_SWEEP_PAUSE_MS = int(os.getenv("SESSION_SWEEP_PAUSE_MS", "50"))
+# Expired/revoked rows are kept this long (reuse of a recently rotated token
+# is still reported as "revoked" rather than "invalid")
+SESSION_SWEEP_RETENTION_SECONDS = int(os.getenv("SESSION_SWEEP_RETENTION_SECONDS", "86400"))
+
+# pg_try_advisory_xact_lock key; any constant unique to this job
+SWEEP_LOCK_KEY = 0x5E55_0001
+
+
+class SessionSweeper:
+    """
+    Deletes refresh sessions that expired, or were revoked, more than
+    SESSION_SWEEP_RETENTION_SECONDS ago.
+
+    - Two passes, each walking its own index (ix_sessions_expires_at,
+      ix_sessions_revoked_at) in keyset order: (column, id) > last seen.
+    - Every batch is one short DELETE ... WHERE id IN (SELECT ... LIMIT n)
+      transaction followed by a pause, so locks and WAL bursts stay small.
+    - PostgreSQL: each batch first takes pg_try_advisory_xact_lock. If
+      another worker holds it, this worker skips the run. The lock is tied
+      to the transaction, so a pooled connection never leaks it.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+        self.runs = 0
+        self.swept_expired = 0
+        self.swept_revoked = 0
+        self.skipped_locked = 0
+        self.errors = 0
+        self.last_run_seconds: Optional[float] = None
+        self.last_run_at: Optional[float] = None
+        self.table: dict = {}
+
+    def start(self) -> None:
+        if self._task is None and SESSION_SWEEP_INTERVAL_SECONDS > 0 and os.getenv("DATABASE_URL"):
+            self._task = asyncio.create_task(self._run(), name="session-sweeper")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("Session sweep failed")
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+
+    @staticmethod
+    async def _try_lock(db: DbSession) -> bool:
+        if db.get_bind().dialect.name != "postgresql":
+            return True  # SQLite & co: single process, nothing to coordinate
+        return bool(await db.scalar(select(func.pg_try_advisory_xact_lock(SWEEP_LOCK_KEY))))
+
+    async def _sweep_column(self, column, cutoff: datetime) -> Optional[int]:
+        """Delete rows with column < cutoff in keyset-ordered batches. None if locked out."""
+        sessions = RefreshSession.__table__
+        last = None
+        total = 0
+        while True:
+            batch = select(sessions.c.id).where(column < cutoff)
+            if last is not None:
+                batch = batch.where(tuple_(column, sessions.c.id) > tuple_(*last))
+            batch = batch.order_by(column, sessions.c.id).limit(SESSION_SWEEP_BATCH)
+
+            async with db_session_scope() as db:
+                if not await self._try_lock(db):
+                    await db.rollback()
+                    return None
+                rows = (
+                    await db.execute(
+                        delete(sessions).where(sessions.c.id.in_(batch)).returning(column, sessions.c.id)
+                    )
+                ).all()
+                await db.commit()
+
+            total += len(rows)
+            if len(rows) < SESSION_SWEEP_BATCH:
+                return total
+            last = max(tuple(row) for row in rows)
+            await asyncio.sleep(SESSION_SWEEP_PAUSE_MS / 1000)
+
+    async def sweep_once(self) -> int:
+        """One full sweep. Returns the number of rows deleted."""
+        start = time.perf_counter()
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_SWEEP_RETENTION_SECONDS)
+
+        expired = await self._sweep_column(RefreshSession.__table__.c.expires_at, cutoff)
+        revoked = None
+        if expired is not None:
+            revoked = await self._sweep_column(RefreshSession.__table__.c.revoked_at, cutoff)
+        if expired is None or revoked is None:
+            self.skipped_locked += 1
+
+        self.swept_expired += expired or 0
+        self.swept_revoked += revoked or 0
+        self.runs += 1
+        self.last_run_seconds = round(time.perf_counter() - start, 3)
+        self.last_run_at = time.time()
+        self.table = await self.table_stats()
+        return (expired or 0) + (revoked or 0)
+
+    @staticmethod
+    async def table_stats() -> dict:
+        """Row estimate and on-disk size of the sessions table (incl. indexes)."""
+        async with db_session_scope() as db:
+            if db.get_bind().dialect.name == "postgresql":
+                row = (
+                    await db.execute(
+                        text(
+                            "SELECT c.reltuples::bigint AS rows, pg_total_relation_size(c.oid) AS bytes "
+                            "FROM pg_class c WHERE c.oid = to_regclass(:name)"
+                        ),
+                        {"name": RefreshSession.__tablename__},
+                    )
+                ).first()
+                if row is None:
+                    return {}
+                # reltuples is -1 until the table has been vacuumed/analyzed once
+                return {"rows_estimate": row.rows if row.rows >= 0 else None, "total_bytes": row.bytes}
+            rows = await db.scalar(select(func.count()).select_from(RefreshSession.__table__))
+            return {"rows_estimate": rows, "total_bytes": None}
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "runs": self.runs,
+            "swept_expired": self.swept_expired,
+            "swept_revoked": self.swept_revoked,
+            "skipped_locked": self.skipped_locked,
+            "errors": self.errors,
+            "last_run_seconds": self.last_run_seconds,
+            "last_run_age_seconds": round(time.time() - self.last_run_at, 3) if self.last_run_at else None,
+            "table": self.table,
+        }
+
+
+session_sweeper = SessionSweeper()
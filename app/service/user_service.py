@@ -0,0 +1,187 @@
+# @Time: 2/15/26 20:40
+# @Author: jie
+# @File: user_service.py
+# @Description: User registration persistence, the taken-username filter, password rehashing and deactivation
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Set
+
+from redis.exceptions import RedisError
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.core.redis_client import available_redis_client
+from app.core.security import password_engine
+from app.db.database import DbSession, db_session_scope, insert_ignore
+from app.model.User import User
+from app.service.refresh_singleflight import refresh_flights
+from app.service.session_store import session_store
+
+logger = logging.getLogger(__name__)
+
+# Strong references: the event loop only keeps weak ones to running tasks
+_background_tasks: Set[asyncio.Task] = set()
+
+# Redis set of usernames known to exist. Only ever a positive filter: a
+# name missing from it (not seeded yet, Redis flushed) may still be taken,
+# which the INSERT ... ON CONFLICT catches. It holds each existing name
+# once (SADD), so it is as large as the users table: roughly 60 bytes plus
+# the name per user.
+TAKEN_USERNAMES_KEY = "users:taken"
+# Written once every existing name has been copied in; gone with the dataset
+TAKEN_USERNAMES_SEEDED_KEY = "users:taken:seeded"
+TAKEN_USERNAMES_SEED_LOCK_KEY = "users:taken:seeding"
+TAKEN_USERNAMES_SEED_BATCH = 1000
+TAKEN_USERNAMES_SEED_LOCK_SECONDS = 300
+
+
+async def username_taken(db: DbSession, username: str) -> bool:
+    """
+    Cheap pre-bcrypt duplicate check.
+
+    With Redis: one SISMEMBER, no DB. Without Redis: an indexed SELECT,
+    and the transaction is ended again so no connection is held while
+    the caller hashes. Redis down: the SELECT too.
+    """
+    rds = available_redis_client()
+    if rds is not None:
+        try:
+            return bool(await rds.sismember(TAKEN_USERNAMES_KEY, username))
+        except RedisError:
+            logger.warning("Username filter unavailable, checking the DB", exc_info=True)
+    exists = (await db.execute(select(User.id).where(User.username == username))).first()
+    await db.commit()
+    return exists is not None
+
+
+async def mark_username_taken(username: str) -> None:
+    rds = available_redis_client()
+    if rds is not None:
+        try:
+            await rds.sadd(TAKEN_USERNAMES_KEY, username)
+        except RedisError:
+            # Only a pre-check; the unique constraint still rejects the duplicate
+            logger.warning("Could not add %r to the username filter", username, exc_info=True)
+
+
+async def seed_taken_usernames(batch: int = TAKEN_USERNAMES_SEED_BATCH) -> int:
+    """
+    Copy the usernames of existing users into the filter (startup, in the
+    background). Returns the number of names copied.
+
+    Once per Redis dataset: skipped when the seeded marker exists, or while
+    another worker holds the seed lock. SADD makes a rerun harmless, and the
+    marker is only set after the last batch, so an interrupted seed starts
+    over on the next start.
+    """
+    rds = available_redis_client()
+    if rds is None:
+        return 0
+    copied = 0
+    try:
+        if await rds.exists(TAKEN_USERNAMES_SEEDED_KEY):
+            return 0
+        if not await rds.set(TAKEN_USERNAMES_SEED_LOCK_KEY, "1", nx=True, ex=TAKEN_USERNAMES_SEED_LOCK_SECONDS):
+            return 0
+        last_id = 0
+        while True:
+            async with db_session_scope() as db:
+                rows = (
+                    await db.execute(
+                        select(User.id, User.username).where(User.id > last_id).order_by(User.id).limit(batch)
+                    )
+                ).all()
+            if not rows:
+                break
+            await rds.sadd(TAKEN_USERNAMES_KEY, *(row.username for row in rows))
+            copied += len(rows)
+            last_id = rows[-1].id
+        async with rds.pipeline(transaction=True) as pipe:
+            pipe.set(TAKEN_USERNAMES_SEEDED_KEY, "1")
+            pipe.delete(TAKEN_USERNAMES_SEED_LOCK_KEY)
+            await pipe.execute()
+    except Exception:
+        # Includes DB errors; the filter is only an optimisation
+        logger.warning("Seeding the username filter stopped after %d names; retried on next start", copied, exc_info=True)
+        return copied
+    logger.info("Username filter seeded with %d existing names", copied)
+    return copied
+
+
+def seed_taken_usernames_in_background() -> None:
+    task = asyncio.create_task(seed_taken_usernames(), name="username-filter-seed")
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def insert_user(db: DbSession, username: str, password_hash: str) -> Optional[int]:
+    """
+    INSERT ... ON CONFLICT (username) DO NOTHING RETURNING id, then COMMIT.
+
+    Returns the new id, or None if the username already exists (including
+    a concurrent registration of the same name). Either way the name is
+    added to the taken-username filter.
+    """
+    stmt = (
+        insert_ignore(User.__table__, db.get_bind().dialect.name, ["username"])
+        .values(username=username, password_hash=password_hash, is_active=True)
+        .returning(User.__table__.c.id)
+    )
+    try:
+        user_id = (await db.execute(stmt)).scalar_one_or_none()
+        await db.commit()
+    except IntegrityError:  # dialects without ON CONFLICT
+        await db.rollback()
+        user_id = None
+    await mark_username_taken(username)
+    return user_id
+
+
+async def deactivate_user(db: DbSession, user_id: int) -> int:
+    """
+    Disable an account and log it out everywhere. Returns the sessions revoked.
+
+    Use this rather than a bare UPDATE: cached session records carry the
+    active flag they had at login, and with SESSION_DURABILITY=async a
+    refresh is served from them without reading the users table.
+    """
+    users = User.__table__
+    await db.execute(update(users).where(users.c.id == user_id).values(is_active=False))
+    await db.commit()
+    revoked = await session_store.revoke_all(db, user_id, datetime.now(timezone.utc))
+    await refresh_flights.forget_user(user_id)
+    return revoked
+
+
+async def _rehash_password(user_id: int, old_hash: str, password: str) -> None:
+    try:
+        new_hash = await password_engine.hash(password)
+        users = User.__table__
+        async with db_session_scope() as db:
+            # Compare-and-set: a password changed meanwhile is left alone
+            await db.execute(
+                update(users)
+                .where(users.c.id == user_id, users.c.password_hash == old_hash)
+                .values(password_hash=new_hash)
+            )
+            await db.commit()
+        password_engine.rehashes += 1
+    except Exception:
+        # Includes 503 from a saturated pool; the next login tries again
+        password_engine.rehash_failures += 1
+        logger.warning("Password rehash failed for user %s", user_id, exc_info=True)
+
+
+def rehash_password_in_background(user_id: int, old_hash: str, password: str) -> None:
+    """
+    Re-hash at the current bcrypt cost after a successful login, off the
+    request path. Skipped while the pool has no idle worker, so it never
+    queues ahead of a live request.
+    """
+    if not password_engine.has_spare_capacity():
+        password_engine.rehash_skipped += 1
+        return
+    task = asyncio.create_task(_rehash_password(user_id, old_hash, password), name="password-rehash")
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
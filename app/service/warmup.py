@@ -0,0 +1,134 @@
+# @Time: 2/14/26 20:15
+# @Author: jie
+# @File: warmup.py
+# @Description: Opt-in lifespan warm-up of pools, crypto and routes
+import asyncio
+import logging
+import os
+import time
+from contextlib import AsyncExitStack
+from typing import Awaitable, Callable, Dict, Union
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from app.core.http_metrics import WARM_UP_SCOPE_KEY
+from app.core.jwt import create_access_token, decode_and_verify
+from app.core.redis_client import get_redis_client
+from app.core.security import password_engine
+from app.db.database import DB_ASYNC_MODE, get_async_engine, get_engine
+from app.db.pool import DB_POOL_SIZE
+
+# uvicorn configures this logger; app.* loggers are not configured at INFO
+logger = logging.getLogger("uvicorn.error")
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "false").lower() == "true"
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", str(DB_POOL_SIZE)))
+WARMUP_REDIS_CONNECTIONS = int(os.getenv("WARMUP_REDIS_CONNECTIONS", "4"))
+
+_WARMUP_PASSWORD = "warm-up-password"
+
+
+async def _warm_db() -> None:
+    """Open N connections at once so the pool holds N idle ones afterwards."""
+    if DB_ASYNC_MODE:
+        engine = get_async_engine()
+        if engine is None:
+            return
+        async with AsyncExitStack() as stack:
+            conns = [await stack.enter_async_context(engine.connect()) for _ in range(WARMUP_DB_CONNECTIONS)]
+            await asyncio.gather(*(conn.execute(text("SELECT 1")) for conn in conns))
+        return
+
+    engine = get_engine()
+    if engine is None:
+        return
+
+    def _open():
+        conns = [engine.connect() for _ in range(WARMUP_DB_CONNECTIONS)]
+        try:
+            for conn in conns:
+                conn.execute(text("SELECT 1"))
+        finally:
+            for conn in conns:
+                conn.close()
+
+    await run_in_threadpool(_open)
+
+
+async def _warm_redis() -> None:
+    rds = get_redis_client()
+    if rds is None:
+        return
+    # Concurrent commands each check out their own pooled connection
+    await asyncio.gather(*(rds.ping() for _ in range(WARMUP_REDIS_CONNECTIONS)))
+
+
+async def _warm_bcrypt() -> None:
+    """Start every pool process (spawn + passlib backend import) with one hash and N verifies."""
+    password_hash = await password_engine.hash(_WARMUP_PASSWORD)
+    await asyncio.gather(
+        *(password_engine.verify(_WARMUP_PASSWORD, password_hash) for _ in range(password_engine.workers))
+    )
+
+
+async def _warm_jwt() -> None:
+    decode_and_verify(create_access_token("warm-up"))
+
+
+async def _warm_routes(app: FastAPI) -> None:
+    """
+    One synthetic request per route, in-process. POST routes get an empty
+    body, so they stop at validation (422) or the missing-cookie check and
+    never write anything; the point is building the validators and
+    serializers, not succeeding. They are flagged in the ASGI scope so the
+    request metrics skip them.
+    """
+
+    async def warm_up_app(scope, receive, send):
+        await app(dict(scope, **{WARM_UP_SCOPE_KEY: True}), receive, send)
+
+    transport = httpx.ASGITransport(app=warm_up_app)
+    # The OpenAPI paths are the public view of every route (and building them is itself a cold cost)
+    paths = app.openapi()["paths"]
+    async with httpx.AsyncClient(transport=transport, base_url="http://warm-up.local") as client:
+        for path, operations in paths.items():
+            if "{" in path:
+                continue
+            if "get" in operations:
+                await client.get(path)
+            elif "post" in operations:
+                await client.post(path, json={})
+
+
+async def warm_up(app: FastAPI) -> Dict[str, Union[float, str]]:
+    """
+    Run every warm-up step and return {step: milliseconds or "error: ..."}.
+
+    A failing step is logged and skipped; dependency health is /ready's job.
+    """
+    steps: Dict[str, Callable[[], Awaitable[None]]] = {
+        "db": _warm_db,
+        "redis": _warm_redis,
+        "bcrypt": _warm_bcrypt,
+        "jwt": _warm_jwt,
+        "routes": lambda: _warm_routes(app),
+    }
+    timings: Dict[str, Union[float, str]] = {}
+    start = time.perf_counter()
+    for name, step in steps.items():
+        step_start = time.perf_counter()
+        try:
+            await step()
+            timings[name] = round((time.perf_counter() - step_start) * 1000, 1)
+        except Exception as e:
+            logger.exception("Warm-up step %r failed", name)
+            timings[name] = f"error: {e}"
+    timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(
+        "Warm-up finished: %s",
+        ", ".join(f"{k}={v}ms" if isinstance(v, float) else f"{k}={v}" for k, v in timings.items()),
+    )
+    return timings
@@ -1,18 +1,63 @@
 # @Time: 1/29/26 22:35
 # @Author: jie
 # @File: hash.py
-# @Description:
+# @Description: Refresh-token generation/hashing and how the hash is stored in Postgres and Redis
 import hashlib
+import os
 import secrets
 import time
+from typing import Dict, Union
 
 REFRESH_TTL_SECONDS = 7 * 24 * 60 * 60
 
+# How refresh-token hashes are stored, "<lookup>[+<also written>]":
+#   hex          64-char hex in sessions.token_hash, "rt:<hex>" Redis keys
+#   hex+binary   also writes the raw digest to sessions.token_digest
+#   binary+hex   looks up by token_digest, raw-digest Redis keys; still writes token_hash
+#   binary       32-byte digest only (BYTEA column, binary Redis keys/set members)
+# Move through them in this order, one rolling deploy each (README: "Binary token hashes").
+TOKEN_HASH_STORAGE = os.getenv("TOKEN_HASH_STORAGE", "hex")
+TOKEN_HASH_STORAGES = ("hex", "hex+binary", "binary+hex", "binary")
+if TOKEN_HASH_STORAGE not in TOKEN_HASH_STORAGES:
+    raise ValueError(f"TOKEN_HASH_STORAGE must be one of {', '.join(TOKEN_HASH_STORAGES)}")
+
+TOKEN_LOOKUP_BINARY = TOKEN_HASH_STORAGE.startswith("binary")
+WRITES_TOKEN_HASH = TOKEN_HASH_STORAGE != "binary"
+WRITES_TOKEN_DIGEST = TOKEN_HASH_STORAGE != "hex"
+
+TokenId = Union[str, bytes]
+
+
 def generate_refresh_token() -> str:
     return secrets.token_urlsafe(32)  # plain token stored in cookie
 
-def hash_refresh_token(token: str) -> str:
-    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def hash_refresh_token(token: str) -> bytes:
+    """Raw SHA-256 digest; every store encodes it through token_id / token_columns."""
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def token_id(digest: bytes) -> TokenId:
+    """The digest as looked up: the sessions lookup column, Redis keys and set members."""
+    return digest if TOKEN_LOOKUP_BINARY else digest.hex()
+
+
+def token_columns(digest: bytes) -> Dict[str, TokenId]:
+    """Values for every token column written in this phase."""
+    columns: Dict[str, TokenId] = {}
+    if WRITES_TOKEN_HASH:
+        columns["token_hash"] = digest.hex()
+    if WRITES_TOKEN_DIGEST:
+        columns["token_digest"] = digest
+    return columns
+
+
+def digest_from_token_id(value: TokenId) -> bytes:
+    """Inverse of token_id in either format (hex str/bytes, or the raw digest)."""
+    if isinstance(value, str):
+        return bytes.fromhex(value)
+    return bytes.fromhex(value.decode()) if len(value) == 64 else bytes(value)
+
 
 def now_ts() -> int:
-    return int(time.time())
\ No newline at end of file
+    return int(time.time())
@@ -0,0 +1,239 @@
+# @Time: 2/11/26 20:30
+# @Author: jie
+# @File: auth_bench.py
+# @Description: End-to-end auth hot-path benchmark against the in-process ASGI app
+"""
+Drives /register, /login, /refresh, /metrics and /logout through
+httpx.ASGITransport (no sockets, no uvicorn), with N concurrent virtual users.
+
+Runs offline:
+- DATABASE_URL defaults to a throwaway SQLite file (pass --database-url for Postgres)
+- REDIS_URL is served by an in-process fakeredis server (--redis none to run without Redis)
+
+Usage:
+    python -m benchmarks.auth_bench --concurrency 32 --iterations 5 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+
+SQLite in async mode needs aiosqlite (without it the run falls back to
+DB_ASYNC_MODE=false), the Redis stand-in needs fakeredis + lupa; both come
+with the dev dependency group (uv sync), neither is an app dependency.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List
+
+# Env knobs the run depends on; recorded in the results so runs are comparable
+RECORDED_ENV = (
+    "DB_ASYNC_MODE",
+    "DB_POOL_SIZE",
+    "DB_MAX_OVERFLOW",
+    "PASSWORD_POOL_WORKERS",
+    "SESSION_STORE",
+    "SESSION_DURABILITY",
+    "SESSION_GROUP_COMMIT",
+    "JWT_CACHE_MAX_BYTES",
+)
+
+LOOP_LAG_INTERVAL = 0.01
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize(samples: List[float], errors: int, wall_seconds: float) -> dict:
+    ordered = sorted(samples)
+    ms = lambda v: round(v * 1000, 3)  # noqa: E731
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "rps": round(len(ordered) / wall_seconds, 2) if wall_seconds else 0.0,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1]) if ordered else 0.0,
+    }
+
+
+def _configure_env(args) -> None:
+    """Must run before anything under app/ is imported: config is read at import time."""
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp(prefix='auth-bench-')}/bench.db"
+        if os.getenv("DB_ASYNC_MODE", "true").lower() == "true":
+            try:
+                import aiosqlite  # noqa: F401
+            except ImportError:
+                os.environ["DB_ASYNC_MODE"] = "false"
+    os.environ.setdefault("JWT_SECRET", "bench-" + "x" * 32)
+    os.environ.setdefault("SESSION_SWEEP_INTERVAL_SECONDS", "0")
+    # Every virtual user shares one client IP
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+    if args.redis == "fake":
+        import fakeredis
+        import redis.asyncio
+
+        server = fakeredis.FakeServer()
+        # get_redis_client() goes through redis.asyncio.from_url
+        redis.asyncio.from_url = lambda url, **kw: fakeredis.FakeAsyncRedis(server=server, **kw)
+        os.environ["REDIS_URL"] = "redis://bench-stand-in"
+        # fakeredis answers the client's PING health check in a form it rejects
+        os.environ.setdefault("REDIS_HEALTH_CHECK_INTERVAL", "0")
+    elif args.redis == "none":
+        os.environ["REDIS_URL"] = ""
+    else:
+        os.environ["REDIS_URL"] = args.redis
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def call(self, client, method: str, path: str, expected: int = 200, **kwargs):
+        start = time.perf_counter()
+        resp = await client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - start
+        if resp.status_code == expected:
+            self.samples[path].append(elapsed)
+        else:
+            self.errors[path] += 1
+        return resp
+
+
+async def _loop_lag(stop: asyncio.Event, lags: List[float]) -> None:
+    """How late the loop wakes a sleeper: time the loop spent busy elsewhere."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL))
+
+
+async def _virtual_user(transport, recorder: Recorder, user_id: int, args) -> None:
+    import httpx
+
+    username, password = f"bench_{user_id}_{os.getpid()}", "bench-password"
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench.local") as client:
+        await recorder.call(client, "POST", "/register", json={"username": username, "password": password})
+        for _ in range(args.iterations):
+            resp = await recorder.call(client, "POST", "/login", json={"username": username, "password": password})
+            if resp.status_code != 200:
+                continue
+            access = resp.json()["access_token"]
+            for _ in range(args.refreshes):
+                resp = await recorder.call(client, "POST", "/refresh")
+                if resp.status_code == 200:
+                    access = resp.json()["access_token"]
+            await recorder.call(client, "GET", "/metrics", headers={"Authorization": f"Bearer {access}"})
+            await recorder.call(client, "POST", "/logout")
+
+
+async def run(args) -> dict:
+    import httpx
+
+    from app import model  # noqa: F401  (register tables on Base.metadata)
+    from app.db import Base, get_engine
+    from app.main import app
+
+    engine = get_engine()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    recorder, lags = Recorder(), []
+    stop = asyncio.Event()
+    transport = httpx.ASGITransport(app=app)
+
+    async with app.router.lifespan_context(app):
+        lag_task = asyncio.create_task(_loop_lag(stop, lags))
+        start = time.perf_counter()
+        await asyncio.gather(*(_virtual_user(transport, recorder, i, args) for i in range(args.concurrency)))
+        wall = time.perf_counter() - start
+        stop.set()
+        await lag_task
+
+    endpoints = {
+        path: summarize(recorder.samples[path], recorder.errors[path], wall)
+        for path in sorted(set(recorder.samples) | set(recorder.errors))
+    }
+    everything = [s for samples in recorder.samples.values() for s in samples]
+    lags.sort()
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "concurrency": args.concurrency,
+            "iterations": args.iterations,
+            "refreshes": args.refreshes,
+            "database": engine.dialect.name,
+            "redis": args.redis if args.redis in ("fake", "none") else "external",
+            "env": {name: os.getenv(name) for name in RECORDED_ENV if os.getenv(name) is not None},
+        },
+        "wall_seconds": round(wall, 3),
+        "total": summarize(everything, sum(recorder.errors.values()), wall),
+        "endpoints": endpoints,
+        "loop_lag_ms": {
+            "p50": round(percentile(lags, 50) * 1000, 3),
+            "p99": round(percentile(lags, 99) * 1000, 3),
+            "max": round(lags[-1] * 1000, 3) if lags else 0.0,
+        },
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def _print_table(results: dict) -> None:
+    print(f"{'endpoint':<12}{'count':>8}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for path, s in {**results["endpoints"], "TOTAL": results["total"]}.items():
+        print(
+            f"{path:<12}{s['count']:>8}{s['errors']:>6}{s['rps']:>10}"
+            f"{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}"
+        )
+    lag = results["loop_lag_ms"]
+    print(f"event loop lag ms: p50 {lag['p50']}  p99 {lag['p99']}  max {lag['max']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=3, help="login/refresh/metrics/logout cycles per user")
+    parser.add_argument("--refreshes", type=int, default=5, help="refresh calls per cycle")
+    parser.add_argument(
+        "--database-url", default="", help="default: throwaway SQLite file. Tables are DROPPED: never point at real data"
+    )
+    parser.add_argument("--redis", default="fake", help="'fake' (in-process), 'none', or a redis:// URL")
+    parser.add_argument("--output", help="write JSON results here")
+    args = parser.parse_args(argv)
+
+    _configure_env(args)
+    results = asyncio.run(run(args))
+    _print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if results["total"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
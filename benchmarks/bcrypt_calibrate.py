@@ -0,0 +1,34 @@
+# @Time: 2/18/26 20:40
+# @Author: jie
+# @File: bcrypt_calibrate.py
+# @Description: On-demand bcrypt cost calibration for this host
+"""
+Benchmark bcrypt on this host and print the BCRYPT_ROUNDS that fits a target
+verify time (the same calculation BCRYPT_TARGET_MS runs at startup).
+
+    python -m benchmarks.bcrypt_calibrate --target-ms 250
+
+Run it on the instance type you deploy to, with the box otherwise idle, and
+pin the result with BCRYPT_ROUNDS so every host hashes at the same cost.
+"""
+import argparse
+import sys
+
+from app.core.security import BCRYPT_MAX_ROUNDS, BCRYPT_MIN_ROUNDS, calibrate_bcrypt_rounds
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target-ms", type=float, default=250, help="budget for one verify")
+    parser.add_argument("--min-rounds", type=int, default=BCRYPT_MIN_ROUNDS)
+    parser.add_argument("--max-rounds", type=int, default=BCRYPT_MAX_ROUNDS)
+    parser.add_argument("--samples", type=int, default=5, help="verifies timed (best one counts)")
+    args = parser.parse_args(argv)
+
+    rounds, verify_ms = calibrate_bcrypt_rounds(args.target_ms, args.min_rounds, args.max_rounds, args.samples)
+    print(f"BCRYPT_ROUNDS={rounds}  (~{verify_ms} ms per verify, target {args.target_ms} ms)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+# @Time: 2/11/26 21:15
+# @Author: jie
+# @File: compare.py
+# @Description: Regression gate between two auth_bench result files
+"""
+Compare a benchmark run against a baseline and fail on regressions.
+
+    python -m benchmarks.compare baseline.json current.json --max-regression 0.15
+
+An endpoint regresses when its p95 or p99 latency grows, or its throughput
+drops, by more than --max-regression (relative). Any request errors in the
+current run also fail the gate. Exit code 1 on failure.
+"""
+import argparse
+import json
+import sys
+from typing import List
+
+# (metric, higher_is_better)
+GATED_METRICS = (("p95_ms", False), ("p99_ms", False), ("rps", True))
+
+
+def compare(baseline: dict, current: dict, max_regression: float) -> List[str]:
+    failures = []
+    for path, base in baseline["endpoints"].items():
+        cur = current["endpoints"].get(path)
+        if cur is None:
+            failures.append(f"{path}: missing from current run")
+            continue
+        for metric, higher_is_better in GATED_METRICS:
+            before, after = base[metric], cur[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > max_regression else ""
+            print(f"{path:<12}{metric:<8}{before:>12}{after:>12}{change:>+10.1%}  {flag}")
+            if flag:
+                failures.append(f"{path} {metric}: {before} -> {after} ({change:+.1%})")
+    if current["total"]["errors"]:
+        failures.append(f"{current['total']['errors']} failed requests in current run")
+    return failures
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--max-regression", type=float, default=0.15, help="allowed relative slowdown (0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    if baseline["meta"].get("database") != current["meta"].get("database"):
+        print("warning: runs used different databases; comparison is not meaningful", file=sys.stderr)
+    failures = compare(baseline, current, args.max_regression)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
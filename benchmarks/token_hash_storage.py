@@ -0,0 +1,135 @@
+# @Time: 2/21/26 21:10
+# @Author: jie
+# @File: token_hash_storage.py
+# @Description: Postgres index / Redis memory of hex vs binary refresh-token hashes
+"""
+Measure what TOKEN_HASH_STORAGE=binary saves at given session counts.
+
+    python -m benchmarks.token_hash_storage --sessions 100000,1000000 \\
+        --database-url postgresql+psycopg://... [--redis redis://localhost:6379/15]
+
+Postgres: two TEMP tables shaped like `sessions` (hex VARCHAR vs BYTEA token
+column, each with its unique index), filled in random hash order the way
+logins fill them. Reported: unique index as grown by inserts, the same index
+freshly rebuilt (REINDEX), and the heap.
+
+Redis (optional; uses and then deletes `bench:` keys, so point it at a
+scratch database): per-session record keys and per-user session sets, read
+with MEMORY USAGE.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+
+SESSIONS_PER_USER = 3
+REDIS_SAMPLE = 10000
+
+
+def _mb(n: int) -> str:
+    return f"{n / 2**20:8.1f} MB"
+
+
+def measure_postgres(url: str, sessions: int) -> dict:
+    engine = create_engine(url)
+    sizes = {}
+    with engine.connect() as conn:
+        for layout, column, value in (
+            ("hex", "token_hash VARCHAR(255)", "encode(sha256(i::text::bytea), 'hex')"),
+            ("binary", "token_digest BYTEA", "sha256(i::text::bytea)"),
+        ):
+            table = f"bench_sessions_{layout}"
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            conn.execute(
+                text(
+                    f"CREATE TEMP TABLE {table} (id SERIAL PRIMARY KEY, user_id INTEGER NOT NULL, "
+                    f"{column} NOT NULL UNIQUE, expires_at TIMESTAMPTZ NOT NULL, "
+                    "revoked_at TIMESTAMPTZ, created_at TIMESTAMPTZ DEFAULT now())"
+                )
+            )
+            # sha256 order is random, like real token hashes arriving at login
+            conn.execute(
+                text(
+                    f"INSERT INTO {table} (user_id, {column.split()[0]}, expires_at) "
+                    f"SELECT i / {SESSIONS_PER_USER}, {value}, now() + interval '7 days' "
+                    "FROM generate_series(1, :n) i"
+                ),
+                {"n": sessions},
+            )
+            index = f"{table}_{column.split()[0]}_key"
+            grown = conn.scalar(text("SELECT pg_relation_size(CAST(:i AS regclass))"), {"i": index})
+            conn.execute(text(f"REINDEX INDEX {index}"))
+            rebuilt = conn.scalar(text("SELECT pg_relation_size(CAST(:i AS regclass))"), {"i": index})
+            heap = conn.scalar(text("SELECT pg_relation_size(CAST(:t AS regclass))"), {"t": table})
+            sizes[layout] = {"index": grown, "index_rebuilt": rebuilt, "heap": heap}
+            conn.execute(text(f"DROP TABLE {table}"))
+    engine.dispose()
+    return sizes
+
+
+async def measure_redis(url: str) -> dict:
+    """Bytes per session (record key + set member), from a sample scaled by MEMORY USAGE."""
+    import hashlib
+
+    import redis.asyncio as redis
+
+    client = redis.from_url(url)
+    record = json.dumps({"u": 1, "n": "someuser", "e": 1900000000, "r": 0, "a": 1}, separators=(",", ":"))
+    sizes = {}
+    try:
+        for layout in ("hex", "binary"):
+            keys, members = [], {}
+            for i in range(REDIS_SAMPLE):
+                digest = hashlib.sha256(f"{layout}{i}".encode()).digest()
+                token = digest.hex().encode() if layout == "hex" else digest
+                keys.append(b"bench:rt:" + token)
+                members.setdefault(f"bench:user:{i // SESSIONS_PER_USER}:sessions", []).append(token)
+            async with client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.set(key, record, ex=3600)
+                for key, tokens in members.items():
+                    pipe.sadd(key, *tokens)
+                    pipe.expire(key, 3600)
+                await pipe.execute()
+            async with client.pipeline(transaction=False) as pipe:
+                for key in [*keys, *members]:
+                    pipe.memory_usage(key, samples=0)
+                usage = await pipe.execute()
+            await client.delete(*keys, *members)
+            sizes[layout] = sum(usage) / REDIS_SAMPLE
+    finally:
+        await client.aclose()
+    return sizes
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", default="100000,1000000", help="comma-separated session counts")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", ""), help="PostgreSQL URL")
+    parser.add_argument("--redis", default="", help="redis:// URL of a scratch database (optional)")
+    args = parser.parse_args(argv)
+    if not args.database_url.startswith("postgresql"):
+        parser.error("--database-url (or DATABASE_URL) must be a PostgreSQL URL")
+
+    per_session = asyncio.run(measure_redis(args.redis)) if args.redis else None
+    print(f"{'sessions':>10}  {'':6}  {'unique idx':>11}  {'rebuilt':>11}  {'heap':>11}  {'redis':>11}")
+    for n in (int(s) for s in args.sessions.split(",")):
+        sizes = measure_postgres(args.database_url, n)
+        for layout in ("hex", "binary"):
+            s = sizes[layout]
+            redis_bytes = _mb(int(per_session[layout] * n)) if per_session else f"{'n/a':>11}"
+            print(f"{n:>10}  {layout:6}  {_mb(s['index'])}  {_mb(s['index_rebuilt'])}  {_mb(s['heap'])}  {redis_bytes}")
+        hex_, binary = sizes["hex"], sizes["binary"]
+        saved = f"{n:>10}  {'saved':6}  {_mb(hex_['index'] - binary['index'])}  "
+        saved += f"{_mb(hex_['index_rebuilt'] - binary['index_rebuilt'])}  {_mb(hex_['heap'] - binary['heap'])}"
+        if per_session:
+            saved += f"  {_mb(int((per_session['hex'] - per_session['binary']) * n))}"
+        print(saved)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
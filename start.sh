@@ -5,5 +5,21 @@ set -e
 nginx -t
 nginx
 
+# One uvicorn worker per core unless WEB_CONCURRENCY is set. Workers are
+# spawned (not forked) by uvicorn; each builds its own engines, Redis client
+# and bcrypt pool, which gets cores / WEB_CONCURRENCY processes.
+# SESSION_STORE=memory keeps sessions in one process: always one worker.
+if [ "${SESSION_STORE:-database}" = "memory" ]; then
+  export WEB_CONCURRENCY=1
+else
+  export WEB_CONCURRENCY="${WEB_CONCURRENCY:-$(nproc)}"
+fi
+
+# Shared by the workers so /metrics/prometheus reports the whole instance;
+# stale files from a previous run must not be summed in
+export METRICS_MULTIPROC_DIR="${METRICS_MULTIPROC_DIR:-/tmp/metrics}"
+mkdir -p "$METRICS_MULTIPROC_DIR"
+rm -f "$METRICS_MULTIPROC_DIR"/*.db
+
 # Start FastAPI behind nginx
-exec uvicorn app.main:app --host 127.0.0.1 --port 8000
\ No newline at end of file
+exec uvicorn app.main:app --host 127.0.0.1 --port 8000 --workers "$WEB_CONCURRENCY"
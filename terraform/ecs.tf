@@ -52,7 +52,8 @@ resource "aws_ecs_task_definition" "app" {
         { name = "REFRESH_COOKIE_SECURE", value = "true" },
         { name = "REFRESH_COOKIE_SAMESITE", value = "lax" },
         { name = "ALLOWED_ORIGINS", value = "https://web.jensending.top" },
-        { name = "CREATE_TABLES_ON_STARTUP", value = "true" }
+        { name = "CREATE_TABLES_ON_STARTUP", value = "true" },
+        { name = "RATE_LIMIT_TRUSTED_PROXIES", value = "127.0.0.0/8,${aws_subnet.public_a.cidr_block},${aws_subnet.public_b.cidr_block}" }
       ]
       logConfiguration = {
         logDriver = "awslogs"
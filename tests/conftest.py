@@ -0,0 +1,61 @@
+# @Time: 2/25/26 20:10
+# @Author: jie
+# @File: conftest.py
+# @Description: Shared fixtures: a throwaway SQLite database and an in-process Redis behind the app's singletons
+import asyncio
+
+import fakeredis
+import pytest
+
+from app import model  # noqa: F401  (register tables on Base.metadata)
+from app.core import redis_client
+from app.db import Base, database
+
+
+def _clear_engines() -> None:
+    for singleton in (
+        database.get_engine,
+        database.get_session_local,
+        database.get_async_engine,
+        database.get_async_session_local,
+    ):
+        singleton.cache_clear()
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """
+    DATABASE_URL pointed at a fresh SQLite file with every table created.
+
+    Yields the sync engine (for setup and assertions); the app's routes and
+    services use the async engine on the same file. Redis is off.
+    """
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv("REDIS_URL", "")
+    redis_client.get_redis_client.cache_clear()
+    _clear_engines()
+    engine = database.get_engine()
+    Base.metadata.create_all(engine)
+    yield engine
+    asyncio.run(database.dispose_engines())
+    _clear_engines()
+    redis_client.get_redis_client.cache_clear()
+
+
+@pytest.fixture
+def fake_redis(sqlite_db, monkeypatch):
+    """
+    REDIS_URL served by an in-process fakeredis server (Lua included), on top of sqlite_db.
+
+    Yields the FakeServer; get_redis_client() builds a fresh guarded client on it.
+    """
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis_client.redis, "from_url", lambda url, **kw: fakeredis.FakeAsyncRedis(server=server, **kw)
+    )
+    # fakeredis answers the client's PING health check in a form it rejects
+    monkeypatch.setattr(redis_client, "REDIS_HEALTH_CHECK_INTERVAL", 0)
+    monkeypatch.setenv("REDIS_URL", "redis://test-stand-in")
+    redis_client.get_redis_client.cache_clear()
+    yield server
+    redis_client.get_redis_client.cache_clear()
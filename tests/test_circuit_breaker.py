@@ -0,0 +1,89 @@
+# @Time: 2/20/26 21:40
+# @Author: jie
+# @File: test_circuit_breaker.py
+# @Description:
+import asyncio
+
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import ResponseError
+
+from app.core import circuit_breaker
+from app.core.circuit_breaker import CircuitBreaker
+from app.core.redis_client import CircuitOpenError, guard_redis
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_breaker_opens_probes_and_closes(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock.monotonic)
+    closed = []
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_seconds=5)
+    breaker.on_close(lambda: closed.append(True))
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == circuit_breaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == circuit_breaker.OPEN
+    assert not breaker.allow()
+
+    # Half-open: one probe only; its failure re-opens
+    clock.now += 5
+    assert breaker.allow()
+    assert breaker.state == circuit_breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == circuit_breaker.OPEN
+
+    clock.now += 5
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.is_closed() and closed == [True]
+    assert breaker.stats()["opens"] == 2
+
+
+class _FlakyClient:
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    async def execute_command(self, *args, **options):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return b"PONG"
+
+    def pipeline(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+def test_guarded_client_skips_redis_while_open():
+    breaker = CircuitBreaker("redis", failure_threshold=2, reset_seconds=60)
+    client = _FlakyClient()
+    guarded = guard_redis(client, breaker)
+
+    async def run():
+        # A command error is an answer from a healthy server
+        client.error = ResponseError("WRONGTYPE")
+        with pytest.raises(ResponseError):
+            await guarded.execute_command("GET", "k")
+        client.error = RedisConnectionError("refused")
+        for _ in range(2):
+            with pytest.raises(RedisConnectionError):
+                await guarded.execute_command("GET", "k")
+        with pytest.raises(CircuitOpenError):
+            await guarded.execute_command("GET", "k")
+
+    asyncio.run(run())
+    assert client.calls == 3
+    assert breaker.state == circuit_breaker.OPEN
+    assert breaker.rejected == 1
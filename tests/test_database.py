@@ -0,0 +1,20 @@
+# @Time: 2/25/26 20:15
+# @Author: jie
+# @File: test_database.py
+# @Description:
+import asyncio
+
+from sqlalchemy import text
+
+from app.db import database
+
+
+def test_sqlite_url_runs_on_the_async_engine(sqlite_db):
+    assert database._to_async_url("sqlite:///data/app.db") == "sqlite+aiosqlite:///data/app.db"
+
+    async def query():
+        async with database.db_session_scope() as db:
+            return (await db.execute(text("SELECT count(*) FROM users"))).scalar_one()
+
+    assert asyncio.run(query()) == 0
+    assert asyncio.run(database.check_database_ready_async()) == {"database": "ok"}
@@ -0,0 +1,39 @@
+# @Time: 2/10/26 21:10
+# @Author: jie
+# @File: test_fork_safety.py
+# @Description:
+import os
+
+import pytest
+
+from app.core.fork_safety import ForkSafetyError, process_singleton
+
+
+@process_singleton
+def _client():
+    return object()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_singleton_created_in_parent_fails_in_child():
+    parent_value = _client()
+    assert _client() is parent_value
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _client()
+        except ForkSafetyError:
+            os._exit(0)
+        os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_unconfigured_singleton_is_exempt():
+    @process_singleton
+    def _missing():
+        return None
+
+    assert _missing() is None
+    assert _missing.cache_info().currsize == 1
@@ -0,0 +1,86 @@
+# @Time: 2/25/26 22:10
+# @Author: jie
+# @File: test_group_commit.py
+# @Description:
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.db.database import get_async_engine
+from app.model import RefreshSession, User
+from app.model.RefreshSession import token_lookup_column
+from app.service.group_commit import SessionInsertBatcher
+from app.utils.hash import token_columns, token_id
+
+EXPIRES = datetime.now(timezone.utc) + timedelta(days=1)
+
+
+def _digest(n: int) -> bytes:
+    return n.to_bytes(32, "big")
+
+
+def _user(engine) -> int:
+    with Session(engine) as s:
+        user = User(username="amy", password_hash="x", is_active=True)
+        s.add(user)
+        s.commit()
+        return user.id
+
+
+def _count_inserts(statements: list):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO sessions"):
+            statements.append(statement)
+
+    event.listen(get_async_engine().sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_concurrent_inserts_share_one_statement(sqlite_db):
+    user_id = _user(sqlite_db)
+    statements = []
+
+    async def scenario():
+        _count_inserts(statements)
+        batcher = SessionInsertBatcher(max_batch=16, linger_ms=50)
+        try:
+            return await asyncio.gather(*(batcher.insert(user_id, _digest(n), EXPIRES) for n in range(1, 6))), batcher
+        finally:
+            await batcher.stop()
+
+    ids, batcher = asyncio.run(scenario())
+    assert len(statements) == 1  # one multi-row INSERT ... RETURNING
+    assert (batcher.rows, batcher.batch_size.snapshot()["count"]) == (5, 1)
+    with Session(sqlite_db) as s:
+        stored = dict(s.execute(select(token_lookup_column(), RefreshSession.id)).all())
+    assert ids == [stored[token_id(_digest(n))] for n in range(1, 6)]
+    assert len(set(ids)) == 5
+
+
+def test_failed_batch_fails_every_waiter(sqlite_db):
+    user_id = _user(sqlite_db)
+    with Session(sqlite_db) as s:
+        s.add(RefreshSession(user_id=user_id, **token_columns(_digest(3)), expires_at=EXPIRES))
+        s.commit()
+
+    async def scenario():
+        batcher = SessionInsertBatcher(max_batch=16, linger_ms=50)
+        try:
+            results = await asyncio.gather(
+                *(batcher.insert(user_id, _digest(n), EXPIRES) for n in range(1, 6)), return_exceptions=True
+            )
+            # The writer survives a failed batch
+            after = await batcher.insert(user_id, _digest(9), EXPIRES)
+            return results, after, batcher
+        finally:
+            await batcher.stop()
+
+    results, after, batcher = asyncio.run(scenario())
+    # The duplicate token fails the whole batch, and every waiter sees the error
+    assert all(isinstance(result, IntegrityError) for result in results)
+    assert (batcher.errors, batcher.rows) == (1, 1)
+    with Session(sqlite_db) as s:
+        assert s.scalar(select(func.count()).select_from(RefreshSession)) == 2
+        assert s.scalar(select(RefreshSession.id).where(token_lookup_column() == token_id(_digest(9)))) == after
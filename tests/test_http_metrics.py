@@ -0,0 +1,86 @@
+# @Time: 2/09/26 21:40
+# @Author: jie
+# @File: test_http_metrics.py
+# @Description:
+import asyncio
+import multiprocessing
+
+from fastapi.testclient import TestClient
+
+from app.api import metrics_api
+from app.core.http_metrics import RequestMetrics, RequestMetricsMiddleware, request_metrics
+from app.main import app
+from app.service.warmup import _warm_routes
+
+
+def _serve_requests(multiproc_dir, count):
+    metrics = RequestMetrics(buckets=(0.1, 1.0), multiproc_dir=multiproc_dir)
+    for _ in range(count):
+        metrics.observe("POST", "/login", 200, 0.05)
+
+
+def test_histogram_is_cumulative_in_exposition():
+    metrics = RequestMetrics(buckets=(0.1, 1.0), multiproc_dir="")
+    metrics.observe("POST", "/login", 200, 0.05)
+    metrics.observe("POST", "/login", 200, 0.5)
+    metrics.observe("POST", "/login", 200, 3.0)
+
+    text = metrics.render()
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/login",status="200",le="0.1"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/login",status="200",le="1.0"} 2' in text
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/login",status="200",le="+Inf"} 3' in text
+    assert 'http_request_duration_seconds_count{method="POST",route="/login",status="200"} 3' in text
+    assert metrics.total_requests() == 3
+
+
+def test_multiprocess_values_are_summed(tmp_path):
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_serve_requests, args=(str(tmp_path), n)) for n in (3, 4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    metrics = RequestMetrics(buckets=(0.1, 1.0), multiproc_dir=str(tmp_path))
+    metrics.track_in_flight("GET", 1)
+    assert metrics.total_requests() == 7
+    assert 'http_requests_in_flight{method="GET"} 1' in metrics.render()
+
+    metrics.mark_process_dead()
+    assert "http_requests_in_flight{" not in RequestMetrics(multiproc_dir=str(tmp_path)).render()
+
+
+def test_prometheus_endpoint_requires_the_scrape_token(monkeypatch):
+    client = TestClient(app)
+    monkeypatch.setattr(metrics_api, "METRICS_SCRAPE_TOKEN", "")
+    # No token configured: refused, whoever asks
+    assert client.get("/metrics/prometheus").status_code == 403
+
+    monkeypatch.setattr(metrics_api, "METRICS_SCRAPE_TOKEN", "s3cret")
+    assert client.get("/metrics/prometheus").status_code == 401
+    assert client.get("/metrics/prometheus", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    resp = client.get("/metrics/prometheus", headers={"Authorization": "Bearer s3cret"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+
+
+def test_unknown_methods_share_one_label():
+    metrics = RequestMetrics(buckets=(0.1, 1.0), multiproc_dir="")
+    client = TestClient(RequestMetricsMiddleware(app, metrics))
+    for method in ("GET", "BREW", "X-ANYTHING-1", "X-ANYTHING-2"):
+        client.request(method, "/hello")
+
+    text = metrics.render()
+    assert 'method="GET",route="/hello",status="200"' in text
+    assert 'http_request_duration_seconds_count{method="other",route="/hello",status="405"} 3' in text
+    assert "BREW" not in text and "X-ANYTHING" not in text
+    assert 'http_requests_in_flight{method="other"} 0' in text
+
+
+def test_warm_up_requests_are_not_counted(sqlite_db):
+    before = request_metrics.total_requests()
+    asyncio.run(_warm_routes(app))
+    assert request_metrics.total_requests() == before
+
+    TestClient(app).get("/hello")
+    assert request_metrics.total_requests() == before + 1
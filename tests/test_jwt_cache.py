@@ -0,0 +1,41 @@
+# @Time: 2/06/26 20:40
+# @Author: jie
+# @File: test_jwt_cache.py
+# @Description:
+import time
+
+from app.core.jwt_cache import VerifiedTokenCache
+
+
+def test_cache_hit_and_miss():
+    cache = VerifiedTokenCache(max_bytes=1024 * 1024, ttl_seconds=60)
+    payload = {"sub": "jie", "exp": int(time.time()) + 3600}
+
+    assert cache.get("token-a") is None
+    cache.put("token-a", payload)
+    assert cache.get("token-a") == payload
+    assert cache.get("token-b") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_cache_never_outlives_token_exp():
+    cache = VerifiedTokenCache(max_bytes=1024 * 1024, ttl_seconds=60)
+    cache.put("expired", {"sub": "jie", "exp": int(time.time()) - 1})
+    assert cache.get("expired") is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = VerifiedTokenCache(max_bytes=700, ttl_seconds=60)
+    exp = int(time.time()) + 3600
+    cache.put("t1", {"sub": "a", "exp": exp})
+    cache.put("t2", {"sub": "b", "exp": exp})
+    cache.get("t1")  # t2 becomes least recently used
+    cache.put("t3", {"sub": "c", "exp": exp})
+
+    assert cache.get("t2") is None
+    assert cache.get("t1") is not None
+    assert cache.get("t3") is not None
+    assert cache.stats()["evictions"] == 1
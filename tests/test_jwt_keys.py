@@ -0,0 +1,48 @@
+# @Time: 2/17/26 21:10
+# @Author: jie
+# @File: test_jwt_keys.py
+# @Description:
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+from app.core import jwt as jwt_helpers
+from app.core.jwt_keys import KeyRing
+
+
+def _write_private(path, key):
+    path.write_bytes(
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    )
+
+
+def test_rotation_keeps_old_tokens_valid(tmp_path, monkeypatch):
+    _write_private(tmp_path / "2026-01.pem", ed25519.Ed25519PrivateKey.generate())
+    old_ring = KeyRing.from_dir(str(tmp_path))
+    monkeypatch.setattr(jwt_helpers, "get_key_ring", lambda: old_ring)
+    old_token = jwt_helpers.create_access_token("jie")
+    assert jwt.get_unverified_header(old_token) == {"alg": "EdDSA", "kid": "2026-01", "typ": "JWT"}
+
+    # New ES256 key signs; the old one is still published and verifies
+    _write_private(tmp_path / "2026-02.pem", ec.generate_private_key(ec.SECP256R1()))
+    new_ring = KeyRing.from_dir(str(tmp_path))
+    monkeypatch.setattr(jwt_helpers, "get_key_ring", lambda: new_ring)
+    new_token = jwt_helpers.create_access_token("jie")
+
+    assert jwt.get_unverified_header(new_token)["kid"] == "2026-02"
+    assert jwt_helpers.decode_and_verify(old_token)["sub"] == "jie"
+    assert jwt_helpers.decode_and_verify(new_token)["sub"] == "jie"
+    assert {(k["kid"], k["alg"]) for k in new_ring.jwks()["keys"]} == {("2026-01", "EdDSA"), ("2026-02", "ES256")}
+    assert all("d" not in k for k in new_ring.jwks()["keys"])  # no private material
+
+
+def test_unknown_kid_is_rejected(tmp_path, monkeypatch):
+    _write_private(tmp_path / "a.pem", ed25519.Ed25519PrivateKey.generate())
+    ring = KeyRing.from_dir(str(tmp_path))
+    monkeypatch.setattr(jwt_helpers, "get_key_ring", lambda: ring)
+    monkeypatch.setattr(jwt_helpers, "JWT_SECRET", None)
+    forged = jwt.encode({"sub": "x"}, ed25519.Ed25519PrivateKey.generate(), algorithm="EdDSA", headers={"kid": "b"})
+
+    with pytest.raises(jwt.InvalidTokenError):
+        jwt_helpers.decode_and_verify(forged)
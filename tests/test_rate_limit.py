@@ -0,0 +1,77 @@
+# @Time: 2/12/26 21:00
+# @Author: jie
+# @File: test_rate_limit.py
+# @Description:
+import asyncio
+from ipaddress import ip_network
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app.core import rate_limit
+from app.core.rate_limit import RateLimiter, TokenBuckets, client_ip
+
+ALB_SUBNETS = [ip_network("127.0.0.0/8"), ip_network("10.0.1.0/24"), ip_network("10.0.2.0/24")]
+
+
+def _request(forwarded_for: str, peer: str = "127.0.0.1", real_ip: str = "10.0.1.25") -> Request:
+    """What uvicorn sees behind ALB -> nginx: nginx is the peer, X-Real-IP the ALB node."""
+    headers = [(b"x-forwarded-for", forwarded_for.encode()), (b"x-real-ip", real_ip.encode())]
+    return Request({"type": "http", "method": "POST", "path": "/login", "headers": headers, "client": (peer, 40000)})
+
+
+def test_fallback_bucket_rejects_over_limit_without_charging_other_keys():
+    buckets = TokenBuckets(window_seconds=60, max_keys=100)
+    keys, limits = ["ip:1", "user:bob"], [5, 2]
+
+    assert buckets.acquire(keys, limits) == (0, 0.0)
+    assert buckets.acquire(keys, limits) == (0, 0.0)
+
+    full, retry_after = buckets.acquire(keys, limits)
+    assert full == 2  # the username bucket is the one that is empty
+    assert 0 < retry_after <= 30
+
+    # The rejected call did not consume from the IP bucket
+    assert buckets.acquire(["ip:1"], [5]) == (0, 0.0)
+    assert buckets.acquire(["ip:1"], [5]) == (0, 0.0)
+    assert buckets.acquire(["ip:1"], [5]) == (0, 0.0)
+    assert buckets.acquire(["ip:1"], [5])[0] == 1
+
+
+def test_fallback_bucket_is_bounded():
+    buckets = TokenBuckets(window_seconds=60, max_keys=3)
+    for i in range(10):
+        buckets.acquire([f"ip:{i}"], [1])
+    assert len(buckets._buckets) == 3
+
+
+def test_client_ip_skips_the_alb_and_nginx(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_TRUSTED_PROXIES", ALB_SUBNETS)
+    # ALB appended the client, nginx appended the ALB node
+    assert client_ip(_request("203.0.113.7, 10.0.1.25")) == "203.0.113.7"
+    # nginx with real_ip set: the client appears once more on the right
+    assert client_ip(_request("203.0.113.7, 203.0.113.7")) == "203.0.113.7"
+    # A forged hop left of the ALB's entry does not move the key
+    assert client_ip(_request("198.51.100.1, 203.0.113.7, 10.0.2.9")) == "203.0.113.7"
+    # Straight to uvicorn, the header is the client's own and is ignored
+    assert client_ip(_request("198.51.100.1", peer="203.0.113.7")) == "203.0.113.7"
+
+
+def test_clients_behind_one_alb_node_have_their_own_bucket(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_TRUSTED_PROXIES", ALB_SUBNETS)
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(rate_limit, "available_redis_client", lambda: None)
+    limiter = RateLimiter("login", window_seconds=60, per_ip=2)
+
+    async def attempts():
+        for _ in range(2):
+            await limiter.check(_request("203.0.113.7, 10.0.1.25"))
+        with pytest.raises(HTTPException) as exc:
+            await limiter.check(_request("203.0.113.7, 10.0.1.25"))
+        assert exc.value.status_code == 429
+        # Same ALB node and nginx, different client: not throttled
+        await limiter.check(_request("198.51.100.1, 10.0.1.25"))
+
+    asyncio.run(attempts())
+    assert (limiter.allowed, limiter.rejected_ip) == (3, 1)
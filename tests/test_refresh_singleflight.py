@@ -0,0 +1,134 @@
+# @Time: 2/23/26 21:30
+# @Author: jie
+# @File: test_refresh_singleflight.py
+# @Description:
+import asyncio
+import base64
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.redis_client import get_redis_client
+from app.service import refresh_singleflight
+from app.service.refresh_singleflight import (
+    RefreshResult,
+    RefreshSingleFlight,
+    flight_key,
+    seal,
+    unseal,
+    user_flights_key,
+)
+
+
+@pytest.fixture
+def no_redis(monkeypatch):
+    monkeypatch.setattr(refresh_singleflight, "available_redis_client", lambda: None)
+
+
+def test_sealed_result_opens_only_with_the_old_token():
+    result = RefreshResult(access_token="a.b.c", refresh_token="new-token", user_id=7)
+    sealed = seal("old-token", result)
+    assert "new-token" not in sealed
+    assert unseal("old-token", sealed) == result
+    assert unseal("other-token", sealed) is None
+
+    # Any altered byte fails the GCM tag instead of decoding differently
+    raw = bytearray(base64.b64decode(sealed))
+    raw[-20] ^= 1
+    assert unseal("old-token", base64.b64encode(bytes(raw)).decode()) is None
+
+
+def test_concurrent_refreshes_share_one_rotation(no_redis):
+    flights = RefreshSingleFlight(grace_seconds=10, wait_ms=100)
+    calls = []
+
+    async def rotate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return RefreshResult(access_token=f"at{len(calls)}", refresh_token=f"rt{len(calls)}", user_id=7)
+
+    async def run():
+        results = await asyncio.gather(*(flights.run("old", b"h" * 32, rotate) for _ in range(5)))
+        # Done, but inside the grace window: the same result, no new rotation
+        results.append(await flights.run("old", b"h" * 32, rotate))
+        return results
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert set(results) == {RefreshResult("at1", "rt1", 7)}
+    stats = flights.stats()
+    assert (stats["leaders"], stats["coalesced_inflight"], stats["coalesced_grace"]) == (1, 4, 1)
+    assert stats["inflight"] == 0
+
+
+def test_failed_rotation_is_shared_but_not_remembered(no_redis):
+    flights = RefreshSingleFlight(grace_seconds=10, wait_ms=100)
+    calls = []
+
+    async def rotate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=401, detail="Refresh token expired")
+
+    async def run():
+        return await asyncio.gather(*(flights.run("old", b"h" * 32, rotate) for _ in range(3)), return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(e, HTTPException) and e.status_code == 401 for e in errors)
+
+    with pytest.raises(HTTPException):
+        asyncio.run(flights.run("old", b"h" * 32, rotate))
+    assert len(calls) == 2
+    assert flights.stats()["grace_entries"] == 0
+
+
+def _revoked_after_first_rotation(calls: list):
+    async def rotate():
+        calls.append(1)
+        if len(calls) > 1:
+            raise HTTPException(status_code=401, detail="Refresh token revoked")
+        return RefreshResult(access_token="at1", refresh_token="rt1", user_id=7)
+
+    return rotate
+
+
+def test_logout_drops_the_local_grace_result(no_redis):
+    flights = RefreshSingleFlight(grace_seconds=10, wait_ms=100)
+    calls = []
+    rotate = _revoked_after_first_rotation(calls)
+
+    async def run():
+        await flights.run("old", b"h" * 32, rotate)
+        await flights.forget_user(8)  # someone else's logout
+        assert await flights.run("old", b"h" * 32, rotate) == RefreshResult("at1", "rt1", 7)
+        await flights.forget_user(7)
+        with pytest.raises(HTTPException):
+            await flights.run("old", b"h" * 32, rotate)
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert flights.stats()["forgotten"] == 1
+
+
+def test_logout_on_another_worker_ends_the_grace_window(fake_redis):
+    rotated_here, logged_out_there = (RefreshSingleFlight(grace_seconds=10, wait_ms=100) for _ in range(2))
+    calls = []
+    rotate = _revoked_after_first_rotation(calls)
+
+    async def run():
+        rds = get_redis_client()
+        await rotated_here.run("old", b"h" * 32, rotate)
+        assert await rds.smembers(user_flights_key(7)) == {flight_key(b"h" * 32)}
+        # The other worker gets the sealed result from Redis
+        assert await logged_out_there.run("old", b"h" * 32, rotate) == RefreshResult("at1", "rt1", 7)
+
+        await logged_out_there.forget_user(7)
+        assert not await rds.exists(flight_key(b"h" * 32), user_flights_key(7))
+        # This worker's own copy is not served once the Redis result is gone
+        with pytest.raises(HTTPException):
+            await rotated_here.run("old", b"h" * 32, rotate)
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert rotated_here.stats()["grace_entries"] == 0
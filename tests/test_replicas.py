@@ -0,0 +1,32 @@
+# @Time: 2/22/26 21:40
+# @Author: jie
+# @File: test_replicas.py
+# @Description:
+from sqlalchemy import insert, select, text
+
+from app.db.replicas import ReplicaSet, _read_only
+from app.model import RefreshSession, User
+
+
+def test_only_plain_selects_are_read_only():
+    assert _read_only(select(User.id).where(User.username == "bob"))
+    assert not _read_only(select(User).where(User.id == 1).with_for_update())
+    assert not _read_only(text("SELECT 1"))
+    assert not _read_only(RefreshSession.__table__.update().values(revoked_at=None))
+
+    # A data-modifying CTE must stay on the primary
+    cte = insert(User).values(username="x", password_hash="y").returning(User.id).cte("new_user")
+    assert not _read_only(select(cte.c.id))
+
+
+def test_round_robin_skips_unhealthy_replicas():
+    replica_set = ReplicaSet(["postgresql://a", "postgresql://b", "postgresql://c"])
+    a, b, c = replica_set.replicas
+    b.healthy = False
+    assert [replica_set.pick() for _ in range(4)] == [a, c, a, c]
+
+    for replica in replica_set.replicas:
+        replica.healthy = False
+    assert replica_set.pick() is None
+    assert replica_set.primary_reads == 1
+    assert (a.reads, b.reads, c.reads) == (2, 0, 2)
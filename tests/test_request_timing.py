@@ -0,0 +1,83 @@
+# @Time: 2/19/26 21:30
+# @Author: jie
+# @File: test_request_timing.py
+# @Description:
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from app.core import rate_limit, request_timing
+from app.core.profiler import StackSampler
+from app.core.request_timing import server_timing_header, timed
+from app.core.security import PasswordService
+from app.main import app
+from app.model import User
+
+
+def test_server_timing_header_is_off_by_default():
+    assert not request_timing.SERVER_TIMING_ENABLED
+    assert "Server-Timing" not in TestClient(app).get("/hello").headers
+
+
+def test_server_timing_header_on_every_response(monkeypatch):
+    monkeypatch.setattr(request_timing, "SERVER_TIMING_ENABLED", True)
+    resp = TestClient(app).get("/hello")
+    assert resp.headers["Server-Timing"].startswith("total;dur=")
+
+
+def test_login_only_gets_the_total(sqlite_db, monkeypatch):
+    monkeypatch.setattr(request_timing, "SERVER_TIMING_ENABLED", True)
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", False)
+
+    async def verify_password(password: str, password_hash: str) -> bool:
+        with timed("bcrypt"):
+            return False
+
+    monkeypatch.setattr(PasswordService, "verify_password_async", staticmethod(verify_password))
+    with Session(sqlite_db) as s:
+        s.add(User(username="amy", password_hash="x", is_active=True))
+        s.commit()
+
+    client = TestClient(app)
+    # A wrong password for a known name must look like an unknown name
+    for username in ("amy", "nobody"):
+        resp = client.post("/login", json={"username": username, "password": "wrong-password"})
+        assert resp.status_code == 401
+        assert resp.headers["Server-Timing"].startswith("total;dur=")
+        assert "," not in resp.headers["Server-Timing"]
+
+
+def test_server_timing_header_format():
+    header = server_timing_header({"db": [0.0015, 2], "bcrypt": [0.25, 1]}, 0.26)
+    assert header == 'db;dur=1.50;desc="2x", bcrypt;dur=250.00;desc="1x", total;dur=260.00'
+
+
+def test_sampler_dumps_folded_stacks_of_profiled_requests(tmp_path):
+    sampler = StackSampler(every_n=2, slow_ms=0, interval_ms=1, out_dir=str(tmp_path))
+
+    def spin(seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    async def request(seconds):
+        handle = sampler.begin()
+        spin(seconds)
+        if handle is not None:
+            sampler.end(handle, "POST /login", seconds)
+
+    async def run():
+        await asyncio.create_task(request(0.01))  # 1st: not sampled
+        await asyncio.create_task(request(0.05))  # 2nd: sampled
+
+    asyncio.run(run())
+    sampler.stop()
+
+    (dump,) = tmp_path.iterdir()
+    assert "POST_login" in dump.name
+    lines = dump.read_text().splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("spin" in line for line in lines)
+    assert sampler.stats()["profiled"] == 1
@@ -0,0 +1,60 @@
+# @Time: 2/02/26 21:10
+# @Author: jie
+# @File: test_security.py
+# @Description:
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.security import PasswordEngine, calibrate_bcrypt_rounds, crypt_context
+
+
+def test_password_engine_hash_and_verify():
+    engine = PasswordEngine(workers=1, max_queue=2, retry_after=1)
+
+    async def run():
+        hashed = await engine.hash("secret123")
+        assert await engine.verify("secret123", hashed)
+        assert not await engine.verify("wrong", hashed)
+
+    try:
+        asyncio.run(run())
+    finally:
+        engine.shutdown()
+
+    stats = engine.stats()
+    assert stats["completed"] == 3
+    assert stats["verify_count"] == 2
+    assert stats["in_flight"] == 0
+
+
+def test_password_engine_rejects_when_saturated():
+    engine = PasswordEngine(workers=1, max_queue=0, retry_after=3)
+    engine.pending = 1  # pretend the single worker is busy
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(engine.hash("secret123"))
+
+    assert exc.value.status_code == 503
+    assert exc.value.headers["Retry-After"] == "3"
+    assert engine.stats()["rejected"] == 1
+
+
+def test_calibration_stays_within_bounds():
+    rounds, verify_ms = calibrate_bcrypt_rounds(target_ms=10_000, min_rounds=4, max_rounds=6, samples=1)
+    assert rounds == 6
+    assert verify_ms > 0
+
+    rounds, _ = calibrate_bcrypt_rounds(target_ms=0, min_rounds=4, max_rounds=6, samples=1)
+    assert rounds == 4
+
+
+def test_needs_update_allows_one_round_of_slack():
+    engine = PasswordEngine(workers=1, max_queue=0, retry_after=1, rounds=5)
+    assert engine.needs_update(crypt_context(4).hash("secret123"))
+    assert not engine.needs_update(crypt_context(5).hash("secret123"))
+    assert not engine.needs_update(crypt_context(6).hash("secret123"))
+    assert engine.needs_update(crypt_context(7).hash("secret123"))
+    # No configured cost: existing hashes are left alone
+    assert not PasswordEngine(workers=1, max_queue=0, retry_after=1).needs_update(crypt_context(4).hash("x"))
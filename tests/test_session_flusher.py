@@ -0,0 +1,221 @@
+# @Time: 2/25/26 21:30
+# @Author: jie
+# @File: test_session_flusher.py
+# @Description:
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from redis.client import NEVER_DECODE
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.core.redis_client import get_redis_client
+from app.db.database import db_session_scope
+from app.model import RefreshSession, User
+from app.model.RefreshSession import token_lookup_column
+from app.service import session_flusher, session_service
+from app.service.session_flusher import DEAD_LETTER_KEY, FLUSH_LOCK_KEY, SessionFlusher
+from app.service.session_service import WRITE_BEHIND_QUEUE, SessionRecord, redis_key, user_sessions_key
+from app.utils.hash import token_columns, token_id
+
+NOW = datetime.now(timezone.utc)
+EXPIRES = NOW + timedelta(days=1)
+
+
+def _digest(n: int) -> bytes:
+    return n.to_bytes(32, "big")
+
+
+@pytest.fixture
+def write_behind(sqlite_db, fake_redis, monkeypatch):
+    monkeypatch.setattr(session_service, "SESSION_DURABILITY", "async")
+    with Session(sqlite_db) as s:
+        users = [User(username="amy", password_hash="x", is_active=True), User(username="bob", password_hash="x", is_active=False)]
+        s.add_all(users)
+        s.commit()
+        return sqlite_db, [(user.id, user.username, user.is_active) for user in users]
+
+
+def _rows(engine) -> dict:
+    with Session(engine) as s:
+        rows = s.execute(select(token_lookup_column(), RefreshSession.user_id, RefreshSession.revoked_at)).all()
+    return {token: (user_id, revoked_at) for token, user_id, revoked_at in rows}
+
+
+def test_queued_create_rotate_revoke_reach_the_db_in_order(write_behind, monkeypatch):
+    engine, [(amy_id, amy, _), _] = write_behind
+    user = User(id=amy_id, username=amy, is_active=True)
+    # Small batches: a token's create and its revocation land in different flushes
+    monkeypatch.setattr(session_flusher, "SESSION_FLUSH_BATCH", 2)
+    later = NOW + timedelta(minutes=1)
+
+    async def scenario():
+        async with db_session_scope() as db:
+            await session_service.create_session(db, user, _digest(1), EXPIRES, 60)
+            await session_service.rotate_refresh_session(db, _digest(1), _digest(2), NOW, EXPIRES, 60)
+            await session_service.revoke_session(db, _digest(2), later)
+            await session_service.create_session(db, user, _digest(3), EXPIRES, 60)
+        assert await get_redis_client().llen(WRITE_BEHIND_QUEUE) == 4
+        assert _rows(engine) == {}  # nothing written inline
+
+        flusher = SessionFlusher()
+        while await flusher.flush_once():
+            pass
+        assert (flusher.flushed, flusher.batches) == (4, 2)
+        assert await get_redis_client().llen(WRITE_BEHIND_QUEUE) == 0
+
+    asyncio.run(scenario())
+    rows = _rows(engine)
+    assert set(rows) == {token_id(_digest(n)) for n in (1, 2, 3)}
+    assert all(user_id == amy_id for user_id, _ in rows.values())
+    assert rows[token_id(_digest(1))][1].replace(tzinfo=timezone.utc) == NOW.replace(microsecond=0)
+    assert rows[token_id(_digest(2))][1].replace(tzinfo=timezone.utc) == later.replace(microsecond=0)
+    assert rows[token_id(_digest(3))][1] is None
+
+
+def test_flush_that_dies_before_the_trim_is_replayed_once(write_behind):
+    engine, [(amy_id, amy, _), _] = write_behind
+    user = User(id=amy_id, username=amy, is_active=True)
+
+    async def scenario():
+        async with db_session_scope() as db:
+            await session_service.create_session(db, user, _digest(1), EXPIRES, 60)
+            await session_service.rotate_refresh_session(db, _digest(1), _digest(2), NOW, EXPIRES, 60)
+
+        # The DB commit goes through, the LTRIM that follows never happens
+        rds = get_redis_client()
+        trim = rds.eval
+
+        def crash(*args, **kwargs):
+            rds.eval = trim
+            raise RuntimeError("worker killed")
+
+        rds.eval = crash
+        flusher = SessionFlusher()
+        with pytest.raises(RuntimeError):
+            await flusher.flush_once()
+        assert await rds.llen(WRITE_BEHIND_QUEUE) == 2
+        committed = _rows(engine)
+        assert len(committed) == 2
+
+        # The lock was released, so the next flush replays the same entries
+        assert await flusher.flush_once() == 2
+        assert await rds.llen(WRITE_BEHIND_QUEUE) == 0
+        return committed
+
+    committed = asyncio.run(scenario())
+    assert _rows(engine) == committed  # no duplicate row, revoked_at not rewritten
+    with Session(engine) as s:
+        assert s.scalar(select(func.count()).select_from(RefreshSession)) == 2
+
+
+def test_epoch_reset_rehydrates_active_sessions(write_behind):
+    engine, [(amy_id, amy, _), (bob_id, bob, _)] = write_behind
+    with Session(engine) as s:
+        s.add_all(
+            [
+                RefreshSession(user_id=amy_id, **token_columns(_digest(1)), expires_at=EXPIRES),
+                RefreshSession(user_id=amy_id, **token_columns(_digest(2)), expires_at=EXPIRES, revoked_at=NOW),
+                RefreshSession(user_id=amy_id, **token_columns(_digest(3)), expires_at=NOW - timedelta(seconds=1)),
+                RefreshSession(user_id=amy_id, **token_columns(_digest(4)), expires_at=EXPIRES),
+                RefreshSession(user_id=bob_id, **token_columns(_digest(5)), expires_at=EXPIRES),
+            ]
+        )
+        s.commit()
+
+    async def scenario():
+        rds = get_redis_client()
+        flusher = SessionFlusher()
+        await flusher.check_epoch()
+        await flusher.check_epoch()
+        assert (flusher.data_loss_detected, flusher.rehydrated) == (0, 0)
+
+        await rds.flushall()
+        # Written by live traffic after the loss: must not be overwritten
+        tombstone = SessionRecord(amy_id, amy, int(EXPIRES.timestamp()), revoked=True)
+        await rds.set(redis_key(_digest(4)), tombstone.dumps())
+
+        await flusher.check_epoch()
+        assert (flusher.data_loss_detected, flusher.rehydrated) == (1, 3)
+
+        records = {n: await rds.get(redis_key(_digest(n))) for n in range(1, 6)}
+        assert records[2] is None and records[3] is None
+        assert SessionRecord.loads(records[1]) == SessionRecord(amy_id, amy, int(EXPIRES.timestamp()))
+        assert SessionRecord.loads(records[4]).revoked
+        assert not SessionRecord.loads(records[5]).active
+        assert await rds.smembers(user_sessions_key(amy_id)) == {token_id(_digest(1)), token_id(_digest(4))}
+        assert 0 < await rds.ttl(redis_key(_digest(1))) <= 24 * 60 * 60
+
+        await flusher.check_epoch()
+        assert flusher.data_loss_detected == 1
+
+    asyncio.run(scenario())
+
+
+def test_flusher_that_lost_its_lock_mid_commit_does_not_trim(write_behind, monkeypatch):
+    engine, [(amy_id, amy, _), _] = write_behind
+    user = User(id=amy_id, username=amy, is_active=True)
+    slow, other = SessionFlusher(), SessionFlusher()
+    db_session_scope_ = session_flusher.db_session_scope
+    interfered = []
+
+    async def create(n: int):
+        async with db_session_scope() as db:
+            await session_service.create_session(db, user, _digest(n), EXPIRES, 60)
+
+    @asynccontextmanager
+    async def slow_commit():
+        if not interfered:
+            interfered.append(True)
+            # The commit outlives the lock; another worker takes over meanwhile
+            rds = get_redis_client()
+            await rds.pexpire(FLUSH_LOCK_KEY, 1)
+            await asyncio.sleep(0.01)
+            await create(3)
+            assert await other.flush_once() == 3
+            await create(4)  # queued after the takeover's trim
+        async with db_session_scope_() as db:
+            yield db
+
+    async def scenario():
+        await create(1)
+        await create(2)
+        monkeypatch.setattr(session_flusher, "db_session_scope", slow_commit)
+        assert await slow.flush_once() == 0
+        assert slow.lock_lost == 1
+        # Entry 4 was not trimmed by the flusher that read only 1 and 2
+        assert await get_redis_client().llen(WRITE_BEHIND_QUEUE) == 1
+        assert await slow.flush_once() == 1
+
+    asyncio.run(scenario())
+    assert set(_rows(engine)) == {token_id(_digest(n)) for n in range(1, 5)}
+
+
+def test_malformed_entries_are_dead_lettered_and_the_rest_flushed(write_behind):
+    engine, [(amy_id, amy, _), _] = write_behind
+    user = User(id=amy_id, username=amy, is_active=True)
+    malformed = [b"not json", b'{"op":"create","new":"zz"}', b'{"op":"revoke","old":"' + b"ab" * 32 + b'"}', b"\xff"]
+
+    async def scenario():
+        rds = get_redis_client()
+        await rds.rpush(WRITE_BEHIND_QUEUE, *malformed[:2])
+        async with db_session_scope() as db:
+            await session_service.create_session(db, user, _digest(1), EXPIRES, 60)
+        await rds.rpush(WRITE_BEHIND_QUEUE, *malformed[2:])
+
+        flusher = SessionFlusher()
+        assert await flusher.flush_once() == 5
+        assert await rds.llen(WRITE_BEHIND_QUEUE) == 0
+        assert (flusher.flushed, flusher.dead_lettered) == (1, 4)
+        assert flusher.stats()["dead_lettered"] == 4
+        assert await rds.execute_command("LRANGE", DEAD_LETTER_KEY, 0, -1, **{NEVER_DECODE: True}) == malformed
+
+        # Later entries are not held up
+        async with db_session_scope() as db:
+            await session_service.create_session(db, user, _digest(2), EXPIRES, 60)
+        assert await flusher.flush_once() == 1
+
+    asyncio.run(scenario())
+    assert set(_rows(engine)) == {token_id(_digest(n)) for n in (1, 2)}
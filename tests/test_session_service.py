@@ -0,0 +1,115 @@
+# @Time: 2/25/26 20:40
+# @Author: jie
+# @File: test_session_service.py
+# @Description:
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from app.core.redis_client import get_redis_client
+from app.db.database import db_session_scope, get_async_engine
+from app.model import RefreshSession, User
+from app.model.RefreshSession import token_lookup_column
+from app.service import session_service
+from app.service.session_service import redis_key
+from app.service.user_service import deactivate_user
+from app.utils.hash import token_columns, token_id
+
+NOW = datetime.now(timezone.utc)
+EXPIRES = NOW + timedelta(days=1)
+
+
+def _digest(n: int) -> bytes:
+    return n.to_bytes(32, "big")
+
+
+def _seed(engine, usernames, sessions_per_user: int) -> dict:
+    """Users first, then their sessions, so user ids and session ids differ. Returns n -> (user_id, username)."""
+    owners = {}
+    with Session(engine) as s:
+        users = [User(username=name, password_hash="x", is_active=True) for name in usernames]
+        s.add_all(users)
+        s.flush()
+        n = 0
+        for user in users:
+            for _ in range(sessions_per_user):
+                n += 1
+                s.add(RefreshSession(user_id=user.id, **token_columns(_digest(n)), expires_at=EXPIRES))
+                owners[n] = (user.id, user.username)
+        s.commit()
+    return owners
+
+
+def _row(engine, n: int):
+    with Session(engine) as s:
+        return s.execute(
+            select(RefreshSession.user_id, RefreshSession.revoked_at).where(
+                token_lookup_column() == token_id(_digest(n))
+            )
+        ).one()
+
+
+def test_concurrent_rotations_keep_each_session_on_its_user(sqlite_db):
+    owners = _seed(sqlite_db, ["amy", "bob", "cat", "dan"], sessions_per_user=3)
+
+    async def rotate(n: int, generation: int, ready: asyncio.Barrier):
+        async with db_session_scope() as db:
+            # Every rotation holds its own pooled connection before any of them runs
+            await db.execute(text("SELECT 1"))
+            await ready.wait()
+            return await session_service.rotate_refresh_session(
+                db, _digest(n + generation * 100), _digest(n + (generation + 1) * 100), NOW, EXPIRES, 60
+            )
+
+    async def rotate_all(generation: int):
+        ready = asyncio.Barrier(len(owners))
+        return await asyncio.gather(*(rotate(n, generation, ready) for n in owners))
+
+    # A column mix-up in RETURNING only shows on a statement's first,
+    # overlapping executions, so every round starts from a cold statement cache
+    for generation in range(4):
+        get_async_engine().sync_engine.clear_compiled_cache()
+        for n, rotated in zip(owners, asyncio.run(rotate_all(generation))):
+            assert (rotated.user_id, rotated.username) == owners[n]
+            assert _row(sqlite_db, n + generation * 100).revoked_at is not None
+            assert _row(sqlite_db, n + (generation + 1) * 100) == (owners[n][0], None)
+
+    # A rotated-away token is spent
+    async def reuse():
+        async with db_session_scope() as db:
+            await session_service.rotate_refresh_session(db, _digest(1), _digest(999), NOW, EXPIRES, 60)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(reuse())
+    assert exc.value.detail == "Refresh token revoked"
+
+
+def test_deactivated_user_cannot_rotate_from_write_behind_records(sqlite_db, fake_redis, monkeypatch):
+    monkeypatch.setattr(session_service, "SESSION_DURABILITY", "async")
+    _seed(sqlite_db, ["amy"], sessions_per_user=0)
+    with Session(sqlite_db) as s:
+        amy = s.scalar(select(User).where(User.username == "amy"))
+        s.expunge(amy)
+
+    async def scenario():
+        async with db_session_scope() as db:
+            await session_service.create_session(db, amy, _digest(1), EXPIRES, 60)
+            await session_service.create_session(db, amy, _digest(2), EXPIRES, 60)
+            # Rotation is served from the Redis record alone
+            await session_service.rotate_refresh_session(db, _digest(1), _digest(3), NOW, EXPIRES, 60)
+            assert await deactivate_user(db, amy.id) == 2
+        assert not await get_redis_client().exists(redis_key(_digest(2)), redis_key(_digest(3)))
+
+        for token in (2, 3):
+            async with db_session_scope() as db:
+                with pytest.raises(HTTPException) as exc:
+                    await session_service.rotate_refresh_session(db, _digest(token), _digest(9), NOW, EXPIRES, 60)
+            assert exc.value.status_code == 401
+
+    asyncio.run(scenario())
+    with Session(sqlite_db) as s:
+        assert s.scalar(select(User.is_active).where(User.id == amy.id)) is False
@@ -0,0 +1,124 @@
+# @Time: 2/24/26 21:45
+# @Author: jie
+# @File: test_session_store.py
+# @Description:
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.redis_client import get_redis_client
+from app.service import memory_session_store, session_store
+from app.service.memory_session_store import MemorySessionStore
+from app.service.session_service import WRITE_BEHIND_QUEUE, redis_key, user_sessions_key
+from app.service.session_store import RedisSessionStore
+from app.utils.hash import token_id
+
+NOW = datetime.now(timezone.utc)
+USER = SimpleNamespace(id=7, username="bob", is_active=True)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def _digest(n: int) -> bytes:
+    return n.to_bytes(32, "big")
+
+
+def test_rotate_revokes_the_old_session_once():
+    store = MemorySessionStore()
+    expires = NOW + timedelta(days=7)
+    _run(store.create(None, USER, _digest(1), expires, 0))
+
+    rotated = _run(store.rotate(None, _digest(1), _digest(2), NOW, expires, 0))
+    assert (rotated.user_id, rotated.username) == (7, "bob")
+    assert _run(store.lookup(None, _digest(1))).revoked
+    assert not _run(store.lookup(None, _digest(2))).revoked
+
+    for token, detail in ((_digest(1), "Refresh token revoked"), (_digest(9), "Invalid refresh token")):
+        with pytest.raises(HTTPException) as exc:
+            _run(store.rotate(None, token, _digest(3), NOW, expires, 0))
+        assert exc.value.detail == detail
+    assert _run(store.lookup(None, _digest(3))) is None
+
+
+def test_revoke_all_and_expiry(monkeypatch):
+    monkeypatch.setattr(memory_session_store, "SESSION_TOMBSTONE_TTL", 60)
+    store = MemorySessionStore()
+    for n in range(3):
+        _run(store.create(None, USER, _digest(n), NOW + timedelta(seconds=30 + n), 0))
+    _run(store.create(None, SimpleNamespace(id=8, username="amy", is_active=True), _digest(10), NOW + timedelta(days=1), 0))
+
+    assert _run(store.revoke_all(None, 7, NOW)) == 3
+    assert _run(store.revoke_all(None, 7, NOW)) == 0
+    assert all(_run(store.lookup(None, _digest(n))).revoked for n in range(3))
+
+    # Tombstones go at min(expiry, now + tombstone TTL); amy's session stays
+    later = NOW + timedelta(seconds=40)
+    _run(store.rotate(None, _digest(10), _digest(11), later, NOW + timedelta(days=1), 0))
+    assert store.stats()["sessions"] == 2  # amy's tombstone + her new session
+    assert store.stats()["evictions"] == 3
+
+
+def test_redis_store_rotates_once_and_rejects_like_the_database(fake_redis):
+    store = RedisSessionStore()
+    expires = NOW + timedelta(days=7)
+
+    async def scenario():
+        await store.create(None, USER, _digest(1), expires, 60)
+        await store.create(None, SimpleNamespace(id=8, username="amy", is_active=False), _digest(5), expires, 60)
+
+        rotated = await store.rotate(None, _digest(1), _digest(2), NOW, expires, 60)
+        assert (rotated.session_id, rotated.user_id, rotated.username) == (None, 7, "bob")
+        assert (await store.lookup(None, _digest(1))).revoked
+        assert not (await store.lookup(None, _digest(2))).revoked
+        assert await get_redis_client().smembers(user_sessions_key(7)) == {token_id(_digest(2))}
+
+        for token, detail in (
+            (_digest(1), "Refresh token revoked"),
+            (_digest(9), "Invalid refresh token"),
+            (_digest(5), "User not available"),
+        ):
+            with pytest.raises(HTTPException) as exc:
+                await store.rotate(None, token, _digest(3), NOW, expires, 60)
+            assert (exc.value.status_code, exc.value.detail) == (401, detail)
+        assert await store.lookup(None, _digest(3)) is None
+        # Redis only: nothing is queued for the database
+        assert await get_redis_client().llen(WRITE_BEHIND_QUEUE) == 0
+
+    _run(scenario())
+
+
+def test_redis_store_revoke_and_revoke_all(fake_redis):
+    store = RedisSessionStore()
+    expires = NOW + timedelta(days=7)
+
+    async def scenario():
+        for n in range(3):
+            await store.create(None, USER, _digest(n), expires, 60)
+        await store.create(None, SimpleNamespace(id=8, username="amy", is_active=True), _digest(10), expires, 60)
+
+        await store.revoke(None, _digest(0), NOW)
+        await store.revoke(None, _digest(99), NOW)  # unknown: ignored
+        assert (await store.lookup(None, _digest(0))).revoked
+        assert 0 < await get_redis_client().ttl(redis_key(_digest(0))) <= session_store.SESSION_TOMBSTONE_TTL
+
+        assert await store.revoke_all(None, 7, NOW) == 2
+        assert all([await store.lookup(None, _digest(n)) is None for n in (1, 2)])
+        assert (await store.lookup(None, _digest(0))).revoked  # the tombstone stays until its TTL
+        assert not await get_redis_client().exists(user_sessions_key(7))
+        assert not (await store.lookup(None, _digest(10))).revoked
+
+    _run(scenario())
+
+
+def test_redis_store_is_unavailable_without_redis(monkeypatch):
+    monkeypatch.setattr(session_store, "available_redis_client", lambda: None)
+    store = RedisSessionStore()
+    with pytest.raises(HTTPException) as exc:
+        _run(store.rotate(None, _digest(1), _digest(2), NOW, NOW + timedelta(days=7), 60))
+    assert (exc.value.status_code, exc.value.detail) == (503, "Session store unavailable")
+    assert store.requires_redis()
@@ -0,0 +1,70 @@
+# @Time: 2/25/26 22:40
+# @Author: jie
+# @File: test_session_sweeper.py
+# @Description:
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app.db.database import get_async_engine
+from app.model import RefreshSession, User
+from app.model.RefreshSession import token_lookup_column
+from app.service import session_sweeper
+from app.service.session_sweeper import SessionSweeper
+from app.utils.hash import token_columns, token_id
+
+NOW = datetime.now(timezone.utc)
+
+
+def _digest(n: int) -> bytes:
+    return n.to_bytes(32, "big")
+
+
+def test_sweep_deletes_only_rows_past_the_retention(sqlite_db, monkeypatch):
+    monkeypatch.setattr(session_sweeper, "SESSION_SWEEP_RETENTION_SECONDS", 24 * 60 * 60)
+    monkeypatch.setattr(session_sweeper, "SESSION_SWEEP_BATCH", 2)
+    monkeypatch.setattr(session_sweeper, "SESSION_SWEEP_PAUSE_MS", 0)
+
+    long_ago, recently, future = NOW - timedelta(days=3), NOW - timedelta(hours=1), NOW + timedelta(days=1)
+    rows = {
+        # Same expires_at three times: the keyset has to break ties on id
+        1: (long_ago, None),
+        2: (long_ago, None),
+        3: (long_ago, None),
+        4: (recently, None),  # expired within the retention
+        5: (future, None),  # live
+        6: (future, NOW - timedelta(days=2)),
+        7: (future, NOW - timedelta(days=3)),
+        8: (future, NOW - timedelta(days=4)),
+        9: (future, recently),  # revoked within the retention
+    }
+    with Session(sqlite_db) as s:
+        user = User(username="amy", password_hash="x", is_active=True)
+        s.add(user)
+        s.flush()
+        for n, (expires_at, revoked_at) in rows.items():
+            s.add(RefreshSession(user_id=user.id, **token_columns(_digest(n)), expires_at=expires_at, revoked_at=revoked_at))
+        s.commit()
+
+    deletes = []
+
+    async def sweep():
+        event.listen(
+            get_async_engine().sync_engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: deletes.append(statement) if statement.startswith("DELETE") else None,
+        )
+        sweeper = SessionSweeper()
+        return await sweeper.sweep_once(), sweeper
+
+    swept, sweeper = asyncio.run(sweep())
+    assert swept == 6
+    assert (sweeper.swept_expired, sweeper.swept_revoked, sweeper.skipped_locked) == (3, 3, 0)
+    assert len(deletes) == 4  # two keyset batches per pass
+    assert sweeper.table["rows_estimate"] == 3
+
+    with Session(sqlite_db) as s:
+        survivors = set(s.scalars(select(token_lookup_column())))
+    assert survivors == {token_id(_digest(n)) for n in (4, 5, 9)}
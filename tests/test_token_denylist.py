@@ -0,0 +1,36 @@
+# @Time: 2/16/26 21:00
+# @Author: jie
+# @File: test_token_denylist.py
+# @Description:
+import asyncio
+import time
+
+from app.core.token_denylist import BloomFilter, TokenDenylist
+
+
+def test_bloom_filter_has_no_false_negatives_and_bounded_false_positives():
+    bloom = BloomFilter(capacity=10000, fp_rate=0.01)
+    for i in range(10000):
+        bloom.add(f"revoked-{i}")
+
+    assert all(f"revoked-{i}" in bloom for i in range(10000))
+    false_positives = sum(f"fresh-{i}" in bloom for i in range(10000))
+    assert false_positives < 300  # ~1% expected
+    assert 0.005 < bloom.estimated_fp_rate() < 0.02
+
+
+def test_denylist_without_redis(monkeypatch):
+    monkeypatch.setattr("app.core.token_denylist.get_redis_client", lambda: None)
+    denylist = TokenDenylist(capacity=1000, fp_rate=0.001, rebuild_seconds=0)
+    exp = time.time() + 3600
+
+    async def run():
+        await denylist.revoke("jti-revoked", exp)
+        await denylist.revoke("jti-expired", time.time() - 1)
+        return await denylist.is_revoked("jti-revoked"), await denylist.is_revoked("jti-expired")
+
+    assert asyncio.run(run()) == (True, False)
+    stats = denylist.stats()
+    assert stats["revocations"] == 1
+    assert stats["revoked_hits"] == 1
+    assert stats["bloom_items"] == 1
@@ -0,0 +1,35 @@
+# @Time: 2/21/26 21:40
+# @Author: jie
+# @File: test_token_hash.py
+# @Description:
+import hashlib
+
+from app.utils import hash as token_hash
+
+
+def test_token_id_round_trips_in_both_formats():
+    digest = token_hash.hash_refresh_token("plain-token")
+    assert digest == hashlib.sha256(b"plain-token").digest() and len(digest) == 32
+
+    hex_id = digest.hex()
+    # Hex ids come back as str (columns, decoded replies) or bytes (raw SMEMBERS)
+    assert token_hash.digest_from_token_id(hex_id) == digest
+    assert token_hash.digest_from_token_id(hex_id.encode()) == digest
+    assert token_hash.digest_from_token_id(digest) == digest
+
+
+def test_token_columns_follow_the_storage_phase(monkeypatch):
+    digest = token_hash.hash_refresh_token("plain-token")
+    phases = {
+        "hex": (False, True, False),
+        "hex+binary": (False, True, True),
+        "binary+hex": (True, True, True),
+        "binary": (True, False, True),
+    }
+    for phase, (lookup_binary, writes_hex, writes_digest) in phases.items():
+        monkeypatch.setattr(token_hash, "TOKEN_LOOKUP_BINARY", lookup_binary)
+        monkeypatch.setattr(token_hash, "WRITES_TOKEN_HASH", writes_hex)
+        monkeypatch.setattr(token_hash, "WRITES_TOKEN_DIGEST", writes_digest)
+        columns = token_hash.token_columns(digest)
+        assert ("token_hash" in columns, "token_digest" in columns) == (writes_hex, writes_digest), phase
+        assert token_hash.token_id(digest) == (digest if lookup_binary else digest.hex()), phase
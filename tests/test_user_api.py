@@ -0,0 +1,203 @@
+# @Time: 2/26/26 20:10
+# @Author: jie
+# @File: test_user_api.py
+# @Description:
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.core import jwt as jwt_helpers
+from app.core import rate_limit
+from app.core.redis_client import get_redis_client
+from app.core.security import PasswordService
+from app.main import app
+from app.model import RefreshSession, User
+from app.service.session_service import redis_key, user_sessions_key
+from app.service.user_service import (
+    TAKEN_USERNAMES_KEY,
+    TAKEN_USERNAMES_SEED_LOCK_KEY,
+    TAKEN_USERNAMES_SEEDED_KEY,
+    seed_taken_usernames,
+)
+from app.utils.hash import hash_refresh_token
+
+CREDENTIALS = {"username": "amy", "password": "amy-password"}
+
+
+@pytest.fixture
+def fake_bcrypt(monkeypatch):
+    """Plain-text "hashes" instead of the bcrypt pool. `calls` counts hashes; `gate` (a Barrier) holds them."""
+    bcrypt = SimpleNamespace(calls=0, gate=None)
+
+    async def hash_password(password: str) -> str:
+        bcrypt.calls += 1
+        if bcrypt.gate is not None:
+            await bcrypt.gate.wait()
+        return f"plain:{password}"
+
+    async def verify_password(password: str, password_hash: str) -> bool:
+        return password_hash == f"plain:{password}"
+
+    monkeypatch.setattr(PasswordService, "hash_password_async", staticmethod(hash_password))
+    monkeypatch.setattr(PasswordService, "verify_password_async", staticmethod(verify_password))
+    monkeypatch.setattr(PasswordService, "needs_rehash", staticmethod(lambda password_hash: False))
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", False)
+    return bcrypt
+
+
+def _client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test.local")
+
+
+def _users(engine, username: str) -> int:
+    with Session(engine) as s:
+        return s.scalar(select(func.count()).select_from(User).where(User.username == username))
+
+
+def test_duplicate_registration_is_rejected_by_the_filter_before_bcrypt(sqlite_db, fake_redis, fake_bcrypt):
+    async def scenario():
+        async with _client() as client:
+            first = await client.post("/register", json=CREDENTIALS)
+            assert await get_redis_client().sismember(TAKEN_USERNAMES_KEY, "amy")
+            second = await client.post("/register", json=CREDENTIALS)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert (second.status_code, second.json()["detail"]) == (409, "Username already exists")
+    assert fake_bcrypt.calls == 1
+    assert _users(sqlite_db, "amy") == 1
+
+
+def test_users_from_before_the_filter_are_seeded_into_it(sqlite_db, fake_redis, fake_bcrypt):
+    with Session(sqlite_db) as s:
+        s.add_all([User(username=name, password_hash="x", is_active=True) for name in ("amy", "bob", "cat")])
+        s.commit()
+
+    async def scenario():
+        rds = get_redis_client()
+        # Another worker is seeding: leave it to that one
+        await rds.set(TAKEN_USERNAMES_SEED_LOCK_KEY, "1")
+        assert await seed_taken_usernames(batch=2) == 0
+        await rds.delete(TAKEN_USERNAMES_SEED_LOCK_KEY)
+
+        assert await seed_taken_usernames(batch=2) == 3
+        assert await rds.smembers(TAKEN_USERNAMES_KEY) == {"amy", "bob", "cat"}
+        assert await rds.exists(TAKEN_USERNAMES_SEEDED_KEY)
+        assert not await rds.exists(TAKEN_USERNAMES_SEED_LOCK_KEY)
+        assert await seed_taken_usernames(batch=2) == 0  # once per Redis dataset
+
+        async with _client() as client:
+            return await client.post("/register", json=CREDENTIALS)
+
+    resp = asyncio.run(scenario())
+    assert resp.status_code == 409
+    assert fake_bcrypt.calls == 0
+
+
+def test_concurrent_registrations_of_one_name_get_one_409(sqlite_db, fake_bcrypt):
+    async def scenario():
+        # Both requests pass the pre-check and hash before either inserts
+        fake_bcrypt.gate = asyncio.Barrier(2)
+        async with _client() as client:
+            return await asyncio.gather(*(client.post("/register", json=CREDENTIALS) for _ in range(2)))
+
+    responses = asyncio.run(scenario())
+    assert sorted(resp.status_code for resp in responses) == [200, 409]
+    assert fake_bcrypt.calls == 2
+    assert _users(sqlite_db, "amy") == 1
+
+
+def test_logout_all_revokes_every_session_of_the_caller_only(sqlite_db, fake_redis, fake_bcrypt, monkeypatch):
+    monkeypatch.setattr(jwt_helpers, "JWT_SECRET", "test-" + "x" * 32)
+    bob = {"username": "bob", "password": "bob-password"}
+
+    async def login(credentials: dict) -> httpx.AsyncClient:
+        client = _client()
+        resp = await client.post("/login", json=credentials)
+        assert resp.status_code == 200
+        client.headers["Authorization"] = f"Bearer {resp.json()['access_token']}"
+        return client
+
+    async def scenario():
+        rds = get_redis_client()
+        async with _client() as client:
+            for credentials in (CREDENTIALS, bob):
+                assert (await client.post("/register", json=credentials)).status_code == 200
+        amy_devices = [await login(CREDENTIALS) for _ in range(3)]
+        bob_device = await login(bob)
+        amy_tokens = [hash_refresh_token(device.cookies["refresh_token"]) for device in amy_devices]
+        bob_token = hash_refresh_token(bob_device.cookies["refresh_token"])
+        assert all([await rds.exists(redis_key(token)) for token in amy_tokens])
+
+        resp = await amy_devices[0].post("/logout/all")
+        assert (resp.status_code, resp.json()["sessions_revoked"]) == (200, 3)
+
+        # Redis: amy's records and session set are gone, bob's are untouched
+        assert not any([await rds.exists(redis_key(token)) for token in amy_tokens])
+        with Session(sqlite_db) as s:
+            amy_id, bob_id = (s.scalar(select(User.id).where(User.username == name)) for name in ("amy", "bob"))
+        assert not await rds.exists(user_sessions_key(amy_id))
+        assert await rds.exists(redis_key(bob_token))
+        assert await rds.scard(user_sessions_key(bob_id)) == 1
+
+        # No device of amy's can refresh, or use the access token that logged out; bob still can
+        for device in amy_devices:
+            assert (await device.post("/refresh")).status_code == 401
+        assert (await amy_devices[0].get("/metrics")).status_code == 401
+        assert (await bob_device.post("/refresh")).status_code == 200
+        for device in (*amy_devices, bob_device):
+            await device.aclose()
+        return amy_id, bob_id
+
+    amy_id, bob_id = asyncio.run(scenario())
+    with Session(sqlite_db) as s:
+        revoked = dict(
+            s.execute(
+                select(RefreshSession.user_id, func.count())
+                .where(RefreshSession.revoked_at.is_not(None))
+                .group_by(RefreshSession.user_id)
+            ).all()
+        )
+        live = dict(
+            s.execute(
+                select(RefreshSession.user_id, func.count())
+                .where(RefreshSession.revoked_at.is_(None))
+                .group_by(RefreshSession.user_id)
+            ).all()
+        )
+    # bob's refresh above rotated his session: one revoked, one live
+    assert revoked == {amy_id: 3, bob_id: 1}
+    assert live == {bob_id: 1}
+
+
+def test_old_cookie_gets_nothing_from_the_grace_window_after_logout_all(sqlite_db, fake_redis, fake_bcrypt, monkeypatch):
+    monkeypatch.setattr(jwt_helpers, "JWT_SECRET", "test-" + "x" * 32)
+
+    async def refresh_with(cookie: str) -> httpx.Response:
+        # Another tab, still holding the cookie from before the rotation
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test.local", cookies={"refresh_token": cookie}
+        ) as tab:
+            return await tab.post("/refresh")
+
+    async def scenario():
+        async with _client() as client:
+            assert (await client.post("/register", json=CREDENTIALS)).status_code == 200
+            assert (await client.post("/login", json=CREDENTIALS)).status_code == 200
+            old_cookie = client.cookies["refresh_token"]
+            refreshed = await client.post("/refresh")
+            assert refreshed.status_code == 200
+            # Inside the grace window: the same result
+            assert (await refresh_with(old_cookie)).json() == refreshed.json()
+
+            headers = {"Authorization": f"Bearer {refreshed.json()['access_token']}"}
+            assert (await client.post("/logout/all", headers=headers)).status_code == 200
+            return await refresh_with(old_cookie)
+
+    resp = asyncio.run(scenario())
+    assert (resp.status_code, resp.json()["detail"]) == (401, "Refresh token revoked")